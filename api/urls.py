@@ -4,7 +4,7 @@ from rest_framework.routers import DefaultRouter
 
 from xchem_db.views import TargetView, CompoundsView, ReferenceView, SoakdbFilesView, CrystalView, DataProcessingView, \
     DimpleView, LabView, RefinementView, PanddaAnalysisView, PanddaRunView, PanddaSiteView, PanddaEventView, \
-    ProasisOutView, FragspectCrystalView
+    ProasisOutView, FragspectCrystalView, PanddaEventNearView, PanddaSiteClusterView
 
 # from rest_framework_swagger.views import get_swagger_view
 
@@ -26,6 +26,8 @@ router.register(r'pandda_site', PanddaSiteView)
 router.register(r'pandda_event', PanddaEventView)
 router.register(r'proasis_out', ProasisOutView)
 router.register(r'fragspect', FragspectCrystalView)
+router.register(r'pandda_event_near', PanddaEventNearView, base_name='pandda_event_near')
+router.register(r'pandda_site_cluster', PanddaSiteClusterView, base_name='pandda_site_cluster')
 
 # schema_view = get_swagger_view(title='Pipeline API')
 
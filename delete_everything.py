@@ -1,8 +1,7 @@
 import glob
 import os
 
-import pandas as pd
-
+from functions import csv_functions
 from xchem_db.models import *
 
 soakdb_rows = SoakdbFiles.objects.all()
@@ -18,7 +17,7 @@ for row in soakdb_rows:
 list_of_files = glob.glob('logs/search_paths_*')
 latest_file = max(list_of_files, key=os.path.getctime)
 
-search_paths = [path for path in pd.DataFrame.from_csv(latest_file)['search_path']]
+search_paths = [path for path in csv_functions.read_frame(latest_file, 'search_paths')['search_path']]
 
 for path in search_paths:
     if os.path.isfile(os.path.join(path, 'transfer_pandda_data.done')):
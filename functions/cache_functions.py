@@ -0,0 +1,178 @@
+import json
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+from functions import metrics_functions
+
+
+class FileCache(object):
+    """
+    A persistent (sqlite) cache of values worked out from files, e.g. the results of parsing a log. Values are keyed
+    on the file's path, size and mtime, so a value is only used while the file hasn't changed. Values must be json
+    serialisable.
+    """
+
+    def __init__(self, cache_file, name):
+        self.cache_file = cache_file
+        self.table = str('cache_' + name)
+        self.hits = 0
+        self.misses = 0
+        # sqlite connections can't be shared between threads or forked processes, so each has its own
+        self.local = threading.local()
+
+        if os.path.dirname(cache_file) and not os.path.isdir(os.path.dirname(cache_file)):
+            os.makedirs(os.path.dirname(cache_file))
+
+        self.conn.execute(str('CREATE TABLE IF NOT EXISTS ' + self.table +
+                              ' (path TEXT PRIMARY KEY, size INTEGER, mtime INTEGER, value TEXT)'))
+        self.conn.commit()
+
+    @property
+    def conn(self):
+        if getattr(self.local, 'pid', None) != os.getpid():
+            self.local.conn = sqlite3.connect(self.cache_file, timeout=30)
+            self.local.pid = os.getpid()
+        return self.local.conn
+
+    @staticmethod
+    def file_key(path):
+        stat = os.stat(path)
+        return stat.st_size, stat.st_mtime_ns
+
+    def get(self, path, key=None):
+        # the cached value for path, or None if there isn't one for the file as it is now
+        if key is None:
+            key = self.file_key(path)
+        row = self.conn.execute(str('SELECT size, mtime, value FROM ' + self.table + ' WHERE path = ?'),
+                                (path,)).fetchone()
+        if row is not None and (row[0], row[1]) == key:
+            self.hits += 1
+            return json.loads(row[2])
+        self.misses += 1
+        return None
+
+    def set(self, path, value, key=None):
+        if key is None:
+            key = self.file_key(path)
+        with self.conn:
+            self.conn.execute(str('INSERT OR REPLACE INTO ' + self.table + ' (path, size, mtime, value) '
+                                  'VALUES (?, ?, ?, ?)'), (path, key[0], key[1], json.dumps(value)))
+
+    def get_or_compute(self, path, function):
+        """
+        Return the cached value for path, or work it out with function(path) and cache it. The file is stat'ed
+        before function is called, so a file that changes while it is being read is read again next time.
+        """
+        key = self.file_key(path)
+        value = self.get(path, key=key)
+        if value is None:
+            value = function(path)
+            self.set(path, value, key=key)
+        return value
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses}
+
+    def close(self):
+        self.conn.close()
+
+
+class StatCache(object):
+    """
+    An in-memory cache of file existence checks, so that a file is only looked up on the (network) filesystem once
+    per run. With prefetch=True, the first check in a directory lists the whole directory with one scandir, and
+    checks for the other files in it are answered from that listing.
+
+    Results are kept for ttl seconds, so long running processes (e.g. the web server) see files that appear later,
+    and the cache is cleared when each task starts (see start_pipeline.py). At most max_listings directory listings
+    and max_files file checks are kept, the least recently used going first. It can be shared between threads.
+    """
+
+    def __init__(self, ttl=60, prefetch=True, max_listings=2000, max_files=100000):
+        self.ttl = ttl
+        self.prefetch = prefetch
+        self.max_listings = max_listings
+        self.max_files = max_files
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+        # path -> (time checked, whether it is a file)
+        self.files = OrderedDict()
+        # directory -> (time listed, dict of name -> os.DirEntry, empty if the directory can't be listed)
+        self.listings = OrderedDict()
+
+    def fresh(self, checked):
+        return time.time() - checked < self.ttl
+
+    def lookup(self, cache, key):
+        # the cached value for key if it is still fresh, or None
+        with self.lock:
+            cached = cache.get(key)
+            if cached is not None and self.fresh(cached[0]):
+                cache.move_to_end(key)
+                self.hits += 1
+            else:
+                cached = None
+                self.misses += 1
+        metrics_functions.count('stat_misses' if cached is None else 'stat_hits')
+        return cached
+
+    def store(self, cache, key, value, limit):
+        with self.lock:
+            cache[key] = (time.time(), value)
+            cache.move_to_end(key)
+            while len(cache) > limit:
+                cache.popitem(last=False)
+
+    def listing(self, directory):
+        cached = self.lookup(self.listings, directory)
+        if cached is not None:
+            return cached[1]
+
+        # listed outside the lock, so threads checking other directories don't wait for this one
+        try:
+            entries = dict((entry.name, entry) for entry in os.scandir(directory))
+        except OSError:
+            # missing directory (or no permission), so nothing in it can be read
+            entries = {}
+        self.store(self.listings, directory, entries, self.max_listings)
+
+        return entries
+
+    def isfile(self, path):
+        # os.path.isfile, from the cache where possible
+        path = str(path)
+
+        if self.prefetch:
+            entry = self.listing(os.path.dirname(path) or '.').get(os.path.basename(path))
+            if entry is None:
+                return False
+            try:
+                # DirEntry keeps the result, so a symlink is only followed once
+                return entry.is_file()
+            except OSError:
+                return False
+
+        cached = self.lookup(self.files, path)
+        if cached is not None:
+            return cached[1]
+
+        exists = os.path.isfile(path)
+        self.store(self.files, path, exists, self.max_files)
+
+        return exists
+
+    def clear(self):
+        with self.lock:
+            self.files = OrderedDict()
+            self.listings = OrderedDict()
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses}
+
+
+# shared by the file checks in pandda_functions and db_functions
+stat_cache = StatCache()
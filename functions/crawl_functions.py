@@ -0,0 +1,251 @@
+import glob
+import json
+import os
+import sqlite3
+import time
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from fnmatch import fnmatchcase
+
+from functions import metrics_functions
+
+
+# What to look for when crawling the visit directories. Each search has a file name pattern, the maximum depth
+# (relative to the directory the crawl starts from, as for find -maxdepth), and the path patterns that are pruned
+# (as for find -path ... -prune). Directories are matched with a trailing '/', so '*/lab36/*' prunes lab36 itself.
+SEARCHES = {
+    'soakdb': {
+        'name': 'soakDBDataFile.sqlite',
+        'maxdepth': 5,
+        'prune': ['*/lab36/*', '*/tmp/*', '*BACKUP*', '*/initial_model/*', '*/beamline/*', '*/analysis/*', '*ackup*',
+                  '*ack*', '*old*', '*TeXRank*']
+    },
+    'pandda_log': {
+        'name': 'pandda-*.log',
+        'maxdepth': 10,
+        'prune': ['*/lab36/*', '*/initial_model/*', '*/beamline/*', '*ackup*', '*old*', '*TeXRank*']
+    }
+}
+
+
+# a directory changed this close to the start of a crawl may change again within the same mtime tick (1 s on some
+# filesystems) after it was listed, so its listing is not reused by the next crawl
+SETTLE_SECONDS = 2
+
+
+def is_pruned(path, search):
+    for pattern in search['prune']:
+        if fnmatchcase(path, pattern):
+            return True
+    return False
+
+
+def load_index(index_file):
+    """
+    Read the crawl index (a sqlite file holding, for every directory listed by a previous crawl, its mtime, its
+    subdirectories, and the files in it that match any of the SEARCHES).
+
+    Returns: a dict of path -> (mtime_ns, subdirectory names, file names)
+    """
+    conn = sqlite3.connect(index_file)
+    conn.execute('CREATE TABLE IF NOT EXISTS directories '
+                 '(path TEXT PRIMARY KEY, mtime INTEGER, subdirs TEXT, files TEXT)')
+    conn.execute('CREATE TABLE IF NOT EXISTS searches (names TEXT)')
+    conn.commit()
+
+    index = {}
+    # if the searches have changed, the file lists in the index are no good
+    stored = conn.execute('SELECT names FROM searches').fetchall()
+    if stored and stored[0][0] == search_names():
+        for path, mtime, subdirs, files in conn.execute('SELECT path, mtime, subdirs, files FROM directories'):
+            index[path] = (mtime, json.loads(subdirs), json.loads(files))
+    conn.close()
+
+    return index
+
+
+def save_index(index_file, listings, roots, index, started=None):
+    # write the listings from this crawl, and drop directories under the roots that weren't seen this time
+    seen = set(listings.keys())
+    roots = tuple([str(root.rstrip('/') + '/') for root in roots])
+    stale = [(path,) for path in index.keys() if path not in seen and str(path + '/').startswith(roots)]
+
+    # listings of directories that changed within SETTLE_SECONDS of the crawl starting are stored with no mtime, so
+    # they are always read again
+    if started is not None:
+        settled = int((started - SETTLE_SECONDS) * 1e9)
+        listings = dict((path, (0 if listing[0] > settled else listing[0],) + tuple(listing[1:]))
+                        for path, listing in listings.items())
+
+    conn = sqlite3.connect(index_file)
+    with conn:
+        conn.execute('DELETE FROM searches')
+        conn.execute('INSERT INTO searches (names) VALUES (?)', (search_names(),))
+        conn.executemany('DELETE FROM directories WHERE path = ?', stale)
+        conn.executemany('INSERT OR REPLACE INTO directories (path, mtime, subdirs, files) VALUES (?, ?, ?, ?)',
+                         [(path, mtime, json.dumps(subdirs), json.dumps(files))
+                          for path, (mtime, subdirs, files) in listings.items()])
+    conn.close()
+
+
+def search_names():
+    return json.dumps(sorted([search['name'] for search in SEARCHES.values()]))
+
+
+def list_directory(path, cached=None):
+    """
+    List the subdirectories of path, and the files in it that match any of the SEARCHES. A directory's mtime only
+    changes when entries are added to, removed from or renamed in it, so if it matches the cached listing, the cached
+    listing is used rather than reading the directory again.
+
+    Returns: mtime_ns, subdirectory names, file names, and whether the cached listing was used
+    """
+    # stat before listing, so anything written while listing moves the mtime past what is stored
+    mtime = os.stat(path).st_mtime_ns
+
+    if cached and cached[0] == mtime:
+        return mtime, cached[1], cached[2], True
+
+    subdirs = []
+    files = []
+    for entry in os.scandir(path):
+        try:
+            # like find, don't follow symlinks to directories
+            is_dir = entry.is_dir(follow_symlinks=False)
+        except OSError:
+            continue
+        if is_dir:
+            subdirs.append(entry.name)
+        elif True in [fnmatchcase(entry.name, search['name']) for search in SEARCHES.values()]:
+            files.append(entry.name)
+
+    return mtime, subdirs, files, False
+
+
+def scan_directory(path, depth, searches, cached=None):
+    """
+    List one directory, returning the files that match any of the searches still active for it, and the
+    subdirectories that at least one search still wants to descend into.
+    """
+    found = []
+    subdirs = []
+    pruned = 0
+
+    try:
+        listing = list_directory(path, cached)
+    except OSError:
+        # permission denied, or removed since the parent was listed
+        return found, subdirs, pruned, None
+
+    entry_depth = depth + 1
+
+    for name in listing[1]:
+        dir_path = os.path.join(path, name)
+        active = []
+        dropped = False
+        for search_name in searches:
+            if entry_depth >= SEARCHES[search_name]['maxdepth']:
+                continue
+            if is_pruned(str(dir_path + '/'), SEARCHES[search_name]):
+                dropped = True
+                continue
+            active.append(search_name)
+        if active:
+            subdirs.append((dir_path, entry_depth, tuple(active)))
+        elif dropped:
+            pruned += 1
+
+    for name in listing[2]:
+        file_path = os.path.join(path, name)
+        for search_name in searches:
+            search = SEARCHES[search_name]
+            if entry_depth <= search['maxdepth'] and fnmatchcase(name, search['name']) \
+                    and not is_pruned(file_path, search):
+                found.append((search_name, file_path))
+
+    return found, subdirs, pruned, listing
+
+
+def crawl(roots, searches=('soakdb', 'pandda_log'), workers=16, index_file=None, full_walk=False):
+    """
+    Walk the directory trees under roots in parallel (a thread pool over os.scandir), looking for the files described
+    by searches (keys of SEARCHES). All searches are done in the same walk, and a directory is only listed if at least
+    one search still needs it.
+
+    If index_file is given, directory listings are kept there between crawls, and directories that haven't changed
+    since the last crawl are not read again (unless full_walk is True). Every directory is still stat'ed, so new,
+    removed and renamed files are found at any depth: adding or removing an entry changes the mtime of the directory
+    it is in, and that directory is read again. What the index can miss:
+        - a change within the same mtime tick as the listing. Directories that changed within SETTLE_SECONDS of the
+          crawl starting are always read again next time, which covers filesystems with 1 s timestamps.
+        - a change whose mtime the client can't see yet, e.g. NFS attribute caching (actimeo). These are picked up by
+          the first crawl after the cached attributes expire.
+        - a change to a directory whose mtime is then set back to the stored value (touch -r, rsync -t). Use full_walk
+          to crawl without the index.
+
+    Returns: a dict of search name -> sorted list of files found, and a dict of walk statistics
+    """
+    start = time.time()
+
+    found = dict((name, []) for name in searches)
+    stats = {'roots': len(roots), 'dirs_visited': 0, 'dirs_pruned': 0, 'dirs_skipped': 0, 'errors': 0}
+
+    index = {}
+    if index_file:
+        index = load_index(index_file)
+    # the listings from this crawl, to write back to the index
+    listings = {}
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        # future -> the directory it is listing
+        pending = {}
+
+        def submit(path, depth, active):
+            cached = None
+            if not full_walk:
+                cached = index.get(path)
+            pending[executor.submit(scan_directory, path, depth, active, cached)] = path
+
+        for root in roots:
+            if not os.path.isdir(root):
+                continue
+            active = tuple([name for name in searches if not is_pruned(str(root.rstrip('/') + '/'), SEARCHES[name])])
+            if active:
+                submit(root, 0, active)
+
+        while pending:
+            done = wait(pending, return_when=FIRST_COMPLETED)[0]
+            for future in done:
+                directory = pending.pop(future)
+                files, subdirs, pruned, listing = future.result()
+                stats['dirs_visited'] += 1
+                stats['dirs_pruned'] += pruned
+                if listing is None:
+                    stats['errors'] += 1
+                    continue
+                if listing[3]:
+                    stats['dirs_skipped'] += 1
+                for name, path in files:
+                    found[name].append(path)
+                for path, depth, active in subdirs:
+                    submit(path, depth, active)
+                listings[directory] = listing[:3]
+
+    if index_file:
+        save_index(index_file, listings, roots, index, started=start)
+
+    for name in found.keys():
+        found[name] = sorted(found[name])
+        stats[str(name + '_found')] = len(found[name])
+
+    stats['seconds'] = round(time.time() - start, 2)
+    metrics_functions.count('files', sum([len(files) for files in found.values()]))
+
+    print(str('CRAWL: ' + ', '.join([str(key + '=' + str(stats[key])) for key in sorted(stats.keys())])))
+
+    return found, stats
+
+
+def crawl_path(filepath, searches=('soakdb', 'pandda_log'), workers=16, index_file=None, full_walk=False):
+    # filepath can be a glob (e.g. /dls/labxchem/data/*/lb*/*) as for the find commands it replaces
+    return crawl(sorted(glob.glob(filepath)), searches=searches, workers=workers, index_file=index_file,
+                 full_walk=full_walk)
@@ -0,0 +1,119 @@
+import os
+from collections import OrderedDict
+
+import pandas as pd
+
+try:
+    import pyarrow
+except ImportError:
+    pyarrow = None
+
+
+# column types for the csvs read by the pipeline, so they aren't worked out from the data every time (and crystal
+# names like 0001 stay as strings). Columns not listed are left to pandas. index_col is as for pd.read_csv: the
+# pipeline's own files are written with their index (and were read with pd.DataFrame.from_csv, which uses index_col=0)
+SCHEMAS = {
+    'pandda_sites': {
+        'index_col': None,
+        'dtype': {'site_idx': int, 'centroid': str, 'native_centroid': str}
+    },
+    'pandda_events': {
+        'index_col': None,
+        'dtype': {'dtag': str, 'event_idx': int, 'site_idx': int, '1-BDC': float, 'x': float, 'y': float,
+                  'z': float}
+    },
+    'pandda_info': {
+        'index_col': 0,
+        'dtype': {'log_file': str, 'pver': str, 'input_dir': str, 'output_dir': str, 'sites_file': str,
+                  'events_file': str, 'sdbfile': str}
+    },
+    'search_paths': {
+        'index_col': 0,
+        'dtype': {'search_path': str, 'soak_db_filepath': str, 'sdbfile': str}
+    },
+    'duplicates': {
+        'index_col': 0,
+        'dtype': {'crystal': str, 'file_1': str, 'file_2': str, 'smiles': str, 'target': str}
+    }
+}
+
+# frames already read by this process: (path, schema, size, mtime_ns) -> frame, least recently used first. Frames are
+# only kept while their file is unchanged, and at most MEMO_SIZE of them
+MEMO_SIZE = 32
+memo = OrderedDict()
+memo_stats = {'hits': 0, 'misses': 0}
+
+
+def columnar_file(path):
+    # the parquet copy of a csv written by write_frame(..., columnar=True)
+    return str(path + '.parquet')
+
+
+def file_key(path):
+    stat = os.stat(path)
+    return stat.st_size, stat.st_mtime_ns
+
+
+def read_columnar(path, schema):
+    # read a parquet copy written by write_frame, giving the same frame as pd.read_csv with the schema would
+    frame = pd.read_parquet(path)
+
+    if SCHEMAS[schema]['index_col'] is None:
+        # the csv has the index written as its first column, which read_csv gives back as a column
+        name = frame.index.name
+        frame = frame.reset_index()
+        if name is None:
+            frame = frame.rename(columns={'index': 'Unnamed: 0'})
+    else:
+        # the csv's index column has no header
+        frame.index.name = None
+
+    dtype = SCHEMAS[schema]['dtype']
+    return frame.astype(dict((column, dtype[column]) for column in dtype.keys() if column in frame.columns))
+
+
+def read_frame(path, schema):
+    """
+    Read a csv with the column types in SCHEMAS[schema]. A file is only read once by a process for as long as it
+    doesn't change, so a csv read in a task's requires() is not read again in run(). If there is an up to date
+    parquet copy of the file (see write_frame), that is read instead.
+
+    Returns: a copy of the frame, so callers can change it without affecting the next read
+    """
+    key = (path, schema) + file_key(path)
+    if key in memo.keys():
+        memo.move_to_end(key)
+        memo_stats['hits'] += 1
+        return memo[key].copy()
+
+    memo_stats['misses'] += 1
+
+    columnar = columnar_file(path)
+    if pyarrow is not None and os.path.isfile(columnar) and os.path.getmtime(columnar) >= os.path.getmtime(path):
+        frame = read_columnar(columnar, schema)
+    else:
+        frame = pd.read_csv(path, index_col=SCHEMAS[schema]['index_col'], dtype=SCHEMAS[schema]['dtype'])
+
+    # older versions of the file won't be read again
+    for old in [k for k in memo.keys() if k[:2] == key[:2]]:
+        memo.pop(old)
+    memo[key] = frame
+    while len(memo) > MEMO_SIZE:
+        memo.popitem(last=False)
+
+    return frame.copy()
+
+
+def write_frame(frame, path, columnar=False):
+    """
+    Write one of the pipeline's intermediate frames as csv (the luigi targets are always the csv). With columnar=True
+    (and pyarrow installed), a parquet copy is written alongside it for read_frame to use.
+    """
+    frame.to_csv(path)
+
+    columnar_path = columnar_file(path)
+    if columnar and pyarrow is not None:
+        frame.to_parquet(columnar_path)
+    elif os.path.isfile(columnar_path):
+        # don't leave an old copy behind
+        os.remove(columnar_path)
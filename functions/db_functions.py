@@ -1,14 +1,25 @@
+import glob
+import hashlib
 import os
 import re
 import sqlite3
-import subprocess
+import time
+import urllib.parse
+from concurrent.futures import ThreadPoolExecutor
 
 import pandas as pd
 from django.core.exceptions import ObjectDoesNotExist
-from django.db import IntegrityError
+from django.db import connection
 from django.db import transaction
+from django.db.models import FloatField, IntegerField
+from django.utils import timezone
 
+from functions import cache_functions
+from functions import csv_functions
+from functions import metrics_functions
 from functions import misc_functions
+from functions import pandda_functions
+from functions import pdb_functions
 from xchem_db import models
 
 
@@ -18,6 +29,10 @@ from xchem_db import models
 # l.setLevel(logging.DEBUG)
 # l.addHandler(logging.StreamHandler())
 
+# soakdb values that are treated as empty when transferring to the database
+disallowed_values = [None, 'None', '', '-', 'n/a', 'null', 'pending', 'NULL', '#NAME?', '#NOM?', 'None\t',
+                     'Analysis Pending', 'in-situ']
+
 def reference_translations():
     reference = {
         'reference': 'DimpleReferencePDB'
@@ -159,6 +174,113 @@ def refinement_translations():
     return refinement
 
 
+def soakdb_translations():
+    # models populated from the soakdb mainTable, in the order they have to be written (crystal first)
+    translations = [
+        (models.Crystal, crystal_translations()),
+        (models.Lab, lab_translations()),
+        (models.Refinement, refinement_translations()),
+        (models.Dimple, dimple_translations()),
+        (models.DataProcessing, data_processing_translations())
+    ]
+
+    return translations
+
+
+def expected_values(values, key):
+    """
+    Apply the conversions done by translate_row to a column of soakdb values, for comparison with the model field key.
+
+    Returns: the expected values, and a mask of the values that are not transferred (so can't be checked)
+    """
+    skip = values.isnull() | values.isin(disallowed_values)
+
+    if key == 'outcome':
+        numbers = values.astype(str).str.findall(r'-?\d+')
+        skip = skip | (numbers.str.len() == 0)
+        values = pd.to_numeric(numbers.str[0].where(numbers.str.len() == 1), errors='coerce')
+
+    if key == 'lig_confidence_int':
+        values = pd.to_numeric(values.astype(str).str.split('-').str[0].str.strip(), errors='coerce').fillna(-1)
+
+    if key == 'lig_confidence_string':
+        values = values.astype(str).str.split('-').str[1].fillna('Unassigned')
+
+    return values, skip
+
+
+def upload_mismatches(filename, model, conn=None):
+    """
+    Compare the rows of a soakdb file with what has been transferred to model (Lab, Refinement, Dimple or
+    DataProcessing). The file is read into one DataFrame, the table with one query, the two are joined on crystal name
+    and compound, and each translated column is compared in one go.
+
+    Returns: a DataFrame of mismatches (crystal, soakdb_field, model_field, soakdb_value, model_value)
+    """
+    error_dict = {
+        'crystal': [],
+        'soakdb_field': [],
+        'model_field': [],
+        'soakdb_value': [],
+        'model_value': []
+    }
+
+    translate_dict = dict(soakdb_translations())[model]
+
+    rows = soakdb_query(filename, columns=soakdb_columns([translate_dict]), conn=conn)
+    if not rows:
+        return pd.DataFrame.from_dict(error_dict)
+    soakdb_frame = pd.DataFrame([tuple(row) for row in rows], columns=rows[0].keys())
+
+    keys = [key for key, column in translate_dict.items() if key != 'crystal_name' and column in soakdb_frame.columns]
+    # related objects are compared on the value they were looked up with
+    lookups = dict((key, key) for key in keys)
+    if 'reference' in lookups.keys():
+        lookups['reference'] = 'reference__reference_pdb'
+
+    model_frame = pd.DataFrame(list(model.objects.filter(crystal_name__visit__filename=filename).values(
+        'crystal_name__crystal_name', 'crystal_name__compound__smiles', *lookups.values())),
+        columns=['crystal_name__crystal_name', 'crystal_name__compound__smiles'] + list(lookups.values()))
+    model_frame = model_frame.rename(columns=dict(
+        [('crystal_name__crystal_name', 'CrystalName'), ('crystal_name__compound__smiles', 'CompoundSMILES')] +
+        [(lookup, str('model:' + key)) for key, lookup in lookups.items()]))
+
+    if model_frame.duplicated(['CrystalName', 'CompoundSMILES']).any():
+        raise Exception('Multiple Crystals!')
+
+    merged = soakdb_frame.merge(model_frame, how='left', on=['CrystalName', 'CompoundSMILES'], indicator=True)
+
+    missing = merged[merged['_merge'] == 'left_only']
+    if model == models.Dimple:
+        # no dimple entry is expected for a crystal without dimple results
+        missing = missing[missing['DimplePathToPDB'].notnull() & (missing['DimplePathToPDB'] != '') |
+                          missing['DimplePathToMTZ'].notnull() & (missing['DimplePathToMTZ'] != '')]
+    if len(missing) > 0:
+        raise Exception(str('No entry for ' + ', '.join([str(name) for name in missing['CrystalName']])))
+
+    merged = merged[merged['_merge'] == 'both']
+
+    for key in keys:
+        column = translate_dict[key]
+        expected, skip = expected_values(merged[column], key)
+        model_values = merged[str('model:' + key)]
+
+        if isinstance(model._meta.get_field(key), (FloatField, IntegerField)):
+            different = ~(pd.to_numeric(expected, errors='coerce') == pd.to_numeric(model_values, errors='coerce'))
+        else:
+            different = expected.astype(str) != model_values.astype(str)
+
+        different = different & ~skip
+
+        error_dict['crystal'].extend(list(merged['CrystalName'][different]))
+        error_dict['soakdb_field'].extend([column] * int(different.sum()))
+        error_dict['model_field'].extend([key] * int(different.sum()))
+        error_dict['soakdb_value'].extend(list(merged[column][different]))
+        error_dict['model_value'].extend(list(model_values[different]))
+
+    return pd.DataFrame.from_dict(error_dict)
+
+
 def distinct_crystals_sqlite(filename):
     conn = sqlite3.connect(filename)
     conn.row_factory = sqlite3.Row
@@ -233,7 +355,7 @@ def check_db_duplicates(filename):
     pop_soakdb(filename)
     duplicates_file = 'duplicates.csv'
     if os.path.isfile(os.path.join(os.getcwd(), duplicates_file)):
-        duplicates_dict = pd.DataFrame.from_csv(duplicates_file).to_dict(orient='list')
+        duplicates_dict = csv_functions.read_frame(duplicates_file, 'duplicates').to_dict(orient='list')
     else:
         duplicates_dict = {'crystal': [],
                            'file_1': [],
@@ -245,11 +367,11 @@ def check_db_duplicates(filename):
     if table == 0:
         return None
 
-    # standard soakdb query for all data
-    results = soakdb_query(filename)
+    # only the columns that identify a crystal are needed
+    lst = [(row['CrystalName'], row['CompoundSMILES'], row['ProteinName']) for chunk in
+           soakdb_rows(filename, columns=['CrystalName', 'CompoundSMILES', 'ProteinName']) for row in chunk]
 
     # check for existing crystal entries
-    lst = [(row['CrystalName'], row['CompoundSMILES'], row['ProteinName']) for row in results]
     for tup in lst:
         vals = list(tup)
         obj, was_created = models.Crystal.objects.get_or_create(crystal_name=vals[0],
@@ -273,170 +395,436 @@ def check_db_duplicates(filename):
     pd.DataFrame.from_dict(duplicates_dict).to_csv(duplicates_file)
 
 
-# @transaction.atomic
-def transfer_table(translate_dict, filename, model):
-    # standard soakdb query for all data
-    results = soakdb_query(filename)
-
-    # for each row found in soakdb
-    for row in results:
-        compound_smiles = row['CompoundSMILES']
-        crystal_name = row['CrystalName']
-        target = row['ProteinName']
-        if not target or target == 'None':
-            try:
-                target = str(row['CrystalName']).split('-')[0]
-            except:
-                continue
+def translate_row(row, inverted_dict):
+    # swap soakdb column names for model field names, dropping anything that counts as an empty value
+    d = {}
+    for key in row.keys():
+        if key in inverted_dict.keys():
+            d[inverted_dict[key]] = row[key]
 
-        # set up blank dictionary to hold model values
-        d = {}
-        # get the keys and values of the query
-        row_keys = row.keys()
-        row_values = list(tuple(row))
+    d = {k: v for k, v in d.items() if v not in disallowed_values}
+
+    if 'outcome' in d.keys():
+        value = re.compile(r'-?\d+').findall(str(d['outcome']))
+        if len(value) > 1:
+            raise Exception('multiple values found in outcome string')
+        if value:
+            d['outcome'] = int(value[0])
+        else:
+            d.pop('outcome')
 
-        # swap the keys over for lookup, and give any missing keys a none value to skip them
-        for i, x in enumerate(row_keys):
-            if x in dict((v, k) for k, v in translate_dict.items()).keys():
-                key = dict((v, k) for k, v in translate_dict.items())[x]
+    if 'lig_confidence_int' in d.keys():
+        try:
+            d['lig_confidence_int'] = int(str(d['lig_confidence_int']).split('-')[0])
+        except ValueError:
+            d['lig_confidence_int'] = -1
+
+    if 'lig_confidence_string' in d.keys():
+        try:
+            d['lig_confidence_string'] = str(d['lig_confidence_string']).split('-')[1]
+        except IndexError:
+            d['lig_confidence_string'] = 'Unassigned'
+
+    return d
+
+
+def bulk_get_or_create(model, field_name, values):
+    # get (or create) all objects for a set of values of a unique field, with one lookup and one insert
+    values = list(set([v for v in values if v not in disallowed_values]))
+    if not values:
+        return {}
+
+    objects = model.objects.in_bulk(values, field_name=field_name)
+    missing = [model(**{field_name: v}) for v in values if v not in objects.keys()]
+
+    if missing:
+        model.objects.bulk_create(missing)
+        objects.update(model.objects.in_bulk([getattr(m, field_name) for m in missing], field_name=field_name))
+
+    return objects
+
+
+def bulk_upsert(model, objs, conflict_fields, update_fields=None, batch_size=500):
+    """
+    Write a list of (unsaved) model instances with one INSERT ... ON CONFLICT statement per batch (postgres only).
+    Rows that conflict on conflict_fields are updated, unless the values in update_fields are unchanged, in which
+    case they are left alone so that auto_now fields are not bumped.
+
+    Returns: (number of rows inserted, number of rows updated)
+    """
+    if not objs:
+        return 0, 0
+
+    meta = model._meta
+    fields = [f for f in meta.local_concrete_fields if not f.primary_key]
+    if update_fields is None:
+        update_fields = [f.name for f in fields if f.name not in conflict_fields and not getattr(f, 'auto_now_add',
+                                                                                                   False)]
+    update = [meta.get_field(name) for name in update_fields]
+    compare = [f for f in update if not getattr(f, 'auto_now', False)]
+
+    qn = connection.ops.quote_name
+    table = qn(meta.db_table)
+
+    sql = str('INSERT INTO ' + table + ' (' + ', '.join([qn(f.column) for f in fields]) + ') VALUES %s ' +
+              'ON CONFLICT (' + ', '.join([qn(meta.get_field(name).column) for name in conflict_fields]) + ') ')
+    if update:
+        sql += str('DO UPDATE SET ' + ', '.join([qn(f.column) + ' = EXCLUDED.' + qn(f.column) for f in update]))
+        if compare:
+            sql += str(' WHERE (' + ', '.join([table + '.' + qn(f.column) for f in compare]) + ') IS DISTINCT FROM (' +
+                       ', '.join(['EXCLUDED.' + qn(f.column) for f in compare]) + ')')
+    else:
+        sql += 'DO NOTHING'
+    sql += ' RETURNING (xmax = 0)'
+
+    row_placeholder = '(' + ', '.join(['%s'] * len(fields)) + ')'
+
+    inserted = 0
+    updated = 0
+
+    with connection.cursor() as c:
+        for i in range(0, len(objs), batch_size):
+            batch = objs[i:i + batch_size]
+            params = []
+            for obj in batch:
+                params.extend([f.get_db_prep_save(f.pre_save(obj, True), connection) for f in fields])
+            c.execute(sql % ', '.join([row_placeholder] * len(batch)), params)
+            for row in c.fetchall():
+                if row[0]:
+                    inserted += 1
+                else:
+                    updated += 1
 
-                if key not in d.keys():
-                    d[key] = ''
-                d[key] = row_values[i]
+    return inserted, updated
 
-        # get the fields that must exist in the model (i.e. table)
-        model_fields = [f.name for f in model._meta.local_fields]
 
-        disallowed_floats = [None, 'None', '', '-', 'n/a', 'null', 'pending', 'NULL', '#NAME?', '#NOM?', 'None\t',
-                             'Analysis Pending', 'in-situ']
+def drop_unique_conflicts(model, objs, owner_field='crystal_name'):
+    # remove objects that would break a unique constraint (other than the owner field) held by a different owner -
+    # the bulk equivalent of catching an IntegrityError for a single row
+    meta = model._meta
+    owner = meta.get_field(owner_field).attname
+    constraints = [(f.name,) for f in meta.local_concrete_fields if f.unique and not f.primary_key and
+                   f.name != owner_field]
+    constraints.extend([tuple(c) for c in meta.unique_together])
 
-        d = {k: v for k, v in d.items() if v not in disallowed_floats}
+    keep = []
+    taken = {}
 
-        if model != models.Reference and 'crystal_name' not in d.keys():
+    for constraint in constraints:
+        values = [getattr(obj, constraint[0]) for obj in objs if getattr(obj, constraint[0]) is not None]
+        if not values:
+            continue
+        existing = model.objects.filter(**{str(constraint[0] + '__in'): list(set(values))}).values_list(
+            *(list(constraint) + [owner]))
+        for row in existing:
+            taken[(constraint, tuple(row[:-1]))] = row[-1]
+
+    for obj in objs:
+        clash = False
+        for constraint in constraints:
+            value = tuple([getattr(obj, name) for name in constraint])
+            if None in value:
+                continue
+            holder = taken.get((constraint, value))
+            if holder is not None and holder != getattr(obj, owner):
+                print('WARNING: ' + str(model.__name__) + ' ' + str(constraint) + ' = ' + str(value) +
+                      ' already used - skipping')
+                clash = True
+        if clash:
             continue
+        for constraint in constraints:
+            value = tuple([getattr(obj, name) for name in constraint])
+            if None not in value:
+                taken[(constraint, value)] = getattr(obj, owner)
+        keep.append(obj)
+
+    return keep
+
 
-        if model == models.Crystal and 'target' not in d.keys():
+def create_shared_rows(filenames):
+    """
+    Create the target, compound and reference rows needed by a set of soakdb files up front, so that files can then be
+    transferred in parallel without two transfers trying to insert the same row.
+
+    Returns: the number of targets, compounds and references needed
+    """
+    crystal_dict = dict((v, k) for k, v in crystal_translations().items())
+    dimple_dict = dict((v, k) for k, v in dimple_translations().items())
+
+    targets = set()
+    compounds = set()
+    references = set()
+
+    for filename in filenames:
+        if check_table_sqlite(filename, 'mainTable') != 1:
             continue
+        for chunk in soakdb_rows(filename, columns=['CrystalName', 'CompoundSMILES', 'ProteinName',
+                                                    'DimpleReferencePDB']):
+            for row in chunk:
+                crystal = translate_row(row, crystal_dict)
+                targets.add(crystal.get('target'))
+                compounds.add(crystal.get('compound'))
+                references.add(translate_row(row, dimple_dict).get('reference'))
 
-        # check that file_id's can be written
-        for key in model_fields:
-            if key == 'visit' and model == models.Crystal:
-                try:
-                    d[key] = models.SoakdbFiles.objects.get(filename=filename)
-                except ObjectDoesNotExist:
-                    _, _, proposal = pop_soakdb(filename)
-                    pop_proposals(proposal)
-                    d[key] = models.SoakdbFiles.objects.get(filename=filename)
-
-        for key in d.keys():
-
-            # raise an exception if a rogue key is found - means translate_dict or model is wrong
-            if key not in model_fields:
-                raise Exception(str('KEY: ' + key + ' FROM MODELS not in ' + str(model_fields)))
-
-            # find relevant entries for foreign keys and set as value - crystal names and proteins
-
-            if key == 'crystal_name' and model != models.Crystal:
-                d[key] = models.Crystal.objects.get(crystal_name=d[key], visit=models.SoakdbFiles.objects.get(
-                    filename=filename), compound=models.Compounds.objects.get_or_create(smiles=compound_smiles)[0])
-
-            if key == 'target':
-                d[key] = models.Target.objects.get_or_create(target_name=d[key])[0]
-
-            if key == 'compound':
-                d[key] = models.Compounds.objects.get_or_create(smiles=d[key])[0]
-
-            if key == 'reference':
-                if d[key]:
-                    d[key] = models.Reference.objects.get_or_create(reference_pdb=d[key])[0]
-
-            if key == 'outcome':
-                pattern = re.compile('-?\d+')
-                value = pattern.findall(str(d[key]))
-                if len(value) > 1:
-                    raise Exception('multiple values found in outcome string')
-                try:
-                    d[key] = int(value[0])
-                except:
-                    continue
+    with transaction.atomic():
+        targets = bulk_get_or_create(models.Target, 'target_name', targets)
+        compounds = bulk_get_or_create(models.Compounds, 'smiles', compounds)
+        references = bulk_get_or_create(models.Reference, 'reference_pdb', references)
 
-            if key == 'lig_confidence_int':
-                if d[key]:
-                    d[key] = int(d[key].split('-')[0])
-                else:
-                    d[key] = -1
+    return len(targets), len(compounds), len(references)
 
-            if key == 'lig_confidence_string':
-                if d[key]:
-                    d[key] = d[key].split('-')[1]
-                else:
-                    d[key] = 'Unassigned'
 
-        # write out the row to the relevant model (table)
-        try:
-            with transaction.atomic():
-                m = model.objects.create(**d)
-                m.save()
-
-        except IntegrityError as e:
-            print(d)
-            print('WARNING: ' + str(e.__cause__))
-            print(model_fields)
-            crys_from_db = models.Crystal.objects.get(crystal_name=crystal_name, visit=models.SoakdbFiles.objects.get(
-                filename=filename), compound=models.Compounds.objects.get_or_create(smiles=compound_smiles)[0])
-            if crys_from_db.target == target:
-                print('Crystal duplicated!')
-                continue
-        # uncomment to debug
-        # except ValueError as e:
-        #     print(d)
-        #     print('WARNING: ' + str(e.__cause__))
-        #     print(e)
-        #     print(model_fields)
-        #     continue
+def soakdb_row_hash(row):
+    # content hash of a full soakdb row (includes LastUpdated), used to spot rows that have changed
+    return hashlib.sha1(repr(tuple(row)).encode('utf-8')).hexdigest()
 
 
-def soakdb_query(filename):
-    conn = sqlite3.connect(filename)
+def transfer_soakdb_file(filename, incremental=False, conn=None):
+    """
+    Transfer the mainTable of a soakdb file to the crystal, lab, refinement, dimple and data_processing tables.
+
+    The file is read once, every row is translated for all five tables in a single pass, foreign keys (target,
+    compound, reference, soakdb file) are resolved with one lookup per table, and each table is written with bulk
+    inserts/upserts inside one transaction. A content hash of every row is stored against its crystal.
+
+    If incremental is True, rows whose hash matches the one stored for the crystal (CrystalName, CompoundSMILES) are
+    skipped, and the ids of crystals that are no longer in the file are returned as 'stale' for the caller to remove.
+
+    The file is streamed in chunks, and only the columns used by the translations are read. If conn is given (from
+    soakdb_connection) it is used to read the file.
+
+    Returns: a dict of counts (rows read/skipped, rows inserted/updated per table, stale crystals) and timing info
+    """
+    start = time.time()
+
+    try:
+        soakdb_file = models.SoakdbFiles.objects.get(filename=filename)
+    except ObjectDoesNotExist:
+        _, _, proposal = pop_soakdb(filename)
+        pop_proposals(proposal)
+        soakdb_file = models.SoakdbFiles.objects.get(filename=filename)
+
+    translations = soakdb_translations()
+    # swap the keys over for lookup (once per table, rather than once per column of every row)
+    inverted = [(model, dict((v, k) for k, v in translate_dict.items())) for model, translate_dict in translations]
+
+    # get the fields that must exist in each model (i.e. table)
+    model_fields = dict((model, [f.name for f in model._meta.local_fields]) for model, _ in translations)
+
+    translated = []
+    # only the translated rows are kept, not the rows read from the file
+    for chunk in soakdb_rows(filename, columns=soakdb_columns([t for _, t in translations]), conn=conn):
+        for row in chunk:
+            d = dict((model, translate_row(row, inverted_dict)) for model, inverted_dict in inverted)
+            for model, _ in translations:
+                for key in d[model].keys():
+                    # raise an exception if a rogue key is found - means translate_dict or model is wrong
+                    if key not in model_fields[model]:
+                        raise Exception(str('KEY: ' + key + ' FROM MODELS not in ' + str(model_fields[model])))
+            d['hash'] = soakdb_row_hash(row)
+            if 'LastUpdated' in row.keys():
+                d['last_updated'] = row['LastUpdated']
+            else:
+                d['last_updated'] = None
+            translated.append(d)
+
+    stats = {'filename': filename, 'rows': len(translated), 'unchanged': 0, 'stale': []}
+
+    with transaction.atomic():
+        # crystals are unique on name, visit and compound
+        crystal_ids = {}
+        crystal_targets = {}
+        for crystal_id, crystal_name, smiles, target_id in models.Crystal.objects.filter(visit=soakdb_file).values_list(
+                'id', 'crystal_name', 'compound__smiles', 'target_id'):
+            crystal_ids[(crystal_name, smiles)] = crystal_id
+            crystal_targets[crystal_id] = target_id
+
+        if incremental:
+            file_keys = set([(d[models.Crystal].get('crystal_name'), d[models.Crystal].get('compound'))
+                             for d in translated])
+            stats['stale'] = [crystal_id for key, crystal_id in crystal_ids.items() if key not in file_keys]
+
+            stored_hashes = dict(((name, smiles), row_hash) for name, smiles, row_hash in
+                                 models.SoakdbRowHash.objects.filter(crystal__visit=soakdb_file).values_list(
+                                     'crystal__crystal_name', 'crystal__compound__smiles', 'row_hash'))
+            changed = [d for d in translated if stored_hashes.get(
+                (d[models.Crystal].get('crystal_name'), d[models.Crystal].get('compound'))) != d['hash']]
+            stats['unchanged'] = len(translated) - len(changed)
+            translated = changed
+
+        crystal_rows = [d[models.Crystal] for d in translated]
+        targets = bulk_get_or_create(models.Target, 'target_name', [c.get('target') for c in crystal_rows])
+        compounds = bulk_get_or_create(models.Compounds, 'smiles', [c.get('compound') for c in crystal_rows])
+        references = bulk_get_or_create(models.Reference, 'reference_pdb',
+                                        [d[models.Dimple].get('reference') for d in translated])
+
+        new_crystals = {}
+        retarget = {}
+        for c in crystal_rows:
+            if 'crystal_name' not in c.keys() or 'target' not in c.keys():
+                continue
+            key = (c['crystal_name'], c.get('compound'))
+            target = targets[c['target']]
+            if key in crystal_ids.keys():
+                if crystal_targets[crystal_ids[key]] != target.id:
+                    retarget.setdefault(target.id, []).append(crystal_ids[key])
+            elif key not in new_crystals.keys():
+                new_crystals[key] = models.Crystal(crystal_name=c['crystal_name'], target=target,
+                                                   compound=compounds.get(c.get('compound')), visit=soakdb_file)
+
+        models.Crystal.objects.bulk_create(list(new_crystals.values()))
+        for key, crystal in new_crystals.items():
+            crystal_ids[key] = crystal.id
+        for target_id, ids in retarget.items():
+            models.Crystal.objects.filter(id__in=ids).update(target_id=target_id)
+
+        stats['Crystal'] = (len(new_crystals), sum([len(ids) for ids in retarget.values()]))
+
+        # every other table hangs off the crystal
+        for model, _ in translations[1:]:
+            objs = []
+            seen = set()
+            for row, d in zip(crystal_rows, translated):
+                values = dict(d[model])
+                if 'crystal_name' not in values.keys():
+                    continue
+                crystal_id = crystal_ids.get((values.pop('crystal_name'), row.get('compound')))
+                if crystal_id is None or crystal_id in seen:
+                    continue
+                seen.add(crystal_id)
+                if 'reference' in values.keys():
+                    values['reference'] = references.get(values['reference'])
+                objs.append(model(crystal_name_id=crystal_id, **values))
+
+            objs = drop_unique_conflicts(model, objs)
+            stats[model.__name__] = bulk_upsert(model, objs, conflict_fields=['crystal_name'])
+
+        # snapshot the row hashes, so the next incremental transfer can skip rows that haven't changed
+        hashes = {}
+        for row, d in zip(crystal_rows, translated):
+            crystal_id = crystal_ids.get((row.get('crystal_name'), row.get('compound')))
+            if crystal_id is not None and crystal_id not in hashes.keys():
+                hashes[crystal_id] = models.SoakdbRowHash(crystal_id=crystal_id, row_hash=d['hash'],
+                                                          last_updated=d['last_updated'])
+        bulk_upsert(models.SoakdbRowHash, list(hashes.values()), conflict_fields=['crystal'])
+
+    metrics_functions.count('rows', stats['rows'])
+
+    stats['seconds'] = time.time() - start
+    if stats['seconds'] > 0:
+        stats['rows_per_second'] = stats['rows'] / stats['seconds']
+    else:
+        stats['rows_per_second'] = float(stats['rows'])
+
+    print(str('Transferred ' + str(stats['rows']) + ' rows (' + str(stats['unchanged']) + ' unchanged) from ' +
+              filename + ' in ' + str(round(stats['seconds'], 2)) + 's (' + str(round(stats['rows_per_second'], 1)) +
+              ' rows/s): ' + ', '.join([m.__name__ + ' ' + str(stats[m.__name__][0]) + ' new/' +
+                                        str(stats[m.__name__][1]) + ' updated' for m, _ in translations])))
+
+    return stats
+
+
+# rows without a crystal, compound or protein are skipped
+soakdb_where = str("CrystalName NOT LIKE ? and CrystalName NOT LIKE ? "
+                   "and CrystalName !='' and CrystalName IS NOT NULL "
+                   "and CompoundSMILES not like ? and CompoundSMILES NOT LIKE ? and CompoundSMILES IS NOT NULL  "
+                   "and CompoundSMILES !='' "
+                   "and ProteinName not like ? and ProteinName NOT LIKE ? and ProteinName not NULL and ProteinName !=''")
+soakdb_where_values = ('None', 'null', 'None', 'null', 'None', 'null')
+
+
+def soakdb_connection(filename, immutable=False):
+    """
+    Open a read-only connection to a soakdb file. immutable=True also tells sqlite the file can't change while it is
+    open (no locking or change detection), so should only be used for files nobody can be writing to.
+    """
+    uri = str('file:' + urllib.parse.quote(os.path.abspath(filename)) + '?mode=ro')
+    if immutable:
+        uri += '&immutable=1'
+    conn = sqlite3.connect(uri, uri=True)
     conn.row_factory = sqlite3.Row
-    c = conn.cursor()
+    return conn
 
-    c.execute(
-        "select distinct * from mainTable where CrystalName NOT LIKE ? and CrystalName NOT LIKE ? "
-        "and CrystalName !='' and CrystalName IS NOT NULL "
-        "and CompoundSMILES not like ? and CompoundSMILES NOT LIKE ? and CompoundSMILES IS NOT NULL  "
-        "and CompoundSMILES !='' "
-        "and ProteinName not like ? and ProteinName NOT LIKE ? and ProteinName not NULL and ProteinName !=''",
-        ('None', 'null', 'None', 'null', 'None', 'null'))
 
-    results = c.fetchall()
-    conn.close()
-    return results
+def soakdb_columns(translate_dicts):
+    # the mainTable columns needed by a set of translation dictionaries (plus the ones used to identify a crystal)
+    columns = ['CrystalName', 'CompoundSMILES', 'ProteinName', 'LastUpdated']
+    for translate_dict in translate_dicts:
+        columns.extend([column for column in translate_dict.values() if column not in columns])
+    return columns
 
 
-def check_table_sqlite(filename, tablename):
-    conn = sqlite3.connect(filename)
+def soakdb_rows(filename, columns=None, chunk_size=1000, conn=None, immutable=False):
+    """
+    Read the mainTable of a soakdb file, yielding lists of (at most chunk_size) rows, so that the whole table doesn't
+    have to be held in memory. If columns is given, only the columns in that list (that exist in the file) are read.
+    If conn is given (from soakdb_connection), it is used rather than opening the file again.
+    """
+    close = False
+    if conn is None:
+        conn = soakdb_connection(filename, immutable=immutable)
+        close = True
+
+    try:
+        if columns is None:
+            select = '*'
+        else:
+            # only ask for columns that are in this file - older soakdb files don't have all of them
+            existing = [row[1] for row in conn.execute("PRAGMA table_info('mainTable')")]
+            select = ', '.join([str('"' + column + '"') for column in columns if column in existing])
+
+        c = conn.cursor()
+        c.execute(str('select distinct ' + select + ' from mainTable where ' + soakdb_where), soakdb_where_values)
+
+        while True:
+            chunk = c.fetchmany(chunk_size)
+            if not chunk:
+                break
+            yield chunk
+    finally:
+        if close:
+            conn.close()
+
+
+def soakdb_query(filename, columns=None, conn=None):
+    # standard soakdb query for all data
+    return [row for chunk in soakdb_rows(filename, columns=columns, conn=conn) for row in chunk]
+
+
+def check_table_sqlite(filename, tablename, conn=None):
+    close = False
+    if conn is None:
+        conn = sqlite3.connect(filename)
+        close = True
     c = conn.cursor()
     c.execute("SELECT count(*) FROM sqlite_master WHERE type = 'table' AND name = ?", (tablename,))
     results = c.fetchall()[0][0]
-    conn.close()
+    if close:
+        conn.close()
 
     return results
 
 
-def pop_soakdb(database_file):
-    # get proposal number from dls path
-    print(database_file)
+def get_visit_proposal(database_file):
+    # get visit and proposal number from dls path
     try:
         visit = database_file.split('/')[5]
         proposal = visit.split('-')[0]
         # proposal_number = int(proposal[2:])
     except:
+        visit = ''
         proposal = 'lb13385'
         print('WARNING: USING DEFAULT PROPOSAL FOR TESTS')
+    return visit, proposal
+
+
+def pop_soakdb(database_file):
+    # get proposal number from dls path
+    print(database_file)
+    visit, proposal = get_visit_proposal(database_file)
     # get allowed users
-    proc = subprocess.Popen(str('getent group ' + str(proposal)), stdout=subprocess.PIPE, shell=True)
-    out, err = proc.communicate()
+    out = misc_functions.get_fedids(proposal)
+    err = None
     # get modification date of file
     modification_date = misc_functions.get_mod_date(database_file)
     # add info to soakdbfiles table
@@ -449,18 +837,20 @@ def pop_soakdb(database_file):
 
 
 def pop_proposals(proposal_number):
-    # get proposal number from shell
-    proc = subprocess.Popen(str('getent group ' + str(proposal_number)), stdout=subprocess.PIPE, shell=True)
-    out, err = proc.communicate()
-    # create list of fedids (or blank if none found)
-    if len(out.decode('ascii')) == 0:
-        append_list = ''
-    else:
-        append_list = out.decode('ascii').split(':')[3].replace('\n', '')
     # add proposal to proposals table with allowed fedids
-    proposal_entry = models.Proposals.objects.get_or_create(proposal=proposal_number, title=proposal_number[2:])[0]
-    proposal_entry.fedids = str(append_list)
-    proposal_entry.save()
+    update_proposal_fedids([proposal_number])
+
+
+def update_proposal_fedids(proposals):
+    """
+    Add proposals to the proposals table, and set the fedids allowed to see them from their unix groups. All of the
+    proposals are written in one statement, and existing rows are only touched if their fedids have changed.
+
+    Returns: (number of proposals added, number of proposals updated)
+    """
+    objs = [models.Proposals(proposal=proposal, title=proposal[2:], fedids=misc_functions.get_fedids(proposal))
+            for proposal in sorted(set(proposals))]
+    return bulk_upsert(models.Proposals, objs, conflict_fields=['proposal'], update_fields=['fedids'])
 
 
 def check_file_status(filename, bound_pdb):
@@ -472,7 +862,518 @@ def check_file_status(filename, bound_pdb):
     else:
         map_directory = str(bound_pdb).replace(pdb_file_name, '')
 
-    if os.path.isfile(str(map_directory + filename)):
+    if cache_functions.stat_cache.isfile(str(map_directory + filename)):
         return True, str(map_directory + filename)
     else:
         return False, ''
+
+
+# the ProasisHits fields that come from the files of a refinement
+hit_file_fields = ['pdb_file', 'modification_date', 'mtz', 'two_fofc', 'fofc', 'ligand_list']
+
+
+def hit_candidates():
+    """
+    Everything InitDBEntries needs from the database, in one query: refinements at outcome 4 or above, joined to
+    their crystal's dimple reference and any proasis hits already made from them.
+
+    Returns: list of dicts, one per refinement, with a 'hits' list of (unsaved) ProasisHits instances
+    """
+    rows = models.Refinement.objects.filter(outcome__gte=4).values_list(
+        'id', 'crystal_name_id', 'bound_conf', 'pdb_latest', 'crystal_name__dimple__reference__reference_pdb',
+        'proasishits__id', 'proasishits__crystal_name_id', 'proasishits__altconf', 'proasishits__strucid',
+        *['proasishits__' + f for f in hit_file_fields])
+
+    candidates = {}
+    for row in rows:
+        candidate = candidates.setdefault(row[0], {'refinement_id': row[0], 'crystal_id': row[1],
+                                                   'bound_conf': row[2], 'pdb_latest': row[3],
+                                                   'reference_pdb': row[4], 'hits': []})
+        # hits are for the refinement and its crystal
+        if row[5] is not None and row[6] == row[1]:
+            candidate['hits'].append(models.ProasisHits(
+                id=row[5], refinement_id=row[0], crystal_name_id=row[1], altconf=row[7], strucid=row[8],
+                **dict(zip(hit_file_fields, row[9:]))))
+
+    return list(candidates.values())
+
+
+def find_bound_conf(bound_conf, pdb_latest):
+    """
+    The pdb file to upload to proasis for a refinement: bound_conf if it is set, otherwise the bound state split from
+    pdb_latest by refinement (or pdb_latest itself if it is not from a refinement folder).
+
+    Returns: the file, '' if it can't be found, or None if the refinement has no pdb file at all
+    """
+    if bound_conf:
+        if cache_functions.stat_cache.isfile(bound_conf):
+            return bound_conf
+        return ''
+    if pdb_latest:
+        if not cache_functions.stat_cache.isfile(pdb_latest):
+            return ''
+        if 'Refine' in pdb_latest:
+            files = glob.glob(str(os.path.dirname(pdb_latest) + '/refine*split.bound*.pdb'))
+            if len(files) == 1:
+                return files[0]
+            return ''
+        return pdb_latest
+    return None
+
+
+def probe_hit(candidate):
+    """
+    The file checks for one candidate from hit_candidates: find the pdb file and its maps, and read the ligands from
+    the pdb file. Only reads files, so can be run in threads.
+
+    Returns: the candidate with 'status' set to one of 'no_pdb', 'missing_files', 'no_ligands' or 'ok', and for 'ok',
+    the ProasisHits file fields and the altconfs to make hits for
+    """
+    bound_conf = find_bound_conf(candidate['bound_conf'], candidate['pdb_latest'])
+    if bound_conf is None:
+        candidate['status'] = 'no_pdb'
+        return candidate
+
+    mtz = check_file_status('refine.mtz', bound_conf)
+    two_fofc = check_file_status('2fofc.map', bound_conf)
+    fofc = check_file_status('fofc.map', bound_conf)
+
+    if not mtz[0] or not two_fofc[0] or not fofc[0]:
+        candidate['status'] = 'missing_files'
+        return candidate
+
+    ligands, altconfs = pdb_functions.bound_ligands(bound_conf)
+    if not ligands:
+        candidate['status'] = 'no_ligands'
+        return candidate
+
+    candidate['status'] = 'ok'
+    candidate['altconfs'] = altconfs or [None]
+    candidate['fields'] = {'pdb_file': bound_conf, 'modification_date': misc_functions.get_mod_date(bound_conf),
+                           'mtz': mtz[1], 'two_fofc': two_fofc[1], 'fofc': fofc[1], 'ligand_list': str(ligands)}
+    if candidate['reference_pdb']:
+        candidate['reference_exists'] = cache_functions.stat_cache.isfile(candidate['reference_pdb'])
+
+    return candidate
+
+
+def probe_hits(candidates, workers=16):
+    # probe_hit for every candidate, in a pool of threads (the checks are all waiting on the filesystem)
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        return list(executor.map(probe_hit, candidates))
+
+
+def hit_changes(probed):
+    """
+    Work out what needs to change in proasis_hits for a set of probed candidates (see probe_hit). A hit is made for
+    each altconf of a refinement's ligands (or one with no altconf). Existing hits are updated if the pdb file is
+    newer than the one they were made from, or if they haven't been uploaded to proasis and their files have changed.
+    Hits for altconfs that are no longer in the pdb file are deleted. Candidates that fail a file check are left
+    alone.
+
+    Returns: dict of lists of ProasisHits to create, (ProasisHits, new fields) to update, and ProasisHits to delete
+    (those to update or delete that have a strucid need removing from proasis first), and the number unchanged
+    """
+    changes = {'create': [], 'update': [], 'delete': [], 'unchanged': 0}
+
+    for candidate in probed:
+        if candidate['status'] != 'ok':
+            continue
+        fields = candidate['fields']
+        existing = dict((hit.altconf, hit) for hit in candidate['hits'])
+
+        for altconf in candidate['altconfs']:
+            hit = existing.pop(altconf, None)
+            if hit is None:
+                changes['create'].append(models.ProasisHits(refinement_id=candidate['refinement_id'],
+                                                            crystal_name_id=candidate['crystal_id'],
+                                                            altconf=altconf, **fields))
+                continue
+
+            changed = [f for f in hit_file_fields if getattr(hit, f) != fields[f]]
+            if (hit.modification_date or '') < fields['modification_date'] or (not hit.strucid and changed):
+                changes['update'].append((hit, fields))
+            else:
+                changes['unchanged'] += 1
+
+        changes['delete'].extend(existing.values())
+
+    return changes
+
+
+def bulk_update_rows(model, objs, update_fields, batch_size=500):
+    # UPDATE ... FROM (VALUES ...) on the primary key, one statement per batch (postgres only)
+    if not objs:
+        return 0
+
+    meta = model._meta
+    fields = [meta.get_field(name) for name in update_fields]
+    qn = connection.ops.quote_name
+    table = qn(meta.db_table)
+    pk = qn(meta.pk.column)
+
+    sql = str('UPDATE ' + table + ' SET ' +
+              ', '.join([qn(f.column) + ' = v.' + qn(f.column) + '::' + f.db_type(connection) for f in fields]) +
+              ' FROM (VALUES %s) AS v (' + ', '.join([pk] + [qn(f.column) for f in fields]) + ') WHERE ' +
+              table + '.' + pk + ' = v.' + pk)
+    row_placeholder = '(' + ', '.join(['%s'] * (len(fields) + 1)) + ')'
+
+    updated = 0
+    with connection.cursor() as c:
+        for i in range(0, len(objs), batch_size):
+            batch = objs[i:i + batch_size]
+            params = []
+            for obj in batch:
+                params.append(obj.pk)
+                params.extend([f.get_db_prep_save(getattr(obj, f.attname), connection) for f in fields])
+            c.execute(sql % ', '.join([row_placeholder] * len(batch)), params)
+            updated += c.rowcount
+
+    return updated
+
+
+def apply_hit_changes(changes):
+    # write the changes from hit_changes (after any structures have been removed from proasis)
+    for hit, fields in changes['update']:
+        for f in hit_file_fields:
+            setattr(hit, f, fields[f])
+
+    with transaction.atomic():
+        models.ProasisHits.objects.bulk_create(changes['create'])
+        bulk_update_rows(models.ProasisHits, [hit for hit, _ in changes['update']], hit_file_fields + ['strucid'])
+        models.ProasisHits.objects.filter(id__in=[hit.id for hit in changes['delete']]).delete()
+
+
+def reconcile_leads(probed):
+    """
+    Add a proasis lead for the dimple reference of each hit whose reference pdb exists, and remove the leads for
+    references whose pdb has gone.
+
+    Returns: (number of leads added, number removed)
+    """
+    present = set()
+    missing = set()
+    for candidate in probed:
+        if candidate['status'] == 'ok' and candidate['reference_pdb']:
+            if candidate['reference_exists']:
+                present.add(candidate['reference_pdb'])
+            else:
+                missing.add(candidate['reference_pdb'])
+
+    existing = set(models.ProasisLeads.objects.filter(reference_pdb_id__in=present | missing).values_list(
+        'reference_pdb_id', flat=True))
+
+    with transaction.atomic():
+        models.ProasisLeads.objects.bulk_create([models.ProasisLeads(reference_pdb_id=reference)
+                                                 for reference in sorted(present - existing)])
+        models.ProasisLeads.objects.filter(reference_pdb_id__in=missing & existing).delete()
+
+    return len(present - existing), len(missing & existing)
+
+
+def pandda_fingerprint(log_file):
+    return models.PanddaRunFingerprint.objects.filter(pandda_run__pandda_log=log_file).first()
+
+
+def pandda_sites_changed(log_file, sites_file):
+    # whether a run's sites need loading (never loaded, or the sites csv has changed since)
+    fingerprint = pandda_fingerprint(log_file)
+    return fingerprint is None or not pandda_functions.fingerprint_matches(sites_file, fingerprint.sites_fingerprint)
+
+
+def soakdb_transfer_marker(sdbfile):
+    # what has been transferred from a soakdb file: its modification date and status in soakdb_files (the date of the
+    # last transfer once the status is 2) and its number of crystals. This changes when the file is transferred, not
+    # when the file itself changes, so events waiting for their crystals are retried once the crystals are there
+    soakdb = models.SoakdbFiles.objects.filter(filename=sdbfile).values_list('modification_date', 'status').first()
+    crystals = models.Crystal.objects.filter(visit__filename=sdbfile).count()
+    return ':'.join([str(value) for value in list(soakdb or (None, None)) + [crystals]])
+
+
+def pandda_events_changed(log_file, events_file, sdbfile):
+    """
+    Whether a run's events need loading: they have never been loaded, the events csv has changed since, or some
+    events had no crystal to go to last time and the soakdb file has been transferred since.
+    """
+    fingerprint = pandda_fingerprint(log_file)
+    if fingerprint is None or not pandda_functions.fingerprint_matches(events_file, fingerprint.events_fingerprint):
+        return True
+    if not fingerprint.events_complete:
+        return fingerprint.soakdb_transfer != soakdb_transfer_marker(sdbfile)
+    return False
+
+
+def record_pandda_fingerprint(log_file, **fields):
+    # store sites_fingerprint, events_fingerprint, soakdb_transfer or events_complete for a run once it is loaded
+    run = models.PanddaRun.objects.get(pandda_log=log_file)
+    models.PanddaRunFingerprint.objects.update_or_create(pandda_run=run, defaults=fields)
+
+
+def invalidate_pandda_events(crystals):
+    # runs with events for crystals that are about to be removed are missing events once they have gone
+    return models.PanddaRunFingerprint.objects.filter(
+        pandda_run__panddaevent__crystal__in=crystals).update(events_complete=False)
+
+
+def add_pandda_run(log_file, pver, input_dir, output_dir, sites_file, events_file):
+    pandda_run = models.PanddaRun.objects.get_or_create(
+        pandda_log=log_file, input_dir=input_dir,
+        pandda_analysis=models.PanddaAnalysis.objects.get_or_create(pandda_dir=output_dir)[0],
+        pandda_version=pver, sites_file=sites_file, events_file=events_file)[0]
+    pandda_run.save()
+
+    return pandda_run
+
+
+def add_pandda_sites(log_file, sites_file, sites_frame=None):
+    """
+    Add the sites from a pandda run's sites csv to pandda_site, with one upsert on (pandda_run, site). Sites whose
+    centroids haven't changed are left alone. sites_frame is the csv as read by pandda_functions.read_sites, if it
+    has already been read.
+
+    Returns: a dict of counts (sites in file, sites inserted/updated)
+    """
+    run = models.PanddaRun.objects.get(pandda_log=log_file)
+    if sites_frame is None:
+        sites_frame = pandda_functions.read_sites(sites_file)
+    sites_frame = sites_frame.astype(object).where(sites_frame.notnull(), None)
+
+    sites = [models.PanddaSite(pandda_run=run, **row) for row in sites_frame.to_dict('records')]
+
+    counts = {'sites': len(sites)}
+    counts['inserted'], counts['updated'] = bulk_upsert(models.PanddaSite, sites, ['pandda_run', 'site'])
+
+    print(str('Sites from ' + sites_file + ': ' + ', '.join([str(key + '=' + str(counts[key]))
+                                                              for key in sorted(counts.keys())])))
+
+    return counts
+
+
+def add_pandda_events(log_file, events_file, sdbfile, error_file, events_frame=None, event_info=None):
+    """
+    Add the events from a pandda run's events csv to pandda_event and pandda_event_stats. The csv is read once, the
+    run, sites, crystals, refinements and data processing rows are looked up with one query per table, and events and
+    their stats are written in bulk. Fields set by annotation (ligand confidence, comments etc.) are left alone for
+    events that already exist.
+
+    The csv (events_frame) and the files and ligands for each event (event_info, from
+    pandda_functions.events_file_info) can be passed in if they have already been worked out, e.g. by a worker process.
+
+    Events whose files can't be found are written to error_file, as before.
+
+    Returns: a dict of counts (events in file, events inserted/updated, stats written, events skipped)
+    """
+    run = models.PanddaRun.objects.select_related('pandda_analysis').get(pandda_log=log_file)
+    if events_frame is None:
+        events_frame = pandda_functions.read_events(events_file)
+    stats_frame = pandda_functions.event_stats_frame(events_frame)
+
+    metrics_functions.count('events', len(events_frame))
+
+    counts = {'events': len(events_frame), 'skipped': 0}
+
+    with transaction.atomic():
+        site_numbers = set([int(site) for site in events_frame['site_idx']])
+        sites = dict((site.site, site) for site in models.PanddaSite.objects.filter(pandda_run=run,
+                                                                                    site__in=site_numbers))
+        missing_sites = [models.PanddaSite(pandda_run=run, site=site) for site in site_numbers
+                         if site not in sites.keys()]
+        if missing_sites:
+            models.PanddaSite.objects.bulk_create(missing_sites)
+            sites.update(dict((site.site, site) for site in models.PanddaSite.objects.filter(
+                pandda_run=run, site__in=[s.site for s in missing_sites])))
+
+        # crystals are unique on name, visit and compound, so the same name can come up more than once for the run's
+        # soakdb file. An event can't be assigned to one of those, so they are skipped
+        crystals = {}
+        ambiguous = set()
+        for crystal in models.Crystal.objects.filter(visit__filename=sdbfile,
+                                                     crystal_name__in=set(events_frame['dtag'])).order_by('id'):
+            if crystal.crystal_name in crystals.keys():
+                ambiguous.add(crystal.crystal_name)
+            crystals[crystal.crystal_name] = crystal
+        for crystal_name in sorted(ambiguous):
+            print(str('WARNING: ' + str(crystal_name) + ' is in ' + str(sdbfile) + ' more than once (with different '
+                      'compounds), so its events are skipped'))
+            crystals.pop(crystal_name)
+
+        # every event needs a refinement and data processing row for its crystal, even if they are empty
+        related = {}
+        for model in [models.Refinement, models.DataProcessing]:
+            related[model] = dict(model.objects.filter(crystal_name__in=crystals.values()).values_list(
+                'crystal_name_id', 'id'))
+            missing = [model(crystal_name=crystal) for crystal in crystals.values()
+                       if crystal.id not in related[model].keys()]
+            if missing:
+                model.objects.bulk_create(missing)
+                related[model] = dict(model.objects.filter(crystal_name__in=crystals.values()).values_list(
+                    'crystal_name_id', 'id'))
+
+        if event_info is None:
+            native_centroids = dict((number, (site.site_native_centroid_x, site.site_native_centroid_y,
+                                              site.site_native_centroid_z)) for number, site in sites.items())
+            event_info = pandda_functions.events_file_info(events_frame, native_centroids, input_dir=run.input_dir,
+                                                           output_dir=run.pandda_analysis.pandda_dir)
+
+        events = []
+        event_stats = {}
+
+        # event_info and stats_frame are in the same order as the csv, whatever its index
+        for position, (_, row) in enumerate(events_frame.iterrows()):
+            site = sites[int(row['site_idx'])]
+
+            fields, expected, exists_array, error = event_info[position]
+            if error:
+                print(error)
+                counts['skipped'] += 1
+                continue
+
+            if fields is None:
+                counts['skipped'] += 1
+                with open(error_file, 'a') as f:
+                    f.write('CRYSTAL: ' + str(row['dtag']) + ' SITE: ' + str(row['site_idx']) +
+                            ' EVENT: ' + str(row['event_idx']) + '\n')
+                    print('FILES NOT FOUND FOR EVENT: ' + str(row['event_idx']))
+                    f.write('FILES NOT FOUND FOR EVENT: ' + str(row['event_idx']) + '\n')
+                    print('EXPECTED: ')
+                    f.write('EXPECTED: ' + '\n')
+                    print(str(expected))
+                    f.write(str(expected) + '\n')
+                    print(exists_array)
+                    f.write(str(exists_array) + '\n')
+                    f.write('\n\n')
+                continue
+
+            crystal = crystals.get(row['dtag'])
+            if crystal is None:
+                if row['dtag'] not in ambiguous:
+                    print(str('No crystal ' + str(row['dtag']) + ' in ' + str(sdbfile) + ' for event ' +
+                              str(row['event_idx'])))
+                counts['skipped'] += 1
+                continue
+
+            events.append(models.PanddaEvent(crystal=crystal, site=site, pandda_run=run,
+                                             refinement_id=related[models.Refinement][crystal.id],
+                                             data_proc_id=related[models.DataProcessing][crystal.id],
+                                             interesting=False, **fields))
+            event_stats[(site.id, fields['event'], crystal.id)] = stats_frame.iloc[position].to_dict()
+
+        counts['inserted'], counts['updated'] = bulk_upsert(
+            models.PanddaEvent, events, conflict_fields=['site', 'event', 'crystal', 'pandda_run'],
+            update_fields=['refinement', 'data_proc', 'event_centroid_x', 'event_centroid_y', 'event_centroid_z',
+                           'event_dist_from_site_centroid', 'lig_centroid_x', 'lig_centroid_y', 'lig_centroid_z',
+                           'lig_dist_event', 'lig_id', 'pandda_event_map_native', 'pandda_model_pdb',
+                           'pandda_input_pdb', 'pandda_input_mtz', 'modified_date'])
+
+        event_ids = dict(((site_id, event, crystal_id), event_id) for event_id, site_id, event, crystal_id in
+                         models.PanddaEvent.objects.filter(pandda_run=run).values_list('id', 'site_id', 'event',
+                                                                                       'crystal_id'))
+
+        # stats are only rewritten for events where they have changed
+        stats_fields = list(stats_frame.columns)
+        existing = {}
+        for values in models.PanddaEventStats.objects.filter(event__pandda_run=run).values('id', 'event_id',
+                                                                                              *stats_fields):
+            existing.setdefault(values.pop('event_id'), []).append(values)
+
+        to_delete = []
+        to_create = []
+        for key, values in event_stats.items():
+            event_id = event_ids[key]
+            old = existing.get(event_id, [])
+            if len(old) == 1 and dict((k, v) for k, v in old[0].items() if k != 'id') == values:
+                continue
+            to_delete.extend([o['id'] for o in old])
+            to_create.append(models.PanddaEventStats(event_id=event_id, **values))
+
+        models.PanddaEventStats.objects.filter(id__in=to_delete).delete()
+        models.PanddaEventStats.objects.bulk_create(to_create)
+        counts['stats'] = len(to_create)
+
+        models.Crystal.objects.filter(id__in=set([event.crystal_id for event in events])).update(
+            status=models.Crystal.PANDDA)
+
+    print(str('Events from ' + events_file + ': ' + ', '.join([str(key + '=' + str(counts[key]))
+                                                                for key in sorted(counts.keys())])))
+
+    return counts
+
+
+def pandda_annotations(filename, conn=None):
+    """
+    Read the event confidences from a soakdb file's panddaTable in one query.
+
+    Returns: a dict of (crystal name, site index, event index) -> (site confidence, inspect confidence), and a set of
+    the keys that appear more than once
+    """
+    close = False
+    if conn is None:
+        conn = soakdb_connection(filename)
+        close = True
+
+    annotations = {}
+    duplicates = set()
+
+    c = conn.cursor()
+    c.execute("select CrystalName, PANDDA_site_index, PANDDA_site_event_index, PANDDA_site_confidence, "
+              "PANDDA_site_InspectConfidence from panddaTable")
+    for row in c:
+        try:
+            key = (row[0], int(row[1]), int(row[2]))
+        except (TypeError, ValueError):
+            continue
+        if key in annotations.keys():
+            duplicates.add(key)
+        annotations[key] = (row[3], row[4])
+
+    if close:
+        conn.close()
+
+    return annotations, duplicates
+
+
+def annotate_events(filename):
+    """
+    Copy the ligand confidences for a soakdb file's events from its panddaTable to pandda_event. Only events whose
+    confidence (or confidence source) has changed are written, so modified_date is only bumped for those.
+
+    Returns: a dict of counts (events, events matched in panddaTable, events updated)
+    """
+    annotations, duplicates = pandda_annotations(filename)
+
+    events = models.PanddaEvent.objects.filter(crystal__visit__filename=filename).select_related('crystal', 'site')
+
+    text = models.PanddaEvent._meta.get_field('ligand_confidence')
+
+    counts = {'events': 0, 'matched': 0}
+    changed = []
+    # auto_now isn't applied by bulk_update_rows
+    now = timezone.now()
+
+    for event in events:
+        counts['events'] += 1
+        key = (event.crystal.crystal_name, event.site.site, event.event)
+        if key not in annotations.keys():
+            continue
+        if key in duplicates:
+            raise Exception('too many events found in soakdb!')
+        counts['matched'] += 1
+
+        confidence, inspect_confidence = [text.to_python(value) for value in annotations[key]]
+
+        if (event.ligand_confidence, event.ligand_confidence_inspect, event.ligand_confidence_source) != \
+                (confidence, inspect_confidence, models.PanddaEvent.SOAKDB):
+            event.ligand_confidence = confidence
+            event.ligand_confidence_inspect = inspect_confidence
+            event.ligand_confidence_source = models.PanddaEvent.SOAKDB
+            event.modified_date = now
+            changed.append(event)
+
+    counts['updated'] = bulk_update_rows(models.PanddaEvent, changed, ['ligand_confidence',
+                                                                       'ligand_confidence_inspect',
+                                                                       'ligand_confidence_source', 'modified_date'])
+
+    print(str('Event annotations from ' + filename + ': ' + ', '.join([str(key + '=' + str(counts[key]))
+                                                                       for key in sorted(counts.keys())])))
+
+    return counts
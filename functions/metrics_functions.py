@@ -0,0 +1,125 @@
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+
+import pandas as pd
+
+
+# counts of things processed by this process (rows, files, events...), and of database queries sent. Tasks add to
+# these with count(), and the luigi event hooks record how much they went up while each task ran
+counters = {'queries': 0}
+# tasks count from worker threads too, and += on a dict entry isn't atomic
+counters_lock = threading.Lock()
+
+# task_id -> what was recorded when the task started
+running = {}
+
+
+def count(kind, number=1):
+    # record that number items of kind (e.g. 'rows', 'files', 'events') have been processed
+    with counters_lock:
+        counters[kind] = counters.get(kind, 0) + number
+
+
+def count_query(execute, sql, params, many, context):
+    # django execute wrapper (connection.execute_wrappers) counting queries
+    count('queries')
+    return execute(sql, params, many, context)
+
+
+def install_query_counter(sender, connection, **kwargs):
+    # connection_created handler: django opens a connection per thread, so each one needs the wrapper added
+    if count_query not in connection.execute_wrappers:
+        connection.execute_wrappers.append(count_query)
+
+
+def count_queries():
+    """
+    Count the queries sent on every database connection this process opens, in any thread, from now on (and on the
+    connection of the calling thread if it is already open).
+    """
+    # imported here so the functions that only count items don't need django set up
+    from django.db import connection
+    from django.db.backends.signals import connection_created
+
+    connection_created.connect(install_query_counter, dispatch_uid='metrics_functions.install_query_counter')
+    if connection.connection is not None:
+        install_query_counter(None, connection)
+
+
+def task_started(task):
+    running[task.task_id] = {'start': time.time(), 'counters': dict(counters)}
+
+
+def task_processing_time(task, processing_time):
+    if task.task_id in running.keys():
+        running[task.task_id]['processing_seconds'] = processing_time
+
+
+def task_finished(task, status, metrics_file, run_id):
+    """
+    Append a record of a finished task (wall time, processing time, query count, items processed) to metrics_file, a
+    JSONL file with one record per task.
+    """
+    started = running.pop(task.task_id, None)
+    if started is None:
+        return
+
+    record = OrderedDict([
+        ('run', run_id),
+        ('task_family', task.task_family),
+        ('task_id', task.task_id),
+        ('status', status),
+        ('start', time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(started['start']))),
+        ('wall_seconds', round(time.time() - started['start'], 3)),
+        ('processing_seconds', round(started.get('processing_seconds', 0), 3)),
+    ])
+    for kind in sorted(counters.keys()):
+        record[kind] = counters[kind] - started['counters'].get(kind, 0)
+
+    if not os.path.isdir(os.path.dirname(metrics_file)):
+        os.makedirs(os.path.dirname(metrics_file))
+
+    with open(metrics_file, 'a') as f:
+        f.write(str(json.dumps(record) + '\n'))
+
+
+def read_metrics(metrics_file):
+    with open(metrics_file, 'r') as f:
+        records = [json.loads(line) for line in f if line.strip()]
+    return pd.DataFrame(records)
+
+
+def summarise_metrics(metrics_file, last_runs=10, top=10):
+    """
+    Print the slowest task families of the latest run, and the total time taken by each task family over the last
+    last_runs runs.
+
+    Returns: the per-run totals for each task family as a DataFrame (runs as rows, task families as columns)
+    """
+    frame = read_metrics(metrics_file)
+    if frame.empty:
+        print('No metrics recorded in ' + metrics_file)
+        return frame
+
+    numbers = [column for column in frame.columns if column not in ['run', 'task_family', 'task_id', 'status', 'start']]
+    frame['tasks'] = 1
+    frame['failed'] = (frame['status'] != 'SUCCESS').astype(int)
+
+    runs = list(OrderedDict.fromkeys(frame['run']))[-last_runs:]
+    frame = frame[frame['run'].isin(runs)]
+
+    totals = frame.groupby(['run', 'task_family'])[numbers + ['tasks', 'failed']].sum()
+
+    latest = totals.loc[runs[-1]].sort_values('wall_seconds', ascending=False).head(top)
+    print(str('Slowest task families in run ' + str(runs[-1]) + ':'))
+    print(latest.to_string())
+
+    trend = totals['wall_seconds'].unstack('task_family').reindex(runs)
+    trend = trend[list(trend.max().sort_values(ascending=False).index[:top])]
+    print(str('\nWall seconds per run (last ' + str(len(runs)) + ' runs):'))
+    print(trend.to_string())
+
+    return trend
@@ -1,4 +1,5 @@
 import datetime
+import grp
 import os
 import re
 import sys
@@ -8,6 +9,11 @@ from rdkit import Chem
 from rdkit.Chem import AllChem
 import openbabel
 import subprocess
+import time
+
+# unix group (proposal) -> comma separated fedids, read from the group database at most once per GROUP_CACHE_TTL
+GROUP_CACHE_TTL = 3600
+group_cache = {'time': 0, 'members': {}}
 
 
 def get_id_string(out):
@@ -25,6 +31,30 @@ def get_id_string(out):
     return strucidstr
 
 
+def get_group_members(refresh=False):
+    """
+    Enumerate the unix groups once, and keep them for GROUP_CACHE_TTL seconds (replaces getent group <proposal>)
+    """
+    if refresh or time.time() - group_cache['time'] > GROUP_CACHE_TTL:
+        group_cache['members'] = dict((group.gr_name, ','.join(group.gr_mem)) for group in grp.getgrall())
+        group_cache['time'] = time.time()
+    return group_cache['members']
+
+
+def get_fedids(proposal):
+    """
+    Get the fedids of the members of a proposal's unix group, as a comma separated string (blank if none found)
+    """
+    members = get_group_members()
+    if proposal not in members:
+        # groups from a directory service aren't always enumerated by getgrall, so look up the ones that are missing
+        try:
+            members[proposal] = ','.join(grp.getgrnam(proposal).gr_mem)
+        except KeyError:
+            members[proposal] = ''
+    return members[proposal]
+
+
 def get_mod_date(filename):
     try:
         modification_date = datetime.datetime.fromtimestamp(os.path.getmtime(filename)).strftime("%Y%m%d%H%M%S")
@@ -1,37 +1,41 @@
+import hashlib
 import os
 import re
-import subprocess
+import traceback
 
 import numpy as np
 import pandas as pd
-from rdkit import Chem
-from rdkit.Chem import rdMolTransforms
 
+from functions import cache_functions
+from functions import crawl_functions
+from functions import csv_functions
+from functions import metrics_functions
+from functions import pdb_functions
 
-def find_log_files(path):
-    command = ' '.join(['find',
-                        path,
-                        '-maxdepth 10 -path "*/lab36/*" -prune -o',
-                        '-path "*/initial_model/*" -prune -o',
-                        '-path "*/beamline/*" -prune -o',
-                        '-path "*ackup*" -prune -o',
-                        '-path "*old*" -prune -o',
-                        '-path "*TeXRank*" -prune -o',
-                        '-name "pandda-*.log"',
-                        '-print'])
-
-    process = subprocess.Popen(command, shell=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
 
-    out, err = process.communicate()
+def find_log_files(path):
+    found, stats = crawl_functions.crawl([path], searches=('pandda_log',))
 
-    files_list = out.decode('ascii')
+    files_list = ''.join([str(log + '\n') for log in found['pandda_log']])
 
     print(files_list)
 
     return files_list
 
 
-def get_files_from_log(log):
+# bytes of pandda logs read by parse_log (cache hits read nothing)
+log_parse_stats = {'bytes_parsed': 0}
+
+
+def parse_log(log, tail_size=65536):
+    """
+    Read the run information from a pandda log in one pass, stopping as soon as everything has been found. The header
+    (version, data_dirs, out_dir) is at the top of the log, and the sites and events files are listed once the
+    analysis is done, but whether pandda exited with an error is only written at the end, so the last tail_size bytes
+    are checked for that separately.
+
+    Returns: pver, input_dir, output_dir, sites_file, events_file, error
+    """
     pver = ''
     input_dir = ''
     output_dir = ''
@@ -39,37 +43,89 @@ def get_files_from_log(log):
     events_file = ''
     error = False
 
-    for line in open(log, 'r'):
-        # get pandda version from log file
-        if 'Pandda Version' in line:
-            pver = str(line.split()[-1])
-        # get input directory from log file
-        if 'data_dirs' in line:
-            input_dir = re.sub('\s+', '', line.split('=')[-1]).replace('"', '')
-        # get output dir from log file
-        if 'out_dir' in line:
-            output_dir = re.sub('\s+', '', line.split('=')[-1]).replace('"', '')
-        # get sites file from log file
-        if 'pandda_analyse_sites.csv' in line:
-            to_check = re.sub('\s+', '', line)
-            if os.path.isfile(to_check):
-                sites_file = to_check
-        # get events file from log file
-        if 'pandda_analyse_events.csv' in line:
-            to_check = re.sub('\s+', '', line)
-            if os.path.isfile(to_check):
-                events_file = to_check
-        # check if pandda ran successfully
-        if 'exited with an error' in line:
+    size = os.path.getsize(log)
+    bytes_read = 0
+
+    with open(log, 'r') as f:
+        for line in f:
+            bytes_read += len(line)
+            # get pandda version from log file
+            if 'Pandda Version' in line:
+                pver = str(line.split()[-1])
+            # get input directory from log file
+            if 'data_dirs' in line:
+                input_dir = re.sub('\s+', '', line.split('=')[-1]).replace('"', '')
+            # get output dir from log file
+            if 'out_dir' in line:
+                output_dir = re.sub('\s+', '', line.split('=')[-1]).replace('"', '')
+            # get sites file from log file
+            if not sites_file and 'pandda_analyse_sites.csv' in line:
+                to_check = re.sub('\s+', '', line)
+                if os.path.isfile(to_check):
+                    sites_file = to_check
+            # get events file from log file
+            if not events_file and 'pandda_analyse_events.csv' in line:
+                to_check = re.sub('\s+', '', line)
+                if os.path.isfile(to_check):
+                    events_file = to_check
+            # check if pandda ran successfully
+            if 'exited with an error' in line:
+                error = True
+            if pver and input_dir and output_dir and sites_file and events_file:
+                break
+
+    # the rest of the log is only needed for the error flag
+    if bytes_read < size and not error:
+        with open(log, 'rb') as f:
+            f.seek(max(size - tail_size, 0))
+            tail = f.read().decode('utf-8', 'ignore')
+        bytes_read += len(tail)
+        if 'exited with an error' in tail:
             error = True
 
+    log_parse_stats['bytes_parsed'] += bytes_read
+    metrics_functions.count('bytes_parsed', bytes_read)
+
     return pver, input_dir, output_dir, sites_file, events_file, error
 
 
+def get_files_from_log(log, cache=None):
+    # cache is a cache_functions.FileCache - pandda logs don't change once the run is finished, so only read them once
+    if cache is None:
+        return parse_log(log)
+    return tuple(cache.get_or_compute(log, parse_log))
+
+
+def file_fingerprint(path):
+    # size:mtime:sha1 of a file, to tell whether a pandda csv has changed since it was last loaded
+    stat = os.stat(path)
+    sha1 = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1048576), b''):
+            sha1.update(block)
+    return str(str(stat.st_size) + ':' + str(stat.st_mtime_ns) + ':' + sha1.hexdigest())
+
+
+def fingerprint_matches(path, fingerprint):
+    """
+    Whether a file still matches a fingerprint from file_fingerprint. The file is only hashed if its size is the same
+    but its mtime has changed (e.g. it has been copied, or rewritten with the same contents).
+    """
+    if not fingerprint or not os.path.isfile(path):
+        return False
+    size, mtime, sha1 = fingerprint.split(':')
+    stat = os.stat(path)
+    if str(stat.st_size) != size:
+        return False
+    if str(stat.st_mtime_ns) == mtime:
+        return True
+    return file_fingerprint(path).split(':')[2] == sha1
+
+
 def get_sites_from_events(events_file):
     print(events_file)
     # read events file as dataframe
-    events_frame = pd.read_csv(events_file)
+    events_frame = read_events(events_file)
 
     # holders for crystal, event and site
     crystals = []
@@ -87,6 +143,49 @@ def get_sites_from_events(events_file):
     return crystals, events, sites, bdc
 
 
+# a tuple (or list) of three numbers
+CENTROID_PATTERN = r'^[\(\[]\s*([-+0-9.eE]+)\s*,\s*([-+0-9.eE]+)\s*,\s*([-+0-9.eE]+)\s*,?\s*[\)\]]$'
+
+
+def parse_centroids(column):
+    """
+    Parse a column of centroid strings as written by pandda, e.g. '(52.9094, 20.3376, 74.1414)', without eval.
+    Empty values give a row of NaN.
+
+    Returns: numpy array of floats (n x 3)
+    """
+    values = pd.Series(column).astype(object)
+    values = values.where(values.notnull(), '').astype(str).str.strip()
+
+    coordinates = values.str.extract(CENTROID_PATTERN, expand=True)
+
+    bad = values[(values != '') & coordinates.isnull().any(axis=1)]
+    if len(bad) > 0:
+        raise ValueError(str('Could not parse centroid: ' + str(bad.iloc[0])))
+
+    return coordinates.astype(float).values.reshape(-1, 3)
+
+
+def read_sites(sites_file):
+    """
+    Read a pandda sites csv into a frame with one row per site, and columns named after the PanddaSite fields.
+    """
+    sites_frame = csv_functions.read_frame(sites_file, 'pandda_sites')
+
+    aligned = parse_centroids(sites_frame['centroid'])
+    native = parse_centroids(sites_frame['native_centroid'])
+
+    return pd.DataFrame({
+        'site': sites_frame['site_idx'].astype(int).values,
+        'site_aligned_centroid_x': aligned[:, 0],
+        'site_aligned_centroid_y': aligned[:, 1],
+        'site_aligned_centroid_z': aligned[:, 2],
+        'site_native_centroid_x': native[:, 0],
+        'site_native_centroid_y': native[:, 1],
+        'site_native_centroid_z': native[:, 2]
+    })
+
+
 def get_file_names(bdc, crystal, input_dir, output_dir, event):
 
     map_file_name = ''.join([crystal, '-event_', str(event), '_1-BDC_', str(bdc), '_map.native.ccp4'])
@@ -104,63 +203,34 @@ def get_file_names(bdc, crystal, input_dir, output_dir, event):
     pandda_model_name = input_pdb_name.replace('-input', '-model')
     pandda_model_path = input_pdb_path.replace(input_pdb_name, pandda_model_name)
 
-    exists_array = [os.path.isfile(filepath) for filepath in [map_file_path, input_pdb_path, input_mtz_path,
-                                                              aligned_pdb_path, pandda_model_path]]
+    exists_array = [cache_functions.stat_cache.isfile(filepath) for filepath in [map_file_path, input_pdb_path,
+                                                                                   input_mtz_path, aligned_pdb_path,
+                                                                                   pandda_model_path]]
 
     return map_file_path, input_pdb_path, input_mtz_path, aligned_pdb_path, pandda_model_path, exists_array
 
 
 def find_ligands(pandda_model_path):
-    lig_strings = []
-    for line in open(pandda_model_path, 'r'):
-        if 'LIG' in line:
-            result = re.search(r"LIG.......", line)
-            if result:
-                lig_string = result.group()
-                lig_strings.append(lig_string)
-    lig_strings = list(set(lig_strings))
+    lig_strings, centroids = pdb_functions.ligand_centroids(pandda_model_path)
 
     return lig_strings
 
 
 def find_ligand_site_event(nx, ny, nz, ex, ey, ez, lig_strings, pandda_model_path):
     # nn = native_centroid n, en = event_centroid n
-    event_centroid = [ex, ey, ez]
-    native_centroid = [nx, ny, nz]
-    event_displacement = np.linalg.norm([native_centroid, event_centroid])
-    lig_distances = []
-    lig_centres = []
-    for lig in lig_strings:
-        lig_pdb = []
-
-        for line in open(pandda_model_path):
-            if lig in line:
-                lig_pdb.append(line)
-        lig_pdb = (''.join(lig_pdb))
-        mol = Chem.MolFromPDBBlock(lig_pdb)
-        conf = mol.GetConformer()
-        centre = rdMolTransforms.ComputeCentroid(conf)
-        lig_centre = [centre.x, centre.y, centre.z]
-        lig_centres.append(lig_centre)
-
-        matrix = [lig_centre, event_centroid]
-        dist = np.linalg.norm(matrix)
-
-        lig_event_dist = abs(event_displacement-dist)
-        lig_distances.append(lig_event_dist)
-
-    min_dist = min(lig_distances)
-    for j in range(0, len(lig_distances)):
-        if lig_distances[j] == min_dist:
-            ind = j
+    all_ligs, all_centroids = pdb_functions.ligand_centroids(pandda_model_path)
+    lig_centres = all_centroids[[all_ligs.index(lig) for lig in lig_strings]]
+
+    indices, distances, displacements = pdb_functions.match_ligands([nx, ny, nz], [ex, ey, ez], lig_centres)
+    ind = indices[0]
 
     ligand = lig_strings[ind]
-    lig_centroid = lig_centres[ind]
+    lig_centroid = lig_centres[ind].tolist()
 
-    return ligand, lig_centroid, min_dist, event_displacement
+    return ligand, lig_centroid, float(distances[0]), float(displacements[0])
 
 
-def translate_event_stats(event_csv, csv_row):
+def event_stats_translations():
     pandda_event_stats_trans = {
         '1-BDC': 'one_minus_bdc',
         'cluster_size': 'cluster_size',
@@ -210,12 +280,106 @@ def translate_event_stats(event_csv, csv_row):
         'scl_map_rms': 'scl_map_rms'
     }
 
-    event_frame = pd.DataFrame.from_csv(event_csv)
+    return pandda_event_stats_trans
+
 
-    out_dict = {}
+def event_stats_frame(events_frame):
+    """
+    Translate the columns of a pandda events frame to PanddaEventStats fields (all events in one go). Missing values
+    are returned as None.
+    """
+    translations = event_stats_translations()
+    columns = [column for column in translations.keys() if column in events_frame.columns]
+    stats = events_frame[columns].rename(columns=translations)
+    return stats.astype(object).where(stats.notnull(), None)
+
+
+def translate_event_stats(event_csv, csv_row):
+    event_frame = read_events(event_csv)
+
+    return event_stats_frame(event_frame).iloc[csv_row].to_dict()
+
+
+def read_events(events_file):
+    # the pandda events csv, with events in file order (as pd.DataFrame.from_csv(events_file, index_col=None))
+    return csv_functions.read_frame(events_file, 'pandda_events')
+
+
+def event_fields(row, files, ligand, lig_centroid, lig_dist, site_dist):
+    """
+    The PanddaEvent fields for one event (a row of the events frame), given its files (from get_file_names) and the
+    ligand closest to it.
+    """
+    map_file_path, input_pdb_path, input_mtz_path, aligned_pdb_path, pandda_model_path, exists_array = files
+
+    return {
+        'event': int(row['event_idx']),
+        'event_centroid_x': row['x'],
+        'event_centroid_y': row['y'],
+        'event_centroid_z': row['z'],
+        'event_dist_from_site_centroid': site_dist,
+        'lig_centroid_x': lig_centroid[0],
+        'lig_centroid_y': lig_centroid[1],
+        'lig_centroid_z': lig_centroid[2],
+        'lig_dist_event': lig_dist,
+        'lig_id': ligand,
+        'pandda_event_map_native': map_file_path,
+        'pandda_model_pdb': pandda_model_path,
+        'pandda_input_pdb': input_pdb_path,
+        'pandda_input_mtz': input_mtz_path
+    }
 
-    for key in pandda_event_stats_trans.keys():
-        if out_dict[pandda_event_stats_trans[key]]:
-            out_dict[pandda_event_stats_trans[key]] = event_frame[key][csv_row]
 
-    return out_dict
+def events_file_info(events_frame, native_centroids, input_dir, output_dir):
+    """
+    Find the files for every event in an events frame, and the ligand closest to each event. native_centroids is a
+    dict of site index -> native centroid. Events are grouped by pandda model (one per crystal), so each model is read
+    once and its ligands are matched to all of its events with one call to match_ligands. Nothing here touches the
+    database, so it can be done in a worker process.
+
+    Returns: a list (in frame order) of (PanddaEvent fields or None, expected files, exists_array, error or None)
+    """
+    info = [None] * len(events_frame)
+    # pandda model -> [(position in frame, row, native centroid, files), ...]
+    models = {}
+
+    for position, (i, row) in enumerate(events_frame.iterrows()):
+        native_centroid = native_centroids.get(int(row['site_idx']))
+        # events can't be placed relative to a site without a native centroid, so they are skipped rather than
+        # matched against NaNs
+        if native_centroid is None or pd.isnull(list(native_centroid)).any():
+            info[position] = (None, [], [], str('No native centroid for site ' + str(row['site_idx']) +
+                                                ', skipping event ' + str(row['event_idx']) + ' of ' + str(row['dtag'])))
+            continue
+
+        try:
+            files = get_file_names(bdc=row['1-BDC'], crystal=row['dtag'], input_dir=input_dir, output_dir=output_dir,
+                                   event=row['event_idx'])
+        except Exception:
+            info[position] = (None, [], [], traceback.format_exc())
+            continue
+
+        if False in files[5]:
+            info[position] = (None, list(files[:5]), files[5], None)
+            continue
+
+        models.setdefault(files[4], []).append((position, row, native_centroid, files))
+
+    for pandda_model_path, events in models.items():
+        try:
+            lig_strings, lig_centroids = pdb_functions.ligand_centroids(pandda_model_path)
+            indices, distances, displacements = pdb_functions.match_ligands(
+                [native_centroid for _, _, native_centroid, _ in events],
+                [(row['x'], row['y'], row['z']) for _, row, _, _ in events], lig_centroids)
+        except Exception:
+            error = traceback.format_exc()
+            for position, _, _, _ in events:
+                info[position] = (None, [], [], error)
+            continue
+
+        for j, (position, row, _, files) in enumerate(events):
+            fields = event_fields(row, files, lig_strings[indices[j]], lig_centroids[indices[j]].tolist(),
+                                  float(distances[j]), float(displacements[j]))
+            info[position] = (fields, list(files[:5]), files[5], None)
+
+    return info
@@ -0,0 +1,255 @@
+import os
+import re
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+from functions import cache_functions
+
+
+# ligand inventories of the structures read by this process: path -> ((size, mtime_ns), inventory), oldest first.
+# Only the last MAX_CACHED structures are kept
+structure_cache = OrderedDict()
+structure_cache_stats = {'hits': 0, 'misses': 0}
+MAX_CACHED = 256
+# buffer size for reading and writing whole pdb files
+FILE_BUFFER = 1 << 20
+# structures can be read from several threads (e.g. InitDBEntries' file checks)
+structure_lock = threading.Lock()
+
+# persistent caches of inventories, and of what each file written by rewrite_pdb was made from, shared by every
+# task (see set_ligand_cache)
+ligand_cache = None
+rewrite_cache = None
+
+
+def is_hydrogen(line):
+    # element from columns 77-78, or from the atom name if there isn't one
+    element = line[76:78].strip()
+    if not element:
+        element = re.sub(r'[^A-Za-z]', '', line[12:16])[:1]
+    return element.upper() in ['H', 'D']
+
+
+def set_ligand_cache(cache_file):
+    # keep ligand inventories in a cache_functions.FileCache, so unchanged structures are never read again (and the
+    # keys of rewrite_pdb's copies in another table of it, so unchanged copies are never written again)
+    global ligand_cache, rewrite_cache
+    if ligand_cache is None or ligand_cache.cache_file != cache_file:
+        ligand_cache = cache_functions.FileCache(cache_file, 'ligands')
+        rewrite_cache = cache_functions.FileCache(cache_file, 'rewrites')
+    return ligand_cache
+
+
+def altconf_ligands(ligands):
+    # the ligands (with their altloc character) that are one of several alternate conformations of the same residue
+    residues = [l[1:] for l in ligands]
+    return [l for l in ligands if residues.count(l[1:]) > 1]
+
+
+def parse_inventory(pdb_path):
+    """
+    Read the LIG residues of a pdb file in one pass.
+
+    Returns: dict (json serialisable) with
+        - residues: the ligand strings (e.g. 'LIG A 501 ') in the order they appear in the file
+        - ligands: the ligand strings with their alternate location character (e.g. 'ALIG A 501 '), sorted, leaving
+          out LINK records (for phenix's format)
+        - altconfs: the ligands that are one of several alternate conformations of the same residue
+        - atoms: ligand string -> number of atoms used for its centroid
+        - centroids: ligand string -> centroid, for ligands with atoms. As for the centroids worked out with RDKit
+          before (MolFromPDBBlock then ComputeCentroid), hydrogens are left out, and only atoms without an alternate
+          location, or in alternate location A or 1, are used
+    """
+    coordinates = OrderedDict()
+    ligands = set()
+    with open(pdb_path, 'r') as f:
+        for line in f:
+            if 'LIG' not in line:
+                continue
+            result = re.search(r"LIG.......", line)
+            if not result:
+                continue
+            lig_string = result.group()
+            if lig_string not in coordinates.keys():
+                coordinates[lig_string] = []
+            if 'LINK' not in line and result.start() > 0:
+                ligands.add(line[result.start() - 1:result.end()])
+            if not line.startswith(('HETATM', 'ATOM')) or line[16] not in [' ', 'A', '1'] or is_hydrogen(line):
+                continue
+            coordinates[lig_string].append([float(line[30:38]), float(line[38:46]), float(line[46:54])])
+
+    ligands = sorted(ligands)
+
+    return {'residues': list(coordinates.keys()),
+            'ligands': ligands,
+            'altconfs': altconf_ligands(ligands),
+            'atoms': dict((lig, len(coords)) for lig, coords in coordinates.items()),
+            'centroids': dict((lig, np.array(coords, dtype=float).mean(axis=0).tolist())
+                              for lig, coords in coordinates.items() if coords)}
+
+
+def read_inventory(pdb_path):
+    """
+    parse_inventory, parsing each file once for as long as it doesn't change: from memory if this process has read
+    it already, otherwise from the ligand cache (if set), and only then from the file
+    """
+    stat = os.stat(pdb_path)
+    key = (stat.st_size, stat.st_mtime_ns)
+
+    with structure_lock:
+        cached = structure_cache.get(pdb_path)
+        if cached is not None and cached[0] == key:
+            structure_cache_stats['hits'] += 1
+            structure_cache.move_to_end(pdb_path)
+            return cached[1]
+        structure_cache_stats['misses'] += 1
+
+    if ligand_cache is not None:
+        inventory = ligand_cache.get(pdb_path, key=key)
+        if inventory is None:
+            inventory = parse_inventory(pdb_path)
+            ligand_cache.set(pdb_path, inventory, key=key)
+    else:
+        inventory = parse_inventory(pdb_path)
+
+    with structure_lock:
+        structure_cache[pdb_path] = (key, inventory)
+        structure_cache.move_to_end(pdb_path)
+        while len(structure_cache) > MAX_CACHED:
+            structure_cache.popitem(last=False)
+
+    return inventory
+
+
+def ligand_centroids(pdb_path):
+    """
+    Returns: the ligand strings of the ligands with atoms in pdb_path, and their centroids (numpy array, n x 3)
+    """
+    inventory = read_inventory(pdb_path)
+    lig_strings = [lig for lig in inventory['residues'] if lig in inventory['centroids'].keys()]
+    centroids = np.array([inventory['centroids'][lig] for lig in lig_strings], dtype=float).reshape(-1, 3)
+
+    return lig_strings, centroids
+
+
+def bound_ligands(pdb_path):
+    """
+    Returns: the ligands in pdb_path with their alternate location character, and those that are altconfs (see
+    parse_inventory), or (None, None) if the file can't be read
+    """
+    try:
+        inventory = read_inventory(pdb_path)
+    except (IOError, UnicodeDecodeError):
+        return None, None
+
+    return inventory['ligands'], inventory['altconfs']
+
+
+def match_ligands(native_centroid, event_centroids, lig_centroids):
+    """
+    Find the ligand closest to each of a set of events in one go. Distances are measured as they always have been
+    for pandda events: the event's displacement is the norm of the matrix [native centroid, event centroid], and its
+    distance from a ligand is the difference between that and the norm of [ligand centroid, event centroid]. Where
+    two ligands are equally close, the last one is used. native_centroid is either one centroid for all the events,
+    or one per event (the events of a model can be in different sites).
+
+    Returns: for each event, the index of the closest ligand, its distance, and the event's displacement
+    """
+    native_centroid = np.asarray(native_centroid, dtype=float).reshape(-1, 3)
+    event_centroids = np.asarray(event_centroids, dtype=float).reshape(-1, 3)
+    lig_centroids = np.asarray(lig_centroids, dtype=float).reshape(-1, 3)
+
+    if len(lig_centroids) == 0:
+        raise ValueError('no ligands to match events to')
+
+    # norm of the 2 x 3 matrix [a, b] = sqrt(|a|^2 + |b|^2)
+    event_squares = np.sum(np.square(event_centroids), axis=1)
+    event_displacements = np.sqrt(np.sum(np.square(native_centroid), axis=1) + event_squares)
+    lig_dists = np.sqrt(event_squares[:, np.newaxis] + np.sum(np.square(lig_centroids), axis=1)[np.newaxis, :])
+
+    distances = np.abs(event_displacements[:, np.newaxis] - lig_dists)
+
+    # argmin returns the first of equal values, so look from the end
+    last = len(lig_centroids) - 1
+    indices = last - np.argmin(distances[:, ::-1], axis=1)
+
+    return indices, distances[np.arange(len(indices)), indices], event_displacements
+
+
+def altconf_pdb_file(pdb_path, altconf, directory):
+    # the pdb file to upload for one altconf of the ligands in pdb_path, e.g. refine_bound_ALIGA501.pdb
+    return str(directory + pdb_path.split('/')[-1].replace('.pdb', str('_' + altconf.replace(' ', '') + '.pdb')))
+
+
+def rewrite_pdb(pdb_path, outputs):
+    """
+    Write several edited copies of a pdb file in one pass over it. outputs is a list of (file, drop, relabel): lines
+    containing any of the strings in drop are left out of file, and relabel (a ligand string with its altloc
+    character, or None) is replaced by the same ligand without the altloc. Each copy is written through one buffered
+    file and moved into place when it is complete.
+
+    With a rewrite cache (see set_ligand_cache), a copy is left as it is if it hasn't changed since it was written
+    from the same pdb_path (by size and mtime), drop and relabel. Otherwise every copy is written.
+
+    Returns: the files that were written
+    """
+    stat = os.stat(pdb_path)
+    keys = [[pdb_path, stat.st_size, stat.st_mtime_ns, sorted(drop), relabel] for _, drop, relabel in outputs]
+
+    stale = []
+    for output, key in zip(outputs, keys):
+        if rewrite_cache is None or not os.path.isfile(output[0]) or rewrite_cache.get(output[0]) != key:
+            stale.append((output, key))
+    if not stale:
+        return []
+
+    writers = []
+    try:
+        for (out_file, drop, relabel), _ in stale:
+            temp_file = str(out_file + '.' + str(os.getpid()) + '.tmp')
+            new_label = str(' ' + relabel[1:]) if relabel else None
+            writers.append((open(temp_file, 'w', buffering=FILE_BUFFER), temp_file, tuple(drop), relabel, new_label))
+
+        with open(pdb_path, 'r', buffering=FILE_BUFFER) as f:
+            for line in f:
+                for writer, _, drop, relabel, new_label in writers:
+                    if drop and any(d in line for d in drop):
+                        continue
+                    if relabel and relabel in line:
+                        writer.write(line.replace(relabel, new_label))
+                    else:
+                        writer.write(line)
+    except:
+        for writer, temp_file, _, _, _ in writers:
+            writer.close()
+            os.remove(temp_file)
+        raise
+
+    for writer, temp_file, _, _, _ in writers:
+        writer.close()
+    for (writer, temp_file, _, _, _), ((out_file, _, _), key) in zip(writers, stale):
+        os.replace(temp_file, out_file)
+        if rewrite_cache is not None:
+            rewrite_cache.set(out_file, key)
+
+    return [output[0] for output, _ in stale]
+
+
+def split_altconfs(pdb_path, ligands, directory, altconfs=None):
+    """
+    Write the pdb files to upload for the altconfs of ligands (as stored in proasis_hits.ligand_list) in one pass
+    over pdb_path: each keeps only its own conformation of the ligands, with the altloc character removed so proasis
+    can read it. altconfs defaults to all of them (see altconf_ligands).
+
+    Returns: dict of altconf -> pdb file
+    """
+    if altconfs is None:
+        altconfs = altconf_ligands(ligands)
+    files = dict((altconf, altconf_pdb_file(pdb_path, altconf, directory)) for altconf in altconfs)
+    rewrite_pdb(pdb_path, [(files[altconf], [lig for lig in ligands if lig != altconf], altconf)
+                           for altconf in sorted(files.keys())])
+
+    return files
+
@@ -1,34 +1,166 @@
+import gzip
+import json
 import os
 import shutil
 import subprocess
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 
 import requests
+from requests.adapters import HTTPAdapter
+
+
+class ProasisClient(object):
+    """
+    Client for the proasis REST API. Requests share one pooled requests.Session (so connections are kept open between
+    calls), failed requests are retried with exponential backoff, and lookups for many structures can be made
+    concurrently with get_many. Operations the API doesn't have (submitting and deleting structures, adding files)
+    run proasis' utils scripts.
+
+    The one Session is shared by every thread using the client: nothing changes its headers, cookies or adapters
+    after it is made, and its connection pool (up to workers connections) is thread safe. It can't be shared with
+    forked processes, which get a new client from client().
+    """
+
+    def __init__(self, webserver_address, api_ext, username, password, utils_root='/usr/local/Proasis2/utils/',
+                 retries=3, backoff=0.5, workers=8, timeout=60):
+        self.settings = dict(webserver_address=webserver_address, api_ext=api_ext, username=username,
+                             password=password, utils_root=utils_root, retries=retries, backoff=backoff,
+                             workers=workers, timeout=timeout)
+        self.base_url = str(webserver_address.rstrip('/') + '/' + api_ext.strip('/') + '/')
+        self.username = username
+        self.password = password
+        self.utils_root = utils_root
+        self.retries = retries
+        self.backoff = backoff
+        self.workers = workers
+        self.timeout = timeout
+
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=workers)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+    @classmethod
+    def from_config(cls, **kwargs):
+        # settings from [ProasisConfig] in the luigi config (and any others given)
+        from luigi_classes.config_classes import ProasisConfig
+
+        config = ProasisConfig()
+        settings = dict(webserver_address=config.webserver_address, api_ext=config.api_ext,
+                        username=config.username, password=config.password, utils_root=config.utils_root)
+        settings.update(kwargs)
+        return cls(**settings)
+
+    def url(self, path):
+        # paths are relative to the api root, e.g. 'idlookup/<strucid>'; full urls are used as they are
+        if path.startswith(('http://', 'https://')):
+            return path
+        return str(self.base_url + path.lstrip('/'))
+
+    def get_json(self, path, retries=None, **fields):
+        """
+        Send a request to the API (with the credentials, and any other fields, as a json body) and return the json
+        it sends back. Connection errors, server errors and responses that aren't json are retried, waiting backoff,
+        2 * backoff, 4 * backoff... seconds in between.
+
+        Returns: the json, or None if there was no (non-empty) json after all the retries
+        """
+        if retries is None:
+            retries = self.retries
+        data = dict(username=self.username, password=self.password, **fields)
+
+        for attempt in range(max(retries, 1)):
+            if attempt:
+                time.sleep(self.backoff * 2 ** (attempt - 1))
+            try:
+                r = self.session.get(self.url(path), data=json.dumps(data), timeout=self.timeout)
+            except requests.RequestException:
+                continue
+            if r.status_code >= 500 or r.status_code == 429:
+                continue
+            try:
+                js = r.json()
+            except ValueError:
+                continue
+            # proasis sends back empty json while it is still working on slow requests
+            if js:
+                return js
 
-from functions import misc_functions
-import json
-from simplejson.errors import JSONDecodeError
+        return None
 
+    def get_many(self, paths, **fields):
+        # get_json for each of paths, workers at a time. Returns the results in the same order as paths
+        if not paths:
+            return []
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            return list(executor.map(lambda path: self.get_json(path, **fields), paths))
 
-def get_json(url, max_retries=1):
+    def run_util(self, script, *args):
+        # run one of proasis' utils scripts. Returns its (stdout, stderr) as strings
+        process = subprocess.Popen([os.path.join(self.utils_root, script)] + [str(a) for a in args],
+                                   stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        out, err = process.communicate()
+        return out.decode('ascii'), err.decode('ascii')
 
-    def attempt_json(url, data):
-        try:
-            r = requests.get(url, data=data)
-            js = r.json()
-            return js
-        except JSONDecodeError:
-            return None
+    def close(self):
+        self.session.close()
+
+
+_client = None
+_client_pid = None
+_client_lock = threading.Lock()
+
+
+def client():
+    # the client shared by the functions below, made the first time it is needed in each process (a forked process
+    # would otherwise share its parent's open connections)
+    global _client, _client_pid
+    with _client_lock:
+        if _client is None:
+            _client = ProasisClient.from_config()
+        elif _client_pid != os.getpid():
+            _client = ProasisClient(**_client.settings)
+        _client_pid = os.getpid()
+    return _client
+
+
+def set_client(proasis_client):
+    # use a different client for the functions below (e.g. one pointing at a test server)
+    global _client, _client_pid
+    with _client_lock:
+        _client = proasis_client
+        _client_pid = os.getpid()
 
+
+def get_json(url, max_retries=None):
     # send API request and pull output as json
-    data = '''{"username":"uzw12877","password":"uzw12877"}'''
-    attempt_no = 0
-    while attempt_no <= max_retries:
-        attempt_no += 1
-        json_string = attempt_json(url=url, data=data)
-        if json_string:
-            return json_string
-        elif attempt_no >= max_retries:
-            return None
+    return client().get_json(url, retries=max_retries)
+
+
+def gunzip(path):
+    # gzip -d: unzip path and remove the zipped file
+    if not path.endswith('.gz'):
+        return path
+    with gzip.open(path, 'rb') as f_in, open(path[:-3], 'wb') as f_out:
+        shutil.copyfileobj(f_in, f_out)
+    os.remove(path)
+    return path[:-3]
+
+
+def write_output(file_dict, outfile):
+    # write the 'output' lines of a fetchfile response to outfile. Returns None if there weren't any
+    if os.path.isfile(outfile):
+        os.remove(outfile)
+
+    with open(outfile, 'w') as f:
+        try:
+            for line in file_dict['output']:
+                f.write(line)
+        except:
+            outfile = None
+    return outfile
 
 
 def dict_from_string(json_string):
@@ -48,10 +180,7 @@ def dict_from_string(json_string):
 
 
 def get_strucids_from_project(project):
-    url = str("http://cs04r-sc-vserv-137.diamond.ac.uk/proasisapi/v1.4/projectlookup/" + project +
-              "?strucsource=inh&idonly=1")
-
-    json_string_strucids = get_json(url)
+    json_string_strucids = get_json(str("projectlookup/" + project + "?strucsource=inh&idonly=1"))
     dict_strucids = dict_from_string(json_string_strucids)
     try:
         strucids = list(dict_strucids['strucids'])
@@ -62,23 +191,18 @@ def get_strucids_from_project(project):
 
 
 def delete_structure(strucid):
-    delete_string = str('/usr/local/Proasis2/utils/removestruc.py -s ' + str(strucid))
-    process = subprocess.Popen(delete_string, shell=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-    process.communicate()
+    client().run_util('removestruc.py', '-s', strucid)
 
 
 def delete_project(name):
-    delete_string = str('/usr/local/Proasis2/utils/removeoldproject.py -p ' + str(name))
-    process = subprocess.Popen(delete_string, shell=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-    process.communicate()
+    client().run_util('removeoldproject.py', '-p', name)
 
 
 def delete_all_inhouse(exception_list=None):
     if exception_list is None:
         exception_list = ['Zitzmann', 'Ali', 'CMGC_Kinases']
-    all_projects_url = 'http://cs04r-sc-vserv-137.diamond.ac.uk/proasisapi/v1.4/projects/'
 
-    json_string_projects = get_json(all_projects_url)
+    json_string_projects = get_json('projects/')
     dict_projects = dict_from_string(json_string_projects)
 
     all_projects = dict_projects['ALLPROJECTS']
@@ -100,9 +224,8 @@ def count_all_inhouse(exception_list=None):
     if exception_list is None:
         exception_list = ['Zitzmann', 'Ali', 'CMGC_Kinases']
     count = 0
-    all_projects_url = 'http://cs04r-sc-vserv-137.diamond.ac.uk/proasisapi/v1.4/projects/'
 
-    json_string_projects = get_json(all_projects_url)
+    json_string_projects = get_json('projects/')
     dict_projects = dict_from_string(json_string_projects)
 
     all_projects = dict_projects['ALLPROJECTS']
@@ -124,8 +247,7 @@ def count_all_inhouse(exception_list=None):
 
 
 def get_struc_mtz(strucid, out_dir):
-    url = str('http://cs04r-sc-vserv-137.diamond.ac.uk/proasisapi/v1.4/listfiles/' + strucid)
-    json_string = get_json(url)
+    json_string = get_json(str('listfiles/' + strucid))
     if not json_string:
         raise Exception('failed to retreive mtz for ' + strucid + ' to ' + out_dir)
     file_dict = dict_from_string(json_string)
@@ -141,9 +263,7 @@ def get_struc_mtz(strucid, out_dir):
         print('moving stuff...')
         shutil.copy2(filename, out_dir)
         mtz_zipped = filename.split('/')[-1]
-        command_string = ('gzip -d ' + out_dir + '/' + mtz_zipped)
-        process = subprocess.Popen(command_string, shell=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-        process.communicate()
+        gunzip(os.path.join(out_dir, mtz_zipped))
         saved_to = str(mtz_zipped.replace('.gz', ''))
     else:
         saved_to = None
@@ -152,8 +272,7 @@ def get_struc_mtz(strucid, out_dir):
 
 
 def get_struc_map(strucid, out_dir, mtype):
-    url = str('http://cs04r-sc-vserv-137.diamond.ac.uk/proasisapi/v1.4/listfiles/' + strucid)
-    json_string = get_json(url)
+    json_string = get_json(str('listfiles/' + strucid))
     if not json_string:
         raise Exception('failed to retreive map for ' + strucid + ' to ' + out_dir)
     file_dict = dict_from_string(json_string)
@@ -173,12 +292,7 @@ def get_struc_map(strucid, out_dir, mtype):
         print('moving stuff...')
         shutil.copy2(filename, out_dir)
         mtz_zipped = filename.split('/')[-1]
-        command_string = ('gzip -d ' + out_dir + '/' + mtz_zipped)
-        process = subprocess.Popen(command_string, shell=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-        _, _ = process.communicate()
-        # out = out.decode('ascii')
-        # if err:
-        #     err = err.decode('ascii')
+        gunzip(os.path.join(out_dir, mtz_zipped))
         saved_to = str(mtz_zipped.replace('.gz', ''))
     else:
         saved_to = None
@@ -187,29 +301,13 @@ def get_struc_map(strucid, out_dir, mtype):
 
 
 def get_struc_pdb(strucid, outfile):
-    url = str('http://cs04r-sc-vserv-137.diamond.ac.uk/proasisapi/v1.4/fetchfile/originalpdb/' + strucid)
-    json_string = get_json(url)
+    json_string = get_json(str('fetchfile/originalpdb/' + strucid))
     if not json_string:
         raise Exception('failed to retreive pdb for ' + strucid + ' to ' + outfile)
     file_dict = dict_from_string(json_string)
     print(file_dict)
-    if os.path.isfile(outfile):
-        os.remove(outfile)
 
-    command_string = ('touch ' + outfile)
-    process = subprocess.Popen(command_string, shell=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-    _, _ = process.communicate()
-    # out = out.decode('ascii')
-    # if err:
-    #     err = err.decode('ascii')
-
-    with open(outfile, 'a') as f:
-        try:
-            for line in file_dict['output']:
-                f.write(line)
-        except:
-            outfile = None
-    return outfile
+    return write_output(file_dict, outfile)
 
 
 def submit_proasis_job_string(substring):
@@ -219,24 +317,15 @@ def submit_proasis_job_string(substring):
     if err:
         err = err.decode('ascii')
 
+    # misc_functions needs rdkit and openbabel, which nothing else here does
+    from functions import misc_functions
     strucidstr = misc_functions.get_id_string(out)
 
     return strucidstr, err, out
 
 
 def add_proasis_file(file_type, filename, strucid, title):
-    add_file = str(
-        '/usr/local/Proasis2/utils/addnewfile.py' + ' ' + '-i' + ' ' + file_type + ' ' + '-f' + ' ' + filename + ' ' +
-        '-s' + ' ' + strucid + ' ' + '-t' + ' ' + title)
-
-    process = subprocess.Popen(add_file, shell=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-    out, err = process.communicate()
-
-    out = out.decode('ascii')
-    if err:
-        err = err.decode('ascii')
-
-    return out, err
+    return client().run_util('addnewfile.py', '-i', file_type, '-f', filename, '-s', strucid, '-t', title)
 
 
 def get_lig_strings(lig_list):
@@ -251,34 +340,16 @@ def get_lig_strings(lig_list):
 
 
 def get_struc_file(strucid, outfile, ftype):
-    url = str('http://cs04r-sc-vserv-137.diamond.ac.uk/proasisapi/v1.4/fetchfile/' + ftype + '/' + strucid)
-    json_string = get_json(url)
+    json_string = get_json(str('fetchfile/' + ftype + '/' + strucid))
     if not json_string:
         return None
     file_dict = dict_from_string(json_string)
-    # print file_dict
-    if os.path.isfile(outfile):
-        os.remove(outfile)
 
-    command_string = ('touch ' + outfile)
-    process = subprocess.Popen(command_string, shell=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-    out, _ = process.communicate()
-    out = out.decode('ascii')
-
-    print(out)
-
-    with open(outfile, 'a') as f:
-        try:
-            for line in file_dict['output']:
-                f.write(line)
-        except:
-            outfile = None
-    return outfile
+    return write_output(file_dict, outfile)
 
 
 def get_strucid_json(strucid):
-    url = str('http://cs04r-sc-vserv-137.diamond.ac.uk/proasisapi/v1.4/idlookup/' + strucid)
-    json_string = get_json(url)
+    json_string = get_json(str('idlookup/' + strucid))
     if not json_string:
         raise Exception('failed to retreive strucid json for ' + strucid)
     out_dict = dict_from_string(json_string)
@@ -286,54 +357,35 @@ def get_strucid_json(strucid):
     return out_dict
 
 
-def get_lig_sdf(strucid, ligand, outfile):
-    url = str(str('http://cs04r-sc-vserv-137.diamond.ac.uk/proasisapi/v1.4/fetchfile/sdf/' + strucid))
-    data = str('{"username":"uzw12877","password":"uzw12877","ligand":"' + ligand + '"}')
-    r = requests.get(url, data=data)
-    json_string = r.json()
-    file_dict = dict_from_string(json_string)
-    if 'errorMessage' in file_dict.keys():
-        data = str('{"username":"uzw12877","password":"uzw12877"}')
-        r = requests.get(url, data=data)
-        json_string = r.json()
-        print(json_string)
+def get_strucids_json(strucids):
+    # get_strucid_json for many strucids, looked up concurrently
+    json_strings = client().get_many([str('idlookup/' + strucid) for strucid in strucids])
+    failed = [strucid for strucid, json_string in zip(strucids, json_strings) if not json_string]
+    if failed:
+        raise Exception('failed to retreive strucid json for ' + ', '.join(failed))
 
-        file_dict = dict_from_string(json_string)
-    if os.path.isfile(outfile):
-        os.remove(outfile)
+    return [dict_from_string(json_string) for json_string in json_strings]
 
-    command_string = ('touch ' + outfile)
-    process = subprocess.Popen(command_string, shell=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-    out, err = process.communicate()
-    out = out.decode('ascii')
-    if err:
-        err = err.decode('ascii')
 
-    print(out)
-    print(err)
+def get_lig_json(path, ligand):
+    # ask for a ligand's file, or the structure's if proasis doesn't know the ligand
+    json_string = client().get_json(path, ligand=ligand)
+    if json_string and 'errorMessage' in dict_from_string(json_string).keys():
+        json_string = client().get_json(path)
+        print(json_string)
+    return json_string
 
-    with open(outfile, 'a') as f:
-        try:
-            for line in file_dict['output']:
-                f.write(line)
-        except:
-            outfile = None
-    return outfile
+
+def get_lig_sdf(strucid, ligand, outfile):
+    json_string = get_lig_json(str('fetchfile/sdf/' + strucid), ligand)
+    file_dict = dict_from_string(json_string or {})
+
+    return write_output(file_dict, outfile)
 
 
 def get_lig_interactions(strucid, ligand, outfile):
-    url = str(str('http://cs04r-sc-vserv-137.diamond.ac.uk/proasisapi/v1.4/sc/' + strucid))
-    data = str('{"username":"uzw12877","password":"uzw12877","ligand":"' + ligand + '"}')
-    r = requests.get(url, data=data)
-    json_string = r.json()
+    json_string = get_lig_json(str('sc/' + strucid), ligand)
     print(json_string)
-    file_dict = dict_from_string(json_string)
-
-    if 'errorMessage' in file_dict.keys():
-        data = str('{"username":"uzw12877","password":"uzw12877"}')
-        r = requests.get(url, data=data)
-        json_string = r.json()
-        print(json_string)
 
     if os.path.isfile(outfile):
         os.remove(outfile)
@@ -22,6 +22,39 @@ class SoakDBConfig(luigi.Config):
     default_path = luigi.Parameter()
 
 
+class CrawlConfig(luigi.Config):
+    # number of threads listing directories when looking for soakdb files and pandda logs
+    workers = luigi.IntParameter(default=16)
+
+
+class TransferConfig(luigi.Config):
+    # number of processes transferring soakdb files when StartTransfers is run with --parallel
+    workers = luigi.IntParameter(default=4)
+
+
+class PanddaConfig(luigi.Config):
+    # processes reading pandda csvs and models, and threads writing to the database, when TransferPandda is run with
+    # --parallel
+    workers = luigi.IntParameter(default=8)
+    writers = luigi.IntParameter(default=2)
+
+
+class ProasisHitsConfig(luigi.Config):
+    # threads checking refinement files (pdb, maps, ligands) when InitDBEntries looks for hits
+    workers = luigi.IntParameter(default=16)
+
+
+class UploadConfig(luigi.Config):
+    # processes preparing files, and threads submitting structures to proasis, when UploadHits is run with --parallel
+    workers = luigi.IntParameter(default=8)
+    submitters = luigi.IntParameter(default=4)
+
+
+class CsvConfig(luigi.Config):
+    # also write the pipeline's intermediate csvs (search paths, pandda info) as parquet, which is quicker to read
+    columnar = luigi.BoolParameter(default=False)
+
+
 class DirectoriesConfig(luigi.Config):
     # '/dls/science/groups/proasis/LabXChem/'
     hit_directory = luigi.Parameter()
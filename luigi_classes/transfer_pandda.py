@@ -1,18 +1,156 @@
+import multiprocessing
 import os
-import sqlite3
+import threading
+import time
 import traceback
+from concurrent.futures import ThreadPoolExecutor
 
 import datetime
 import luigi
 import pandas as pd
-from django.db import IntegrityError
+from django.db import IntegrityError, connections
 
-from functions import pandda_functions, misc_functions
+from functions import db_functions, pandda_functions, misc_functions, csv_functions, pdb_functions
+from functions.cache_functions import FileCache
 from luigi_classes.transfer_soakdb import StartTransfers, FindSoakDBFiles, DirectoriesConfig
-from luigi_classes.config_classes import SoakDBConfig
+from luigi_classes.config_classes import SoakDBConfig, PanddaConfig, CsvConfig
 from xchem_db.models import *
 
 
+def pandda_runs_to_load(search_paths):
+    """
+    The pandda runs under search_paths (pairs of search path and soakdb file) whose sites or events csvs have changed
+    since they were last loaded, as for FindPanddaInfo and the complete() methods of AddPanddaSites/AddPanddaEvents.
+
+    Returns: a list of (log_file, pver, input_dir, output_dir, sites_file, events_file, sdbfile)
+    """
+    cache = FileCache(os.path.join(DirectoriesConfig().log_directory, 'pandda_cache.sqlite'), 'pandda_logs')
+
+    runs = []
+    for search_path, sdbfile in search_paths:
+        for log_file in pandda_functions.find_log_files(search_path).split():
+            pver, input_dir, output_dir, sites_file, events_file, err = pandda_functions.get_files_from_log(
+                log_file, cache=cache)
+            if err or not sites_file or not events_file or '0.1.' in pver:
+                continue
+            if db_functions.pandda_sites_changed(log_file, sites_file) or \
+                    db_functions.pandda_events_changed(log_file, events_file, sdbfile):
+                runs.append((log_file, pver, input_dir, output_dir, sites_file, events_file, sdbfile))
+
+    cache.close()
+
+    return runs
+
+
+def read_pandda_run(job):
+    """
+    Read a pandda run's sites and events csvs, and find the files and ligand for each event, in a worker process.
+    Nothing here touches the database.
+    """
+    log_file, pver, input_dir, output_dir, sites_file, events_file, sdbfile = job
+    start = time.time()
+    try:
+        # fingerprint the files before reading them, so a change while loading is picked up next time
+        run = {
+            'sites_fingerprint': pandda_functions.file_fingerprint(sites_file),
+            'events_fingerprint': pandda_functions.file_fingerprint(events_file),
+            'sites_frame': pandda_functions.read_sites(sites_file),
+            'events_frame': pandda_functions.read_events(events_file)
+        }
+        native_centroids = dict((site, (x, y, z)) for site, x, y, z in zip(
+            run['sites_frame']['site'], run['sites_frame']['site_native_centroid_x'],
+            run['sites_frame']['site_native_centroid_y'], run['sites_frame']['site_native_centroid_z']))
+        run['event_info'] = pandda_functions.events_file_info(run['events_frame'], native_centroids, input_dir,
+                                                              output_dir)
+        error = None
+    except:
+        run = None
+        error = traceback.format_exc()
+
+    return job, run, time.time() - start, error
+
+
+def write_pandda_run(job, run):
+    # write a run read by read_pandda_run to the database (in a writer thread, with its own connection)
+    log_file, pver, input_dir, output_dir, sites_file, events_file, sdbfile = job
+    start = time.time()
+    try:
+        db_functions.add_pandda_run(log_file, pver, input_dir, output_dir, sites_file, events_file)
+        db_functions.add_pandda_sites(log_file, sites_file, sites_frame=run['sites_frame'])
+        db_functions.record_pandda_fingerprint(log_file, sites_fingerprint=run['sites_fingerprint'])
+
+        # taken before the events are written, so a transfer while they are being written is picked up next time
+        soakdb_transfer = db_functions.soakdb_transfer_marker(sdbfile)
+        counts = db_functions.add_pandda_events(log_file, events_file, sdbfile, str(log_file + '.transfer.err'),
+                                                events_frame=run['events_frame'], event_info=run['event_info'])
+        db_functions.record_pandda_fingerprint(log_file, events_fingerprint=run['events_fingerprint'],
+                                               soakdb_transfer=soakdb_transfer,
+                                               events_complete=counts['skipped'] == 0)
+
+        # the same markers as AddPanddaRun, AddPanddaSites and AddPanddaEvents
+        for marker in ['.run.done', '.sites.done', '.events.done']:
+            with open(str(log_file + marker), 'w') as f:
+                f.write('')
+        error = None
+    except:
+        counts = {}
+        error = traceback.format_exc()
+    finally:
+        connections.close_all()
+
+    return counts, time.time() - start, error
+
+
+def transfer_pandda_parallel(search_paths, workers, writers):
+    """
+    Load the pandda runs under search_paths that have changed: csvs and models are read by a pool of worker processes,
+    and the results written to the database by a few writer threads. Runs for the same soakdb file share crystals, so
+    they are written one at a time.
+
+    Returns: a list of (log file, seconds reading, seconds writing, counts, traceback or None)
+    """
+    start = time.time()
+    runs = pandda_runs_to_load(search_paths)
+    print(str(str(len(runs)) + ' pandda runs to load'))
+    if not runs:
+        return []
+
+    # connections can't be shared with forked processes
+    connections.close_all()
+
+    locks = dict((sdbfile, threading.Lock()) for sdbfile in set([job[6] for job in runs]))
+
+    def write(job, run, read_seconds):
+        with locks[job[6]]:
+            counts, write_seconds, error = write_pandda_run(job, run)
+        return job[0], read_seconds, write_seconds, counts, error
+
+    results = []
+    with ThreadPoolExecutor(max_workers=writers) as executor:
+        futures = []
+        with multiprocessing.get_context('fork').Pool(processes=workers) as pool:
+            for job, run, read_seconds, error in pool.imap_unordered(read_pandda_run, runs):
+                if error:
+                    results.append((job[0], read_seconds, 0, {}, error))
+                    continue
+                futures.append(executor.submit(write, job, run, read_seconds))
+        results.extend([future.result() for future in futures])
+
+    for log_file, read_seconds, write_seconds, counts, error in results:
+        print(str(log_file + ': read ' + str(round(read_seconds, 2)) + 's, write ' + str(round(write_seconds, 2)) +
+                  's, ' + ', '.join([str(key + '=' + str(counts[key])) for key in sorted(counts.keys())])))
+        if error:
+            print(error)
+
+    print(str('Loaded ' + str(len(runs)) + ' pandda runs with ' + str(workers) + ' workers and ' + str(writers) +
+              ' writers in ' + str(round(time.time() - start, 2)) + 's (' +
+              str(round(sum([r[1] for r in results]), 2)) + 's reading, ' +
+              str(round(sum([r[2] for r in results]), 2)) + 's writing, ' +
+              str(len([r for r in results if r[4]])) + ' failed)'))
+
+    return results
+
+
 class FindPanddaLogs(luigi.Task):
     search_path = luigi.Parameter()
     date_time = luigi.Parameter(default=datetime.datetime.now().strftime("%Y%m%d%H"))
@@ -51,41 +189,15 @@ class AddPanddaSites(luigi.Task):
     def output(self):
         return luigi.LocalTarget(str(self.log_file + '.sites.done'))
 
+    def complete(self):
+        # sites are only loaded again if the sites csv has changed since they were last loaded
+        return not db_functions.pandda_sites_changed(str(self.log_file).rstrip(), self.sites_file)
+
     def run(self):
-        run = PanddaRun.objects.get(pandda_log=str(self.log_file).rstrip())
-        sites_frame = pd.DataFrame.from_csv(self.sites_file, index_col=None)
-
-        for i in range(0, len(sites_frame['site_idx'])):
-            site = sites_frame['site_idx'][i]
-            aligned_centroid = eval(sites_frame['centroid'][i])
-            native_centroid = eval(sites_frame['native_centroid'][i])
-
-            print('Adding pandda site: ' + str(site))
-
-            try:
-                pandda_site = PanddaSite.objects.get_or_create(pandda_run=run, site=site,
-                                                               site_aligned_centroid_x=aligned_centroid[
-                                                                   0],
-                                                               site_aligned_centroid_y=aligned_centroid[
-                                                                   1],
-                                                               site_aligned_centroid_z=aligned_centroid[
-                                                                   2],
-                                                               site_native_centroid_x=native_centroid[
-                                                                   0],
-                                                               site_native_centroid_y=native_centroid[
-                                                                   1],
-                                                               site_native_centroid_z=native_centroid[
-                                                                   2])[0]
-            except IntegrityError:
-                pandda_site = PanddaSite.objects.get(pandda_run=run, site=site)
-                pandda_site.site_aligned_centroid_x = aligned_centroid[0]
-                pandda_site.site_aligned_centroid_y = aligned_centroid[1]
-                pandda_site.site_aligned_centroid_z = aligned_centroid[2]
-                pandda_site.site_native_centroid_x = native_centroid[0]
-                pandda_site.site_native_centroid_y = native_centroid[1]
-                pandda_site.site_native_centroid_z = native_centroid[2]
-
-            pandda_site.save()
+        fingerprint = pandda_functions.file_fingerprint(self.sites_file)
+
+        db_functions.add_pandda_sites(log_file=str(self.log_file).rstrip(), sites_file=self.sites_file)
+        db_functions.record_pandda_fingerprint(str(self.log_file).rstrip(), sites_fingerprint=fingerprint)
 
         with self.output().open('w') as f:
             f.write('')
@@ -112,103 +224,26 @@ class AddPanddaEvents(luigi.Task):
     def output(self):
         return luigi.LocalTarget(str(self.log_file + '.events.done'))
 
+    def complete(self):
+        # events are only loaded again if the events csv has changed, or some events were missing their crystal and
+        # the soakdb file has been transferred since (see db_functions.pandda_events_changed)
+        return not db_functions.pandda_events_changed(self.log_file, self.events_file, self.sdbfile)
+
     def run(self):
+        error_file = str(self.log_file + '.transfer.err')
+        pdb_functions.set_ligand_cache(os.path.join(DirectoriesConfig().log_directory, 'ligand_cache.sqlite'))
 
-        events_frame = pd.DataFrame.from_csv(self.events_file, index_col=None)
+        # fingerprint the csv and the soakdb transfer before reading them, so a change while loading is picked up next
+        # time
+        fingerprint = pandda_functions.file_fingerprint(self.events_file)
+        soakdb_transfer = db_functions.soakdb_transfer_marker(self.sdbfile)
 
-        error_file = str(self.log_file + '.transfer.err')
+        counts = db_functions.add_pandda_events(log_file=self.log_file, events_file=self.events_file,
+                                                sdbfile=self.sdbfile, error_file=error_file)
 
-        for i in range(0, len(events_frame['dtag'])):
-            event_site = (events_frame['site_idx'][i])
-
-            run = PanddaRun.objects.get(pandda_log=self.log_file)
-            site = PanddaSite.objects.get_or_create(site=int(event_site), pandda_run=run)[0]
-
-            input_directory = run.input_dir
-
-            output_directory = run.pandda_analysis.pandda_dir
-
-            map_file_path, input_pdb_path, input_mtz_path, aligned_pdb_path, \
-            pandda_model_path, exists_array = pandda_functions.get_file_names(bdc=events_frame['1-BDC'][i],
-                                                                              crystal=events_frame['dtag'][i],
-                                                                              input_dir=input_directory,
-                                                                              output_dir=output_directory,
-                                                                              event=events_frame['event_idx'][i])
-
-            if False not in exists_array:
-
-                lig_strings = pandda_functions.find_ligands(pandda_model_path)
-
-                try:
-                    event_ligand, event_ligand_centroid, event_lig_dist, site_event_dist = \
-                        pandda_functions.find_ligand_site_event(
-                            ex=events_frame['x'][i],
-                            ey=events_frame['y'][i],
-                            ez=events_frame['z'][i],
-                            nx=site.site_native_centroid_x,
-                            ny=site.site_native_centroid_y,
-                            nz=site.site_native_centroid_z,
-                            lig_strings=lig_strings,
-                            pandda_model_path=pandda_model_path
-                        )
-
-                    crystal = Crystal.objects.get_or_create(crystal_name=events_frame['dtag'][i],
-                                                            visit=SoakdbFiles.objects.get_or_create(
-                                                                filename=self.sdbfile)[0]
-                                                            )[0]
-
-                    pandda_event = PanddaEvent.objects.get_or_create(
-                        crystal=crystal,
-                        site=site,
-                        refinement=Refinement.objects.get_or_create(crystal_name=crystal)[0],
-                        data_proc=DataProcessing.objects.get_or_create(crystal_name=crystal)[0],
-                        pandda_run=run,
-                        event=events_frame['event_idx'][i],
-                        event_centroid_x=events_frame['x'][i],
-                        event_centroid_y=events_frame['y'][i],
-                        event_centroid_z=events_frame['z'][i],
-                        event_dist_from_site_centroid=site_event_dist,
-                        lig_centroid_x=event_ligand_centroid[0],
-                        lig_centroid_y=event_ligand_centroid[1],
-                        lig_centroid_z=event_ligand_centroid[2],
-                        lig_dist_event=event_lig_dist,
-                        lig_id=event_ligand,
-                        pandda_event_map_native=map_file_path,
-                        pandda_model_pdb=pandda_model_path,
-                        pandda_input_pdb=input_pdb_path,
-                        pandda_input_mtz=input_mtz_path
-
-                    )[0]
-
-                    pandda_event.save()
-
-                    event_stats_dict = pandda_functions.translate_event_stats(self.events_file, i)
-                    event_stats_dict['event'] = pandda_event
-
-                    pandda_event_stats = PanddaEventStats.objects.get_or_create(**event_stats_dict)[0]
-
-                    pandda_event_stats.save()
-
-                    crystal.status = Crystal.PANDDA
-                    crystal.save()
-
-                except Exception as exc:
-                    print(traceback.format_exc())
-                    print(exc)
-            else:
-                with open(error_file, 'a') as f:
-                    f.write('CRYSTAL: ' + str(events_frame['dtag'][i]) + ' SITE: ' + str(event_site) +
-                            ' EVENT: ' + str(events_frame['event_idx'][i]) + '\n')
-                    print('FILES NOT FOUND FOR EVENT: ' + str(events_frame['event_idx'][i]))
-                    f.write('FILES NOT FOUND FOR EVENT: ' + str(events_frame['event_idx'][i]) + '\n')
-                    print('EXPECTED: ')
-                    f.write('EXPECTED: ' + '\n')
-                    print(str([map_file_path, input_pdb_path, input_mtz_path, aligned_pdb_path, pandda_model_path]))
-                    f.write(str([map_file_path, input_pdb_path, input_mtz_path, aligned_pdb_path, pandda_model_path])
-                            + '\n')
-                    print(exists_array)
-                    f.write(str(exists_array) + '\n')
-                    f.write('\n\n')
+        db_functions.record_pandda_fingerprint(self.log_file, events_fingerprint=fingerprint,
+                                               soakdb_transfer=soakdb_transfer,
+                                               events_complete=counts['skipped'] == 0)
 
         with self.output().open('w') as f:
             f.write('')
@@ -231,13 +266,9 @@ class AddPanddaRun(luigi.Task):
 
     def run(self):
         print('ADDING PANDDA RUN...')
-        pandda_run = \
-            PanddaRun.objects.get_or_create(pandda_log=self.log_file, input_dir=self.input_dir,
-                                            pandda_analysis=PanddaAnalysis.objects.get_or_create(
-                                                pandda_dir=self.output_dir)[0],
-                                            pandda_version=self.pver, sites_file=self.sites_file,
-                                            events_file=self.events_file)[0]
-        pandda_run.save()
+        db_functions.add_pandda_run(log_file=self.log_file, pver=self.pver, input_dir=self.input_dir,
+                                    output_dir=self.output_dir, sites_file=self.sites_file,
+                                    events_file=self.events_file)
 
         with self.output().open('w') as f:
             f.write('')
@@ -269,10 +300,15 @@ class FindPanddaInfo(luigi.Task):
             'sdbfile': []
         }
 
+        # logs that haven't changed since they were last read are not read again
+        cache = FileCache(os.path.join(DirectoriesConfig().log_directory, 'pandda_cache.sqlite'), 'pandda_logs')
+        bytes_parsed = pandda_functions.log_parse_stats['bytes_parsed']
+
         for log_file in log_files:
 
             # read information from the log file
-            pver, input_dir, output_dir, sites_file, events_file, err = pandda_functions.get_files_from_log(log_file)
+            pver, input_dir, output_dir, sites_file, events_file, err = pandda_functions.get_files_from_log(
+                log_file, cache=cache)
             if not err and sites_file and events_file and '0.1.' not in pver:
                 # if no error, and sites and events present, add events from events file
                 # yield AddPanddaEvents(
@@ -292,9 +328,13 @@ class FindPanddaInfo(luigi.Task):
                 print(events_file)
                 print(err)
 
+        print(str('Pandda logs: ' + str(cache.hits) + ' cached, ' + str(cache.misses) + ' read, ' +
+                  str(pandda_functions.log_parse_stats['bytes_parsed'] - bytes_parsed) + ' bytes parsed'))
+        cache.close()
+
         frame = pd.DataFrame.from_dict(out_dict)
 
-        frame.to_csv(self.output().path)
+        csv_functions.write_frame(frame, self.output().path, columnar=CsvConfig().columnar)
 
 
 class AddPanddaData(luigi.Task):
@@ -314,9 +354,9 @@ class AddPanddaData(luigi.Task):
             return FindPanddaInfo(search_path=self.search_path, soak_db_filepath=self.soak_db_filepath,
                                   sdbfile=self.sdbfile)
         else:
-            frame = pd.DataFrame.from_csv(
+            frame = csv_functions.read_frame(
                 FindPanddaInfo(search_path=self.search_path, soak_db_filepath=self.soak_db_filepath,
-                               sdbfile=self.sdbfile).output().path)
+                               sdbfile=self.sdbfile).output().path, 'pandda_info')
 
             return [AddPanddaEvents(log_file=log_file, pver=pver, input_dir=input_dir, output_dir=output_dir,
                                     sites_file=sites_file, events_file=events_file, sdbfile=sdbfile) for
@@ -392,20 +432,34 @@ class FindSearchPaths(luigi.Task):
 
         print(self.output().path)
 
-        frame.to_csv(self.output().path)
+        csv_functions.write_frame(frame, self.output().path, columnar=CsvConfig().columnar)
 
 
 class TransferPandda(luigi.Task):
     soak_db_filepath = luigi.Parameter(default=SoakDBConfig().default_path)
     date_time = luigi.Parameter(default=datetime.datetime.now().strftime("%Y%m%d%H"))
+    # load the pandda runs with a pool of PanddaConfig().workers processes and PanddaConfig().writers database
+    # writers, rather than one task per search path and run
+    parallel = luigi.BoolParameter(default=False)
+
+    @property
+    def resources(self):
+        if self.parallel:
+            return {'django': 1}
+        return {}
 
     def requires(self):
         in_file = FindSearchPaths(soak_db_filepath=self.soak_db_filepath, date_time=self.date_time).output().path
         print(in_file)
+        if self.parallel:
+            # the runs are loaded in run(), so the soakdb transfers (done by FindPanddaLogs for each search path
+            # otherwise) have to be done first, or the events have no crystals to go to
+            return [FindSearchPaths(soak_db_filepath=self.soak_db_filepath, date_time=self.date_time),
+                    StartTransfers(soak_db_filepath=self.soak_db_filepath)]
         if not os.path.isfile(in_file):
             return FindSearchPaths(soak_db_filepath=self.soak_db_filepath, date_time=self.date_time)
         else:
-            frame = pd.DataFrame.from_csv(in_file)
+            frame = csv_functions.read_frame(in_file, 'search_paths')
             return [AddPanddaData(search_path=search_path, soak_db_filepath=filepath, sdbfile=sdbfile) for
                     search_path, filepath, sdbfile in list(
                     zip(frame['search_path'], frame['soak_db_filepath'], frame['sdbfile']))]
@@ -416,8 +470,23 @@ class TransferPandda(luigi.Task):
                                                   + '_transferred.txt')))
 
     def run(self):
+        report = ''
+        if self.parallel:
+            pdb_functions.set_ligand_cache(os.path.join(DirectoriesConfig().log_directory, 'ligand_cache.sqlite'))
+            frame = csv_functions.read_frame(self.input()[0].path, 'search_paths')
+            results = transfer_pandda_parallel(list(zip(frame['search_path'], frame['sdbfile'])),
+                                               PanddaConfig().workers, PanddaConfig().writers)
+            failed = [log_file for log_file, _, _, _, error in results if error]
+            if failed:
+                raise Exception(str('Pandda runs failed to load: ' + ', '.join(failed)))
+
+            # time taken for each analysis
+            report = ''.join([str(','.join([log_file, str(round(read_seconds, 2)), str(round(write_seconds, 2)),
+                                            str(counts.get('events', '')), str(counts.get('skipped', ''))]) + '\n')
+                              for log_file, read_seconds, write_seconds, counts, _ in results])
+
         with self.output().open('w') as f:
-            f.write('')
+            f.write(report)
 
 
 class AnnotateEvents(luigi.Task):
@@ -434,30 +503,7 @@ class AnnotateEvents(luigi.Task):
         return luigi.LocalTarget(str(self.soakdb_filename + '_' + mod_date + '.events'))
 
     def run(self):
-        events = PanddaEvent.objects.filter(crystal__visit__filename=self.soakdb_filename)
-
-        conn = sqlite3.connect(self.soakdb_filename)
-        conn.row_factory = sqlite3.Row
-        c = conn.cursor()
-
-        for e in events:
-
-            c.execute(
-                "select PANDDA_site_confidence, PANDDA_site_InspectConfidence from panddaTable where "
-                "CrystalName = ? and PANDDA_site_index = ? and PANDDA_site_event_index = ?",
-                (e.crystal.crystal_name, e.site.site, e.event)
-            )
-
-            results = c.fetchall()
-
-            if len(results) == 1:
-                e.ligand_confidence_inspect = results[0]['PANDDA_site_InspectConfidence']
-                e.ligand_confidence = results[0]['PANDDA_site_confidence']
-                e.ligand_confidence_source = 'SD'
-                e.save()
-
-            elif len(results) > 1:
-                raise Exception('too many events found in soakdb!')
+        db_functions.annotate_events(self.soakdb_filename)
 
         with self.output().open('w') as f:
             f.write('')
@@ -473,7 +519,7 @@ class AnnotateAllEvents(luigi.Task):
         if not os.path.isfile(in_file):
             return FindSearchPaths(soak_db_filepath=self.soak_db_filepath, date_time=self.date_time)
         else:
-            frame = pd.DataFrame.from_csv(in_file)
+            frame = csv_functions.read_frame(in_file, 'search_paths')
             return [AnnotateEvents(soakdb_filename=sdbfile) for
                     search_path, filepath, sdbfile in list(
                     zip(frame['search_path'], frame['soak_db_filepath'], frame['sdbfile']))]
@@ -1,8 +1,11 @@
 import csv
 import glob
-import re
+import multiprocessing
 import shutil
 import subprocess
+import time
+import traceback
+from concurrent.futures import ThreadPoolExecutor
 
 from setup_django import setup_django
 
@@ -13,11 +16,13 @@ import datetime
 import luigi
 import numpy as np
 from Bio.PDB import NeighborSearch, PDBParser, Atom, Residue
+from django.db import connections, transaction
+from django.db.models import Q
 from itertools import chain
 
-from functions import misc_functions, db_functions, proasis_api_funcs
+from functions import misc_functions, db_functions, proasis_api_funcs, cache_functions, pdb_functions
 from xchem_db.models import *
-from .config_classes import SoakDBConfig, DirectoriesConfig
+from .config_classes import SoakDBConfig, DirectoriesConfig, ProasisHitsConfig, UploadConfig
 from . import transfer_soakdb
 
 
@@ -35,205 +40,328 @@ class InitDBEntries(luigi.Task):
                                               self.date.strftime('proasis/proasis_db_%Y%m%d%H.txt')))
 
     def run(self):
-        fail_count = 0
-        # select anything 'in refinement' (3) or above
-        refinement = Refinement.objects.filter(outcome__gte=4)
-        # set up info for each entry that matches the filter
-        for obj in refinement:
-            # set up blank fields for entries in proasis hits table
-            bound_conf = ''
-            files = []
-            mtz = ''
-            two_fofc = ''
-            fofc = ''
-            mod_date = ''
-            proasis_hit_entry = ''
-            entry = ''
-            confs = []
-            ligand_list = []
-
-            # if there is a pdb file named in the bound_conf field, use it as the upload structure for proasis
-            if obj.bound_conf:
-                if os.path.isfile(obj.bound_conf):
-                    bound_conf = obj.bound_conf
-            # otherwise, use the most recent pdb file (according to soakdb)
-            elif obj.pdb_latest:
-                if os.path.isfile(obj.pdb_latest):
-                    # if this is from a refinement folder, find the bound-state pdb file, rather than the ensemble
-                    if 'Refine' in obj.pdb_latest:
-                        search_path = '/'.join(obj.pdb_latest.split('/')[:-1])
-                        files = glob.glob(str(search_path + '/refine*split.bound*.pdb'))
-                        if len(files) == 1:
-                            bound_conf = files[0]
-                    else:
-                        # if can't find bound state, just use the latest pdb file
-                        bound_conf = obj.pdb_latest
-            else:
-                # no pdb = no proasis upload (same for mtz, two_fofc and fofc)
-                # TODO: Turn this into a function instead of repeating file check
-                fail_count += 1
-                continue
-
-            mtz = db_functions.check_file_status('refine.mtz', bound_conf)
-            two_fofc = db_functions.check_file_status('2fofc.map', bound_conf)
-            fofc = db_functions.check_file_status('fofc.map', bound_conf)
-
-            if not mtz[0] or not two_fofc[0] or not fofc[0]:
-                fail_count += 1
-                continue
-
-            # if a suitable pdb file is found, then search for ligands
-            if bound_conf:
-                try:
-                    pdb_file = open(bound_conf, 'r')
-                    ligand_list = []
-                    for line in pdb_file:
-                        # ignore LIG in link for strange phenix format
-                        if "LIG" in line and 'LINK' not in line:
-                            try:
-                                # ligands identified by 'LIG', with preceeding '.' for alt conf letter
-                                lig_string = re.search(r".LIG.......", line).group()
-                                # just use lig string instead of separating into list items (to handle altconfs)
-                                ligand_list.append(lig_string)
-                            except:
-                                continue
-                # if no ligands are found in the pdb file, no upload to proasis (checked that no strucs. had alternative
-                # labels in them)
-                except:
-                    ligand_list = None
-
-            if not ligand_list:
-                continue
-
-            # get a unique list of ligands
-            unique_ligands = list(set(ligand_list))
-            # remove the first letter (alt conf) from unique ligands
-            lig_no_conf = [l[1:] for l in unique_ligands]
-
-            for l in lig_no_conf:
-                # check whether there are more than 1 entries for any of the lig strings without alt conf
-                if lig_no_conf.count(l) > 1:
-                    # this is an alt conf situation - add the alt confs to the conf list
-                    confs.extend([lig for lig in unique_ligands if l in lig])
-
-            # get the date the pdb file was modified
-            mod_date = misc_functions.get_mod_date(bound_conf)
-
-            if mod_date:
-                # if there's already an entry for that structure
-                if ProasisHits.objects.filter(refinement=obj, crystal_name=obj.crystal_name).exists():
-                    # if there are no alternate conformations
-                    if not confs:
-                        # get the relevant entry
-                        entries = ProasisHits.objects.filter(refinement=obj, crystal_name=obj.crystal_name)
-                        for entry in entries:
-                            # if the pdb file is older than the current one, or it has not been uploaded to proasis
-                            if entry.modification_date < mod_date or not entry.strucid:
-                                # delete structure and remove files to remove from proasis is strucid exists
-                                if entry.strucid:
-
-                                    proasis_out = ProasisOut.objects.filter(proasis=entry)
-                                    for o in proasis_out:
-                                        out_dir = os.path.join(o.root, o.start)
-                                        shutil.rmtree(out_dir)
-
-                                    proasis_api_funcs.delete_structure(entry.strucid)
-                                    entry.strucid = None
-                                    entry.save()
-
-                                    if self.hit_directory in entry.pdb_file:
-                                        os.remove(entry.pdb_file)
-                                    if self.hit_directory in entry.mtz:
-                                        os.remove(entry.mtz)
-                                    if self.hit_directory in entry.two_fofc:
-                                        os.remove(entry.two_fofc)
-                                    if self.hit_directory in entry.fofc:
-                                        os.remove(entry.fofc)
-
-                                # otherwise, just update the relevant fields
-                                entry.pdb_file = bound_conf
-                                entry.modification_date = mod_date
-                                entry.mtz = mtz[1]
-                                entry.two_fofc = two_fofc[1]
-                                entry.fofc = fofc[1]
-                                entry.ligand_list = unique_ligands
-                                entry.save()
-                    # if there ARE alternate conformations
-                    else:
-                        # for each conformation
-                        for conf in confs:
-                            # do the same as above, but setting the altconf field too
-                            # TODO: functionalise to add altconfs and not repeat method
-                            entry = ProasisHits.objects.get(refinement=obj, crystal_name=obj.crystal_name, altconf=conf)
-                            if entry.modification_date < mod_date or not entry.strucid:
-                                if entry.strucid:
-                                    proasis_out = ProasisOut.objects.filter(proasis=entry)
-                                    for o in proasis_out:
-                                        out_dir = os.path.join(o.root, o.start)
-                                        shutil.rmtree(out_dir)
-
-                                    proasis_api_funcs.delete_structure(entry.strucid)
-                                    entry.strucid = None
-                                    entry.save()
-                                    if self.hit_directory in entry.pdb_file:
-                                        os.remove(entry.pdb_file)
-                                    if self.hit_directory in entry.mtz:
-                                        os.remove(entry.mtz)
-                                    if self.hit_directory in entry.two_fofc:
-                                        os.remove(entry.two_fofc)
-                                    if self.hit_directory in entry.fofc:
-                                        os.remove(entry.fofc)
-
-                                entry.pdb_file = bound_conf
-                                entry.modification_date = mod_date
-                                entry.mtz = mtz[1]
-                                entry.two_fofc = two_fofc[1]
-                                entry.fofc = fofc[1]
-                                entry.ligand_list = unique_ligands
-                                entry.altconf = conf
-                                entry.save()
-
-                # if there's not already an entry for that structure
-                else:
-                    # if no altconfs
-                    if not confs:
-                        # create entry without an altconf
-                        ProasisHits.objects.get_or_create(refinement=obj,
-                                                          crystal_name=obj.crystal_name,
-                                                          pdb_file=bound_conf,
-                                                          modification_date=mod_date,
-                                                          mtz=mtz[1], two_fofc=two_fofc[1],
-                                                          fofc=fofc[1], ligand_list=unique_ligands)
-                    # if altconfs
-                    if confs:
-                        for conf in confs:
-                            # create an entry for each altconf
-                            # TODO: The pdb file will need to be edited later to pull out other altconfs of the same lig
-
-                            ProasisHits.objects.get_or_create(refinement=obj,
-                                                              crystal_name=obj.crystal_name,
-                                                              pdb_file=bound_conf,
-                                                              modification_date=mod_date,
-                                                              mtz=mtz[1], two_fofc=two_fofc[1],
-                                                              fofc=fofc[1],
-                                                              ligand_list=unique_ligands,
-                                                              altconf=conf)
-
-                dimple = Dimple.objects.filter(crystal_name=obj.crystal_name)
-                if dimple.count() == 1:
-                    if dimple[0].reference and dimple[0].reference.reference_pdb:
-                        if os.path.isfile(dimple[0].reference.reference_pdb):
-                            ProasisLeads.objects.get_or_create(reference_pdb=dimple[0].reference)
-                        else:
-                            if ProasisLeads.objects.filter(reference_pdb=dimple[0].reference).exists():
-                                print('removing...')
-                                proasis_lead_entry = ProasisLeads.objects.get(reference_pdb=dimple[0].reference)
-                                proasis_lead_entry.delete()
-
-        print(fail_count)
+        pdb_functions.set_ligand_cache(os.path.join(DirectoriesConfig().log_directory, 'ligand_cache.sqlite'))
+        # refinements at 'in refinement' (4) or above, with their dimple reference and existing hits, in one query
+        candidates = db_functions.hit_candidates()
+        # find the pdb file, maps and ligands for each one
+        probed = db_functions.probe_hits(candidates, workers=ProasisHitsConfig().workers)
+        changes = db_functions.hit_changes(probed)
+
+        # hits being updated or deleted that were already uploaded need removing from proasis first
+        retire_hits([hit for hit, _ in changes['update']] + changes['delete'], self.hit_directory)
+
+        db_functions.apply_hit_changes(changes)
+        leads_added, leads_removed = db_functions.reconcile_leads(probed)
+
+        report = {'candidates': len(probed), 'created': len(changes['create']), 'updated': len(changes['update']),
+                  'deleted': len(changes['delete']), 'unchanged': changes['unchanged'], 'leads_added': leads_added,
+                  'leads_removed': leads_removed}
+        for status in ['no_pdb', 'missing_files', 'no_ligands']:
+            report[status] = len([c for c in probed if c['status'] == status])
+
+        keys = sorted(report.keys())
+        print(', '.join([str(key + '=' + str(report[key])) for key in keys]))
 
         with self.output().open('w') as f:
-            f.write('')
+            f.write(str(','.join(keys) + '\n'))
+            f.write(str(','.join([str(report[key]) for key in keys]) + '\n'))
+
+
+def retire_hits(hits, hit_directory):
+    """
+    Remove the structures for hits that have been uploaded to proasis (the proasis entry, its output directories,
+    and the copies of its files in the hit directory) and clear their strucids. Hits with no strucid are left alone.
+    """
+    uploaded = [hit for hit in hits if hit.strucid]
+    if not uploaded:
+        return
+
+    outputs = {}
+    for o in ProasisOut.objects.filter(proasis_id__in=[hit.id for hit in uploaded]):
+        outputs.setdefault(o.proasis_id, []).append(o)
+
+    retired = []
+    try:
+        for hit in uploaded:
+            for o in outputs.get(hit.id, []):
+                shutil.rmtree(os.path.join(o.root, o.start))
+
+            proasis_api_funcs.delete_structure(hit.strucid)
+            hit.strucid = None
+            retired.append(hit)
+
+            for path in [hit.pdb_file, hit.mtz, hit.two_fofc, hit.fofc]:
+                if path and hit_directory in path and os.path.isfile(path):
+                    os.remove(path)
+    finally:
+        # whatever happens, don't leave strucids in the database for structures that are gone
+        ProasisHits.objects.filter(id__in=[hit.id for hit in retired]).update(strucid=None)
+
+
+def hit_submission(proasis_bound_pdb, unique_ligands, altconf, proasis_crystal_directory, crystal_name,
+                   target_name):
+    """
+    Write the pdb file to upload for a hit (with only the hit's altconf, or with the ligand's altconf letter removed)
+    and put together the submitStructure.py command to upload it.
+
+    Returns: the command
+    """
+    # if there's only one ligand in the ligand list, then easy upload; if altconf, is also uploading only one ligand
+    if len(unique_ligands) == 1 or altconf:
+        # set lig string and upload title - changed if altconf, remain same if not
+        lig_string = str(unique_ligands[0][1:])
+        title = crystal_name
+
+        # if there's an alternate conformation
+        # ignore for phenix refinements - weird
+        if altconf:
+            # write the pdb files for all of the altconfs in one pass (the other altconf hits of this structure use
+            # them too), keeping only this altconf's ligands
+            altconfs = pdb_functions.altconf_ligands(unique_ligands)
+            if altconf not in altconfs:
+                altconfs.append(altconf)
+            altconf_files = pdb_functions.split_altconfs(proasis_bound_pdb, unique_ligands, proasis_crystal_directory,
+                                                         altconfs=altconfs)
+
+            lig_string = altconf[1:]
+            proasis_bound_pdb = altconf_files[altconf]
+            title = str(crystal_name + '_alt_' + altconf.replace(' ', ''))
+
+        elif unique_ligands[0][1:][0] != ' ':
+            # remove the ligand's altconf letter
+            lig = unique_ligands[0]
+            print(proasis_bound_pdb)
+
+            proasis_pdb = proasis_bound_pdb.replace('.pdb', '_proasis.pdb')
+            pdb_functions.rewrite_pdb(proasis_bound_pdb, [(proasis_pdb, [], lig)])
+
+            proasis_bound_pdb = proasis_pdb
+
+        # see /usr/local/Proasis2/utils/submitStructure.py for explanation
+        return str("/usr/local/Proasis2/utils/submitStructure.py -d 'admin' -f " + "'" +
+                   str(proasis_bound_pdb) + "' -l '" + lig_string + "' -m " +
+                   str(os.path.join(proasis_crystal_directory, str(crystal_name) + '.sdf')) +
+                   " -p " + str(target_name) + " -t " + str(title) + " -x XRAY -N")
+
+    # same as above, but for structures containing more than one ligand
+    elif len(unique_ligands) > 1 and not altconf:
+        lig1 = unique_ligands[0][1:]
+        lign = " -o '"
+        for i in range(1, len(unique_ligands) - 1):
+            lign += str(unique_ligands[i][1:] + ',')
+        lign += str(unique_ligands[len(unique_ligands) - 1][1:] + "'")
+
+        return str("/usr/local/Proasis2/utils/submitStructure.py -d 'admin' -f " + "'" +
+                   str(proasis_bound_pdb) + "' -l '" + lig1 + "' " + lign + " -m " +
+                   str(os.path.join(proasis_crystal_directory, str(crystal_name) + '.sdf')) +
+                   " -p " + str(target_name) + " -t " + crystal_name + " -x XRAY -N")
+
+    raise Exception(str('no ligands to upload for ' + crystal_name))
+
+
+def add_hit_files(strucid, two_fofc, fofc, mtz, crystal_name):
+    # add the maps and mtz for a hit to its proasis structure
+    for file_type, filename, suffix in [('2fofc_c', two_fofc, '_2fofc'), ('fofc_c', fofc, '_fofc'),
+                                        ('mtz', mtz, '_mtz')]:
+        out, err = proasis_api_funcs.add_proasis_file(file_type=file_type, filename=str(filename), strucid=strucid,
+                                                      title=str(crystal_name + suffix))
+        if err:
+            raise Exception(err)
+        print(out)
+
+
+def pending_hits(hit_directory):
+    """
+    Everything needed to upload the hits that aren't in proasis yet, or whose maps and mtz weren't added to their
+    proasis structure, from two queries (the hits with their crystals, and the pandda events for those crystals), so
+    the uploads themselves don't touch the database.
+
+    Returns: list of dicts, one per hit
+    """
+    hits = ProasisHits.objects.filter(Q(strucid=None) | Q(strucid='') | Q(files_added=False)).select_related(
+        'crystal_name__target', 'crystal_name__compound')
+
+    events = {}
+    for event_id, crystal_id, event_map, model_pdb in PanddaEvent.objects.filter(
+            crystal_id__in=[hit.crystal_name_id for hit in hits]).order_by(
+            'crystal_id', 'pandda_event_map_native').distinct('crystal_id', 'pandda_event_map_native').values_list(
+            'id', 'crystal_id', 'pandda_event_map_native', 'pandda_model_pdb'):
+        events.setdefault(crystal_id, []).append((event_id, str(event_map), str(model_pdb)))
+
+    jobs = []
+    for hit in hits:
+        crystal = hit.crystal_name
+        target_name = str(crystal.target.target_name).upper()
+        jobs.append({'hit_id': hit.id, 'strucid': hit.strucid or None, 'crystal_id': crystal.id, 'crystal_name': str(crystal.crystal_name),
+                     'target_name': target_name, 'smiles': crystal.compound.smiles, 'altconf': hit.altconf,
+                     'ligands': eval(hit.ligand_list or '[]'), 'events': events.get(crystal.id, []),
+                     'files': {'pdb_file': hit.pdb_file, 'two_fofc': hit.two_fofc, 'fofc': hit.fofc, 'mtz': hit.mtz},
+                     'directory': os.path.join(hit_directory, target_name, str(crystal.crystal_name), 'input/')})
+
+    return jobs
+
+
+def prepare_hit(job):
+    """
+    The file preparation for uploading one hit, in a worker process (as CopyFile, GetPanddaMaps, GenerateSdf and
+    the start of UploadHit do): copy its files to the hit directory, link its pandda maps and models, write its sdf
+    and the pdb file to upload. Nothing here touches the database.
+
+    Returns: (job, dict of what to record in the database and the command to submit, seconds, traceback or None)
+    """
+    start = time.time()
+    try:
+        directory = job['directory']
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+        # copy the file (symlinking effs up output file)
+        files = {}
+        for field, filename in job['files'].items():
+            files[field] = os.path.join(directory, str(filename).split('/')[-1])
+            if os.path.abspath(str(filename)) != os.path.abspath(files[field]):
+                shutil.copy(str(filename), files[field])
+
+        # symlink pandda event maps and models instead of copying - save space
+        pandda = []
+        for event_id, event_map, model_pdb in job['events']:
+            for source in [event_map, model_pdb]:
+                link = os.path.join(directory, source.split('/')[-1])
+                if os.path.lexists(link):
+                    os.remove(link)
+                os.symlink(source, link)
+            pandda.append((event_id, os.path.join(directory, str(event_map.split('/')[-1] + '.tar.gz')),
+                           os.path.join(directory, model_pdb.split('/')[-1])))
+
+        # take the smiles string for the ligand and create an sdfile (this is the same for altconfs)
+        sdf = os.path.join(directory, str(job['crystal_name'] + '.sdf'))
+        if not os.path.isfile(sdf):
+            misc_functions.create_sd_file(job['crystal_name'], job['smiles'], sdf)
+
+        command = hit_submission(files['pdb_file'], job['ligands'], job['altconf'], directory, job['crystal_name'],
+                                 job['target_name'])
+
+        prepared = {'files': files, 'sdf': sdf, 'pandda': pandda, 'command': command}
+        error = None
+    except:
+        prepared = None
+        error = traceback.format_exc()
+
+    return job, prepared, time.time() - start, error
+
+
+def submit_hit(job, prepared=None):
+    """
+    Submit a prepared hit to proasis and add its maps and mtz (as UploadHit and AddFiles do), in a submitter thread.
+    A hit that is already in proasis (job['strucid']) just has its maps and mtz added.
+
+    Returns: (strucid, or None if the structure wasn't made, whether the maps and mtz were added, seconds, traceback
+    or None)
+    """
+    start = time.time()
+    strucid = job['strucid']
+    files_added = False
+    try:
+        if strucid:
+            files = job['files']
+        else:
+            files = prepared['files']
+            strucid, err, out = proasis_api_funcs.submit_proasis_job_string(prepared['command'])
+            if 'strucid' not in out:
+                raise Exception(str(prepared['command'] + '\n' + out))
+            if err:
+                raise Exception(err)
+        add_hit_files(strucid, files['two_fofc'], files['fofc'], files['mtz'], job['crystal_name'])
+        files_added = True
+        error = None
+    except:
+        error = traceback.format_exc()
+
+    return strucid or None, files_added, time.time() - start, error
+
+
+def record_uploads(uploaded):
+    # write what happened to uploaded hits (list of (job, prepared, strucid, files_added)) to the database in bulk:
+    # the files and strucids of those that were submitted, and whether the maps and mtz were added for all of them
+    # (prepared is None for hits that were already in proasis)
+    hits = []
+    files_added_hits = []
+    pandda = []
+    for job, prepared, strucid, files_added in uploaded:
+        if prepared is None:
+            files_added_hits.append(ProasisHits(id=job['hit_id'], files_added=files_added))
+            continue
+        hits.append(ProasisHits(id=job['hit_id'], sdf=prepared['sdf'], strucid=strucid, files_added=files_added,
+                                **prepared['files']))
+        pandda.extend([ProasisPandda(crystal_id=job['crystal_id'], hit_id=job['hit_id'], event_id=event_id,
+                                     event_map_native=event_map, model_pdb=model_pdb)
+                       for event_id, event_map, model_pdb in prepared['pandda']])
+
+    with transaction.atomic():
+        db_functions.bulk_update_rows(ProasisHits, hits, ['pdb_file', 'two_fofc', 'fofc', 'mtz', 'sdf', 'strucid',
+                                                          'files_added'])
+        db_functions.bulk_update_rows(ProasisHits, files_added_hits, ['files_added'])
+        db_functions.bulk_upsert(ProasisPandda, pandda, ['crystal', 'hit', 'event'])
+
+
+def upload_hits_parallel(hit_directory, workers, submitters):
+    """
+    Upload every hit that isn't in proasis yet: files are prepared by a pool of worker processes, and structures
+    submitted to proasis by a few submitter threads as soon as they are ready. Strucids (and the new file paths) are
+    recorded in bulk at the end - including if something goes wrong part way, so nothing is uploaded twice. Hits
+    that are in proasis but whose maps and mtz couldn't be added have them added again.
+
+    Returns: a list of (crystal name, altconf, strucid, seconds preparing, seconds submitting, traceback or None)
+    """
+    start = time.time()
+    jobs = pending_hits(hit_directory)
+    print(str(str(len(jobs)) + ' hits to upload'))
+    if not jobs:
+        return []
+
+    # connections can't be shared with forked processes
+    connections.close_all()
+    pdb_functions.set_ligand_cache(os.path.join(DirectoriesConfig().log_directory, 'ligand_cache.sqlite'))
+
+    def submit(job, prepared, prepare_seconds):
+        strucid, files_added, submit_seconds, error = submit_hit(job, prepared)
+        return job, prepared, strucid, files_added, prepare_seconds, submit_seconds, error
+
+    results = []
+    futures = []
+    try:
+        with ThreadPoolExecutor(max_workers=submitters) as executor:
+            # hits already in proasis only need their maps and mtz adding
+            futures.extend([executor.submit(submit, job, None, 0) for job in jobs if job['strucid']])
+            with multiprocessing.get_context('fork').Pool(processes=workers) as pool:
+                for job, prepared, prepare_seconds, error in pool.imap_unordered(
+                        prepare_hit, [job for job in jobs if not job['strucid']]):
+                    if error:
+                        results.append((job, None, None, False, prepare_seconds, 0, error))
+                        continue
+                    futures.append(executor.submit(submit, job, prepared, prepare_seconds))
+    finally:
+        # leaving the executor waits for the submissions already started, even if preparing the rest failed
+        results.extend([future.result() for future in futures])
+        record_uploads([(job, prepared, strucid, files_added)
+                        for job, prepared, strucid, files_added, _, _, _ in results if prepared or job['strucid']])
+
+    for job, _, strucid, files_added, prepare_seconds, submit_seconds, error in results:
+        print(str(job['crystal_name'] + ' ' + str(job['altconf']) + ': ' + str(strucid) + ', files added: ' +
+                  str(files_added) + ', prepared in ' + str(round(prepare_seconds, 2)) + 's, submitted in ' +
+                  str(round(submit_seconds, 2)) + 's'))
+        if error:
+            print(error)
+
+    minutes = (time.time() - start) / 60
+    uploaded = len([r for r in results if r[3]])
+    print(str('Uploaded ' + str(uploaded) + ' of ' + str(len(jobs)) + ' hits with ' + str(workers) + ' workers and ' +
+              str(submitters) + ' submitters in ' + str(round(minutes, 2)) + ' minutes (' +
+              str(round(uploaded / max(minutes, 1e-6), 1)) + ' structures/minute, ' +
+              str(len([r for r in results if r[6]])) + ' failed)'))
+
+    return [(job['crystal_name'], job['altconf'], strucid, prepare_seconds, submit_seconds, error)
+            for job, _, strucid, _, prepare_seconds, submit_seconds, error in results]
 
 
 class AddProject(luigi.Task):
@@ -727,92 +855,18 @@ class UploadHit(luigi.Task):
 
         # eval the list saved in the table to reproduce a python list
         unique_ligands = eval(proasis_hit.ligand_list)
-        proasis_bound_pdb = proasis_hit.pdb_file
-
-        # if there's only one ligand in the ligand list, then easy upload; if altconf, is also uploading only one ligand
-        if len(unique_ligands) == 1 or self.altconf:
-            # set lig string and upload title - changed if altconf, remain same if not
-            lig_string = str(unique_ligands[0][1:])
-            title = crystal_name
-
-            # if there's an alternate conformation
-            # ignore for phenix refinements - weird
-            if self.altconf:
-                    #and 'PHENIX refinement' not in open(proasis_bound_pdb, 'r').read():
-                # set name for altconf pdb file
-                altconf_pdb_file = str(proasis_crystal_directory + proasis_bound_pdb.split('/')[-1].replace(
-                    '.pdb', str('_' + self.altconf.replace(' ', '') + '.pdb')))
-
-                # remove if exists so not appending to existing file
-                if os.path.isfile(altconf_pdb_file):
-                    os.remove(altconf_pdb_file)
-
-                # remove the current altconf from the ligands list
-                ligands = [lig for lig in unique_ligands if lig != self.altconf]
-
-                # remove ligands that are not the altconf from the bound state pdb and save as new pdb for upload
-                for line in open(proasis_bound_pdb, 'r'):
-                    if any(lig in line for lig in ligands):
-                        continue
-                    else:
-                        # get rid of preceeding altconf letter to make sure correct format for proasis
-                        if self.altconf in line:
-                            line = line.replace(self.altconf, str(' ' + self.altconf[1:]))
-
-                        with open(altconf_pdb_file, 'a') as f:
-                            f.write(line)
-
-                lig_string = self.altconf[1:]
-                proasis_bound_pdb = altconf_pdb_file
-                title = str(crystal_name + '_alt_' + self.altconf.replace(' ', ''))
-
-            elif unique_ligands[0][1:][0] != ' ':
-                lig = unique_ligands[0]
-                newlines = ''
-                for line in open(proasis_bound_pdb, 'r'):
-                    if lig in line:
-                        line = line.replace(lig, str(' ' + lig[1:]))
-                    newlines += line
-
-                print(proasis_bound_pdb)
-
-                with open(proasis_bound_pdb.replace('.pdb', '_proasis.pdb'), 'w') as f:
-                    f.write(newlines)
-
-                proasis_bound_pdb = proasis_bound_pdb.replace('.pdb', '_proasis.pdb')
-
-            # see /usr/local/Proasis2/utils/submitStructure.py for explanation
-            submit_to_proasis = str("/usr/local/Proasis2/utils/submitStructure.py -d 'admin' -f " + "'" +
-                                    str(proasis_bound_pdb) + "' -l '" + lig_string + "' -m " +
-                                    str(os.path.join(proasis_crystal_directory, str(crystal_name) + '.sdf')) +
-                                    " -p " + str(target_name) + " -t " + str(title) + " -x XRAY -N")
-            print(submit_to_proasis)
-            # submit the structure to proasis
-            strucid, err, out = proasis_api_funcs.submit_proasis_job_string(submit_to_proasis)
 
-            if 'strucid' not in out:
-                raise Exception(str(submit_to_proasis + '\n' + out))
-            print(out)
+        pdb_functions.set_ligand_cache(os.path.join(DirectoriesConfig().log_directory, 'ligand_cache.sqlite'))
 
-        # same as above, but for structures containing more than one ligand
-        elif len(unique_ligands) > 1 and not self.altconf:
-            lig1 = unique_ligands[0][1:]
-            lign = " -o '"
-            for i in range(1, len(unique_ligands) - 1):
-                lign += str(unique_ligands[i][1:] + ',')
-            lign += str(unique_ligands[len(unique_ligands) - 1][1:] + "'")
-
-            submit_to_proasis = str("/usr/local/Proasis2/utils/submitStructure.py -d 'admin' -f " + "'" +
-                                    str(proasis_bound_pdb) + "' -l '" + lig1 + "' " + lign + " -m " +
-                                    str(os.path.join(proasis_crystal_directory, str(crystal_name) + '.sdf')) +
-                                    " -p " + str(target_name) + " -t " + crystal_name + " -x XRAY -N")
-            print(submit_to_proasis)
-
-            strucid, err, out = proasis_api_funcs.submit_proasis_job_string(submit_to_proasis)
+        submit_to_proasis = hit_submission(proasis_hit.pdb_file, unique_ligands, self.altconf,
+                                           proasis_crystal_directory, crystal_name, target_name)
+        print(submit_to_proasis)
+        # submit the structure to proasis
+        strucid, err, out = proasis_api_funcs.submit_proasis_job_string(submit_to_proasis)
 
-            if 'strucid' not in out:
-                raise Exception(str(submit_to_proasis + '\n' + out))
-            print(out)
+        if 'strucid' not in out:
+            raise Exception(str(submit_to_proasis + '\n' + out))
+        print(out)
 
         # warn_string = 'WARNING: Unable to compute the correct chemistry of the ligand from the pdb file'
         #
@@ -824,8 +878,9 @@ class UploadHit(luigi.Task):
         #
         #     strucid, err, out = proasis_api_funcs.submit_proasis_job_string(submit_to_proasis)
 
-        # add strucid to database
+        # add strucid to database (the maps and mtz are added by AddFiles)
         proasis_hit.strucid = strucid
+        proasis_hit.files_added = False
         proasis_hit.save()
 
         if not err:
@@ -869,32 +924,10 @@ class AddFiles(luigi.Task):
 
         # proasis_pandda = ProasisPandda.objects.filter(hit=proasis_hit)
 
-        strucid = proasis_hit.strucid
-
-        out, err = proasis_api_funcs.add_proasis_file(file_type='2fofc_c',
-                                                      filename=str(proasis_hit.two_fofc),
-                                                      strucid=strucid, title=str(proasis_hit.crystal_name.crystal_name
-                                                                                 + '_2fofc'))
-
-        if err:
-            raise Exception(err)
-        print(out)
-
-        out, err = proasis_api_funcs.add_proasis_file(file_type='fofc_c',
-                                                      filename=str(proasis_hit.fofc),
-                                                      strucid=strucid, title=str(proasis_hit.crystal_name.crystal_name
-                                                                                 + '_fofc'))
-        if err:
-            raise Exception(err)
-        print(out)
-
-        out, err = proasis_api_funcs.add_proasis_file(file_type='mtz',
-                                                      filename=str(proasis_hit.mtz),
-                                                      strucid=strucid, title=str(proasis_hit.crystal_name.crystal_name
-                                                                                 + '_mtz'))
-        if err:
-            raise Exception(err)
-        print(out)
+        add_hit_files(proasis_hit.strucid, proasis_hit.two_fofc, proasis_hit.fofc, proasis_hit.mtz,
+                      proasis_hit.crystal_name.crystal_name)
+        proasis_hit.files_added = True
+        proasis_hit.save()
 
         # TODO: Add this back in at some point. Skip for now as no option for native maps
         # for entry in proasis_pandda:
@@ -910,8 +943,20 @@ class AddFiles(luigi.Task):
 class UploadHits(luigi.Task):
     date = luigi.DateParameter(default=datetime.datetime.now())
     hit_directory = luigi.Parameter(default=DirectoriesConfig().hit_directory)
+    # upload the hits with a pool of UploadConfig().workers processes preparing files and UploadConfig().submitters
+    # submitting to proasis, rather than a chain of tasks per hit
+    parallel = luigi.BoolParameter(default=False)
+
+    @property
+    def resources(self):
+        if self.parallel:
+            return {'django': 1}
+        return {}
 
     def requires(self):
+        if self.parallel:
+            # the hits are uploaded in run() in parallel mode
+            return UploadLeads()
         hits1 = ProasisHits.objects.filter(strucid=None)
         hits2 = ProasisHits.objects.filter(strucid='')
         hits = chain(hits1, hits2)
@@ -932,8 +977,21 @@ class UploadHits(luigi.Task):
                                               self.date.strftime('proasis/hits/proasis_hits_%Y%m%d%H.txt')))
 
     def run(self):
+        report = ''
+        if self.parallel:
+            results = upload_hits_parallel(self.hit_directory, UploadConfig().workers, UploadConfig().submitters)
+            failed = [str(crystal_name + ' ' + str(altconf)) for crystal_name, altconf, _, _, _, error in results
+                      if error]
+            if failed:
+                raise Exception(str('Hits failed to upload: ' + ', '.join(failed)))
+
+            # time taken for each hit
+            report = ''.join([str(','.join([crystal_name, str(altconf or ''), str(strucid),
+                                            str(round(prepare_seconds, 2)), str(round(submit_seconds, 2))]) + '\n')
+                              for crystal_name, altconf, strucid, prepare_seconds, submit_seconds, _ in results])
+
         with self.output().open('w') as f:
-            f.write('')
+            f.write(report)
 
 
 class WriteBlackLists(luigi.Task):
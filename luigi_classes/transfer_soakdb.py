@@ -1,5 +1,7 @@
 import glob
+import multiprocessing
 import shutil
+import time
 import traceback
 from sqlite3 import OperationalError
 
@@ -9,12 +11,14 @@ setup_django()
 
 import datetime
 import luigi
+from django.db import connections
 
+from functions import crawl_functions
 from functions import db_functions
 from functions import misc_functions
 from functions.pandda_functions import *
 from xchem_db.models import *
-from .config_classes import SoakDBConfig, DirectoriesConfig
+from .config_classes import SoakDBConfig, DirectoriesConfig, CrawlConfig, TransferConfig
 
 from dateutil.parser import parse
 
@@ -27,31 +31,165 @@ def is_date(string):
         return False
 
 
-def transfer_file(data_file):
-    maint_exists = db_functions.check_table_sqlite(data_file, 'mainTable')
-    if maint_exists == 1:
-        db_functions.transfer_table(translate_dict=db_functions.crystal_translations(), filename=data_file,
-                                    model=Crystal)
-        db_functions.transfer_table(translate_dict=db_functions.lab_translations(), filename=data_file,
-                                    model=Lab)
-        db_functions.transfer_table(translate_dict=db_functions.refinement_translations(), filename=data_file,
-                                    model=Refinement)
-        db_functions.transfer_table(translate_dict=db_functions.dimple_translations(), filename=data_file,
-                                    model=Dimple)
-        db_functions.transfer_table(translate_dict=db_functions.data_processing_translations(),
-                                    filename=data_file, model=DataProcessing)
+def remove_proasis_files(crystals, hit_directory):
+    # remove the proasis hits, their output directories and upload logs for a set of crystals
+    for crystal in crystals:
+        target_name = str(crystal.target.target_name).upper()
+        crystal_name = str(crystal.crystal_name)
+        proasis_crystal_directory = os.path.join(hit_directory, target_name.upper(), crystal_name)
+
+        if ProasisHits.objects.filter(crystal_name=crystal).exists():
+            proasis_hit = ProasisHits.objects.filter(crystal_name=crystal)
+            for hit in proasis_hit:
+                for path in glob.glob(os.path.join(DirectoriesConfig().log_directory, 'proasis/hits',
+                                                   str(hit.crystal_name.crystal_name +
+                                                       '_' + hit.modification_date + '*'))):
+                    os.remove(path)
+                if os.path.isdir(proasis_crystal_directory):
+                    shutil.rmtree(os.path.join(proasis_crystal_directory), ignore_errors=True)
+
+                if ProasisOut.objects.filter(proasis=hit).exists:
+                    for obj in ProasisOut.objects.filter(proasis=hit):
+                        if obj.root:
+                            delete_files = ['verne.transferred', 'PROPOSALS', 'VISITS', 'visits_proposals.done']
+                            for f in delete_files:
+                                if os.path.isfile(os.path.join(obj.root, '/'.join(obj.start.split('/')[:-2]),
+                                                               f)):
+                                    os.remove(os.path.join(obj.root, '/'.join(obj.start.split('/')[:-2]), f))
+                            shutil.rmtree(os.path.join(obj.root, obj.start))
+                        obj.delete()
+                hit.delete()
+
+
+def reset_pandda_markers(data_file):
+    # for pandda file finding
+    split_path = data_file.split('database')
+    search_path = split_path[0]
+
+    # remove pandda data transfer done file
+    if os.path.isfile(os.path.join(search_path, 'transfer_pandda_data.done')):
+        os.remove(os.path.join(search_path, 'transfer_pandda_data.done'))
+
+    log_files = find_log_files(search_path).rsplit()
+    print(log_files)
+
+    # without fingerprints, every run is loaded again
+    PanddaRunFingerprint.objects.filter(pandda_run__pandda_log__in=log_files).delete()
+
+    for log in log_files:
+        print(str(log + '.run.done'))
+        if os.path.isfile(str(log + '.run.done')):
+            os.remove(str(log + '.run.done'))
+        if os.path.isfile(str(log + '.sites.done')):
+            os.remove(str(log + '.sites.done'))
+        if os.path.isfile(str(log + '.events.done')):
+            os.remove(str(log + '.events.done'))
+
+    find_logs_out_files = glob.glob(str(search_path + '*.txt'))
+
+    for f in find_logs_out_files:
+        if is_date(f.replace(search_path, '').replace('.txt', '')):
+            os.remove(f)
+
+
+def transfer_file(data_file, incremental=False, hit_directory=None):
+    # get the modification date before reading, so a write during the transfer is picked up next time
+    modification_date = misc_functions.get_mod_date(data_file)
+
+    # one read-only connection for everything read from the file
+    conn = db_functions.soakdb_connection(data_file)
+    try:
+        maint_exists = db_functions.check_table_sqlite(data_file, 'mainTable', conn=conn)
+        if maint_exists == 1:
+            stats = db_functions.transfer_soakdb_file(data_file, incremental=incremental, conn=conn)
+
+            # crystals that have been removed from the file
+            if stats['stale']:
+                stale = Crystal.objects.filter(id__in=stats['stale'])
+                print(str('Removing ' + str(len(stats['stale'])) + ' crystals no longer in ' + data_file))
+                db_functions.invalidate_pandda_events(stale)
+                if hit_directory:
+                    remove_proasis_files(stale, hit_directory)
+                stale.delete()
+    finally:
+        conn.close()
 
     soakdb_query = SoakdbFiles.objects.get(filename=data_file)
+    if modification_date != 'None':
+        soakdb_query.modification_date = modification_date
     soakdb_query.status = 2
     soakdb_query.save()
 
 
+def transferred_marker(data_file):
+    # the output of TransferNewDataFile/TransferChangedDataFile for a file
+    return str(data_file + '_' + str(misc_functions.get_mod_date(data_file)) + '.transferred')
+
+
+def transfer_worker(job):
+    # transfer one file in a worker process - the database connection is opened by the worker on first use
+    data_file, changed, hit_directory = job
+    start = time.time()
+    try:
+        marker = transferred_marker(data_file)
+        transfer_file(data_file, incremental=changed, hit_directory=hit_directory)
+        with open(marker, 'w') as f:
+            f.write('')
+        error = None
+    except:
+        error = traceback.format_exc()
+    finally:
+        connections.close_all()
+
+    return data_file, time.time() - start, error
+
+
+def transfer_files_parallel(new_files, changed_files, hit_directory, workers):
+    """
+    Transfer new and changed soakdb files with a pool of worker processes, each with its own database connection.
+    Targets, compounds and references shared between files are created first, so the workers never insert the same
+    row. Files that fail keep their status, and are picked up again by the next run.
+
+    Returns: a list of (file, seconds, traceback or None)
+    """
+    jobs = [(data_file, False, hit_directory) for data_file in new_files] + \
+           [(data_file, True, hit_directory) for data_file in changed_files]
+    if not jobs:
+        return []
+
+    start = time.time()
+
+    print(str('Created ' + str(db_functions.create_shared_rows([job[0] for job in jobs])) +
+              ' targets/compounds/references'))
+
+    # connections can't be shared with forked processes
+    connections.close_all()
+
+    results = []
+    with multiprocessing.get_context('fork').Pool(processes=workers) as pool:
+        for data_file, seconds, error in pool.imap_unordered(transfer_worker, jobs):
+            print(str(data_file + ': ' + str(round(seconds, 2)) + 's'))
+            if error:
+                print(error)
+            results.append((data_file, seconds, error))
+
+    elapsed = time.time() - start
+    serial = sum([seconds for _, seconds, _ in results])
+    print(str('Transferred ' + str(len(jobs)) + ' files with ' + str(workers) + ' workers in ' +
+              str(round(elapsed, 2)) + 's (' + str(round(serial, 2)) + 's of transfers, ' +
+              str(len([r for r in results if r[2]])) + ' failed)'))
+
+    return results
+
+
 class FindSoakDBFiles(luigi.Task):
     # date parameter - needs to be changed
     date = luigi.DateParameter(default=datetime.datetime.now())
 
     # filepath parameter can be changed elsewhere
     filepath = luigi.Parameter(default=SoakDBConfig().default_path)
+    # ignore the crawl index, and read every directory again
+    full_walk = luigi.BoolParameter(default=False)
 
     def output(self):
         return luigi.LocalTarget(os.path.join(DirectoriesConfig().log_directory,
@@ -59,20 +197,17 @@ class FindSoakDBFiles(luigi.Task):
 
     def run(self):
         # maybe change to *.sqlite to find renamed files? - this will probably pick up a tonne of backups
-        command = str(
-            '''find ''' + self.filepath + ''' -maxdepth 5 -path "*/lab36/*" -prune -o -path "*/tmp/*" -prune -o -path "*BACKUP*" -prune -o -path "*/initial_model/*" -prune -o -path "*/beamline/*" -prune -o -path "*/analysis/*" -prune -o -path "*ackup*" -prune -o -path "*ack*" -prune -o -path "*old*" -prune -o -path "*TeXRank*" -prune -o -name "soakDBDataFile.sqlite" -print''')
-        process = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE, shell=True)
-        print(command)
-
-        # run process to find sqlite files
-        out, err = process.communicate()
-        out = out.decode('ascii')
+        # directories that haven't changed since the last crawl are listed from the crawl index
+        found, stats = crawl_functions.crawl_path(self.filepath, searches=('soakdb',), workers=CrawlConfig().workers,
+                                                  index_file=os.path.join(DirectoriesConfig().log_directory,
+                                                                          'crawl_index.sqlite'),
+                                                  full_walk=self.full_walk)
         print('OUTPUT:')
-        print(out)
+        print('\n'.join(found['soakdb']))
 
         # write filepaths to file as output
         with self.output().open('w') as f:
-            f.write(str(out))
+            f.write(''.join([str(datafile + '\n') for datafile in found['soakdb']]))
 
 
 class CheckFiles(luigi.Task):
@@ -82,9 +217,7 @@ class CheckFiles(luigi.Task):
 
     def requires(self):
         print('Finding soakdb files via CheckFiles')
-        soakdb = list(SoakdbFiles.objects.all())
-
-        if not soakdb:
+        if not SoakdbFiles.objects.exists():
             return [TransferAllFedIDsAndDatafiles(soak_db_filepath=self.soak_db_filepath),
                     FindSoakDBFiles(filepath=self.soak_db_filepath)]
         else:
@@ -96,9 +229,6 @@ class CheckFiles(luigi.Task):
             self.date.strftime('checked_files/files_%Y%m%d%H.checked')))
 
     def run(self):
-        # a list to hold filenames that have been checked
-        checked = []
-
         # Status codes:-
         # 0 = new
         # 1 = changed
@@ -108,83 +238,63 @@ class CheckFiles(luigi.Task):
         print(self.input()[1].path)
 
         with open(self.input()[1].path, 'r') as f:
-            files = f.readlines()
+            # remove any newline characters
+            files = sorted(set([filename.rstrip('\n') for filename in f.readlines() if filename.rstrip('\n')]))
             print('FILES:')
             print(files)
 
+        # everything already in the soakdb table (filename is unique), in one query
+        known = dict((filename, (proposal_id, visit, modification_date)) for filename, proposal_id, visit,
+                     modification_date in SoakdbFiles.objects.values_list('filename', 'proposal_id', 'visit',
+                                                                          'modification_date'))
+
+        # files that are not in the database at all
+        new_files = [filename for filename in files if filename not in known.keys()]
+        new_proposals = dict((filename, db_functions.get_visit_proposal(filename)) for filename in new_files)
+        # add the proposals (with fedids) for the new files
+        db_functions.update_proposal_fedids([proposal for _, proposal in new_proposals.values()])
+        proposal_ids = dict((proposal, obj.id) for proposal, obj in Proposals.objects.in_bulk(
+            list(set([proposal for _, proposal in new_proposals.values()])), field_name='proposal').items())
+
+        to_write = []
+
+        for filename in new_files:
+            visit, proposal = new_proposals[filename]
+            # status 0, indicating it as a new file
+            to_write.append(SoakdbFiles(filename=filename, modification_date=misc_functions.get_mod_date(filename),
+                                        proposal_id=proposal_ids[proposal], visit=visit, status=0))
+
         for filename in files:
-            # remove any newline characters
-            filename_clean = filename.rstrip('\n')
-            # find the relevant entry in the soakdbfiles table
-
-            soakdb_query = list(SoakdbFiles.objects.filter(filename=filename_clean))
-
-            print(len(soakdb_query))
-
-            # raise an exception if the file is not in the soakdb table
-            if len(soakdb_query) == 0:
-                print('LEN=0')
-                out, err, prop = db_functions.pop_soakdb(filename_clean)
-                db_functions.pop_proposals(prop)
-
-            # only one entry should exist per file
-            if len(soakdb_query) == 1:
-                print('LEN=1')
-                # get the filename back from the query
-                data_file = soakdb_query[0].filename
-                # add the file to the list of those that have been checked
-                checked.append(data_file)
-                # get the modification date as stored in the db
-                old_mod_date = soakdb_query[0].modification_date
-                # get the current modification date of the file
-                current_mod_date = misc_functions.get_mod_date(data_file)
-                # get the id of the entry to write to
-                id_number = soakdb_query[0].id
-
-                print(old_mod_date)
-                if not old_mod_date:
-                    soakdb_query[0].modification_date = current_mod_date
-                    soakdb_query[0].save()
-                    old_mod_date = 0
-                print(current_mod_date)
-
-                # if the file has changed since the db was last updated for the entry, change status to indicate this
-                try:
-                    if int(current_mod_date) > int(old_mod_date):
-                        update_status = SoakdbFiles.objects.get(id=id_number)
-                        update_status.status = 1
-                        update_status.save()
-                except ValueError:
-                    raise Exception(str('current_mod_date: ' + str(current_mod_date)
-                                        + ', old_mod_date: ' + str(old_mod_date)))
-
-            # if there is more than one entry, raise an exception (should never happen - filename field is unique)
-            if len(soakdb_query) > 1:
-                raise Exception('More than one entry for file! Something has gone wrong!')
-
-            # if the file is not in the database at all
-            if filename_clean not in checked:
-                # add the file to soakdb
-                out, err, proposal = db_functions.pop_soakdb(filename_clean)
-                # add the proposal to proposal
-                db_functions.pop_proposals(proposal)
-                # retrieve the new db entry
-                soakdb_query = list(SoakdbFiles.objects.filter(filename=filename_clean))
-                # get the id to update
-                id_number = soakdb_query[0].id
-                # update the relevant status to 0, indicating it as a new file
-                update_status = SoakdbFiles.objects.get(id=id_number)
-                update_status.status = 0
-                update_status.save()
+            if filename not in known.keys():
+                continue
+            proposal_id, visit, old_mod_date = known[filename]
+            # get the current modification date of the file
+            current_mod_date = misc_functions.get_mod_date(filename)
+
+            if not old_mod_date:
+                old_mod_date = 0
+                modification_date = current_mod_date
+            else:
+                modification_date = old_mod_date
+
+            # if the file has changed since the db was last updated for the entry, change status to indicate this
+            try:
+                if int(current_mod_date) > int(old_mod_date):
+                    to_write.append(SoakdbFiles(filename=filename, modification_date=modification_date,
+                                                proposal_id=proposal_id, visit=visit, status=1))
+            except ValueError:
+                raise Exception(str('current_mod_date: ' + str(current_mod_date)
+                                    + ', old_mod_date: ' + str(old_mod_date)))
+
+        # write the new files and the status changes in one go - unchanged files are left alone
+        inserted, updated = db_functions.bulk_upsert(SoakdbFiles, to_write, conflict_fields=['filename'],
+                                                     update_fields=['modification_date', 'status'])
+        print(str(str(len(files)) + ' files checked: ' + str(inserted) + ' new, ' + str(updated) + ' changed'))
 
         # if the lab table is empty, no data has been transferred from the datafiles, so set status of everything to 0
-        lab = list(Lab.objects.all())
-        if not lab:
+        if not Lab.objects.exists():
             # this is to set all file statuses to 0 (new file)
-            soakdb = SoakdbFiles.objects.all()
-            for filename in soakdb:
-                filename.status = 0
-                filename.save()
+            SoakdbFiles.objects.update(status=0)
 
         # write output to signify job done
         with self.output().open('w') as f:
@@ -221,11 +331,10 @@ class TransferAllFedIDsAndDatafiles(luigi.Task):
                 print(proposal)
 
         # return a list of all proposals from db
-        proposal_list = list(SoakdbFiles.objects.values_list('proposal', flat=True))
+        proposal_list = list(SoakdbFiles.objects.values_list('proposal__proposal', flat=True))
 
         # add fedid permissions via proposals table
-        for proposal_number in set(proposal_list):
-            db_functions.pop_proposals(proposal_number)
+        db_functions.update_proposal_fedids(proposal_list)
 
         # write output to show job done
         with self.output().open('w') as f:
@@ -237,13 +346,13 @@ class TransferChangedDataFile(luigi.Task):
     data_file = luigi.Parameter()
     soak_db_filepath = luigi.Parameter(default=SoakDBConfig().default_path)
     hit_directory = luigi.Parameter(default=DirectoriesConfig().hit_directory)
+    full_reload = luigi.BoolParameter(default=False)
 
     def requires(self):
         return CheckFiles(soak_db_filepath=self.data_file)
 
     def output(self):
-        modification_date = misc_functions.get_mod_date(self.data_file)
-        return luigi.LocalTarget(str(self.data_file + '_' + str(modification_date) + '.transferred'))
+        return luigi.LocalTarget(transferred_marker(self.data_file))
 
     def run(self):
         print(self.data_file)
@@ -253,70 +362,25 @@ class TransferChangedDataFile(luigi.Task):
         if maint_exists == 1:
             soakdb_query = SoakdbFiles.objects.get(filename=self.data_file)
             print(soakdb_query)
-            # for pandda file finding
-            split_path = self.data_file.split('database')
-            search_path = split_path[0]
-
-            # remove pandda data transfer done file
-            if os.path.isfile(os.path.join(search_path, 'transfer_pandda_data.done')):
-                os.remove(os.path.join(search_path, 'transfer_pandda_data.done'))
-
-            log_files = find_log_files(search_path).rsplit()
-            print(log_files)
-
-            for log in log_files:
-                print(str(log + '.run.done'))
-                if os.path.isfile(str(log + '.run.done')):
-                    os.remove(str(log + '.run.done'))
-                if os.path.isfile(str(log + '.sites.done')):
-                    os.remove(str(log + '.sites.done'))
-                if os.path.isfile(str(log + '.events.done')):
-                    os.remove(str(log + '.events.done'))
-
-            find_logs_out_files = glob.glob(str(search_path + '*.txt'))
-
-            for f in find_logs_out_files:
-                if is_date(f.replace(search_path, '').replace('.txt', '')):
-                    os.remove(f)
-
-            crystals = Crystal.objects.filter(visit=soakdb_query)
-
-            for crystal in crystals:
-                target_name = str(crystal.target.target_name).upper()
-                crystal_name = str(crystal.crystal_name)
-                proasis_crystal_directory = os.path.join(self.hit_directory, target_name.upper(), crystal_name)
-
-                if ProasisHits.objects.filter(crystal_name=crystal).exists():
-                    proasis_hit = ProasisHits.objects.filter(crystal_name=crystal)
-                    for hit in proasis_hit:
-                        for path in glob.glob(os.path.join(DirectoriesConfig().log_directory, 'proasis/hits',
-                                                           str(hit.crystal_name.crystal_name +
-                                                               '_' + hit.modification_date + '*'))):
-                            os.remove(path)
-                        if os.path.isdir(proasis_crystal_directory):
-                            shutil.rmtree(os.path.join(proasis_crystal_directory), ignore_errors=True)
-
-                        if ProasisOut.objects.filter(proasis=hit).exists:
-                            for obj in ProasisOut.objects.filter(proasis=hit):
-                                if obj.root:
-                                    delete_files = ['verne.transferred', 'PROPOSALS', 'VISITS', 'visits_proposals.done']
-                                    for f in delete_files:
-                                        if os.path.isfile(os.path.join(obj.root, '/'.join(obj.start.split('/')[:-2]),
-                                                                       f)):
-                                            os.remove(os.path.join(obj.root, '/'.join(obj.start.split('/')[:-2]), f))
-                                    shutil.rmtree(os.path.join(obj.root, obj.start))
-                                obj.delete()
-                        hit.delete()
-
-            soakdb_query.delete()
-
-            out, err, proposal = db_functions.pop_soakdb(self.data_file)
-            db_functions.pop_proposals(proposal)
+
+            # pandda runs are only loaded again if their csvs have changed (see AddPanddaEvents), unless a full
+            # reload was asked for
+            if self.full_reload:
+                reset_pandda_markers(self.data_file)
+
+                # throw away everything from the file (and everything hanging off it) and start again
+                remove_proasis_files(Crystal.objects.filter(visit=soakdb_query), self.hit_directory)
+
+                soakdb_query.delete()
+
+                out, err, proposal = db_functions.pop_soakdb(self.data_file)
+                db_functions.pop_proposals(proposal)
 
         else:
             print('MAIN TABLE DOES NOT EXIST!')
 
-        transfer_file(self.data_file)
+        # only rows that have changed since the last transfer are written, unless a full reload was asked for
+        transfer_file(self.data_file, incremental=not self.full_reload, hit_directory=self.hit_directory)
 
         with self.output().open('w') as f:
             f.write('')
@@ -331,8 +395,7 @@ class TransferNewDataFile(luigi.Task):
         return CheckFiles(soak_db_filepath=self.soak_db_filepath)
 
     def output(self):
-        modification_date = misc_functions.get_mod_date(self.data_file)
-        return luigi.LocalTarget(str(self.data_file + '_' + str(modification_date) + '.transferred'))
+        return luigi.LocalTarget(transferred_marker(self.data_file))
 
     def run(self):
         transfer_file(self.data_file)
@@ -345,6 +408,8 @@ class StartTransfers(luigi.Task):
     resources = {'django': 1}
     date = luigi.Parameter(default=datetime.datetime.now().strftime("%Y%m%d%H"))
     soak_db_filepath = luigi.Parameter(default=SoakDBConfig().default_path)
+    # transfer the new and changed files with a pool of TransferConfig().workers processes, rather than one task each
+    parallel = luigi.BoolParameter(default=False)
 
     def get_file_list(self, status_code):
 
@@ -356,6 +421,9 @@ class StartTransfers(luigi.Task):
     def requires(self):
         if not os.path.isfile(CheckFiles(soak_db_filepath=self.soak_db_filepath).output().path):
             return CheckFiles(soak_db_filepath=self.soak_db_filepath)
+        elif self.parallel:
+            # the transfers are done by a process pool in run()
+            return []
         else:
             new_list = self.get_file_list(0)
             changed_list = self.get_file_list(1)
@@ -369,6 +437,13 @@ class StartTransfers(luigi.Task):
                                               str('transfer_logs/transfers_' + str(self.date) + '.done')))
 
     def run(self):
+        if self.parallel:
+            results = transfer_files_parallel(self.get_file_list(0), self.get_file_list(1),
+                                              DirectoriesConfig().hit_directory, TransferConfig().workers)
+            failed = [data_file for data_file, _, error in results if error]
+            if failed:
+                raise Exception(str('Transfers failed for: ' + ', '.join(failed)))
+
         with self.output().open('w') as f:
             f.write('')
 
@@ -395,93 +470,15 @@ class CheckFileUpload(luigi.Task):
 
         print(out_err_file)
 
-        results = db_functions.soakdb_query(self.filename)
-
         try:
-            print('Number of rows from file = ' + str(len(results)))
-
-            proteins = list(set([protein for protein in [protein['ProteinName'] for protein in results]]))
-
-            print('Unique targets in soakdb file: ' + str(proteins))
-
-            translations = {Lab: db_functions.lab_translations(),
-                            Refinement: db_functions.refinement_translations(),
-                            DataProcessing: db_functions.data_processing_translations(),
-                            Dimple: db_functions.dimple_translations()}
-
-            translation = translations[self.model]
-
-            error_dict = {
-                'crystal': [],
-                'soakdb_field': [],
-                'model_field': [],
-                'soakdb_value': [],
-                'model_value': []
-
-            }
-            for row in results:
-                lab_object = self.model.objects.filter(crystal_name__crystal_name=row['CrystalName'],
-                                                       crystal_name__visit__filename=str(self.filename),
-                                                       crystal_name__compound__smiles=row['CompoundSMILES'])
-                if len(lab_object) > 1:
-                    raise Exception('Multiple Crystals!')
-                if len(lab_object) == 0:
-                    if self.model == Dimple and not row['DimplePathToPDB'] and not row['DimplePathToMTZ']:
-                        pass
-                    else:
-                        raise Exception('No entry for ' + str(row['CrystalName'] + ' ' + row['DimplePathToPDB'] + ' '
-                                                              + row['DimplePathToMTZ']))
-                for key in translation.keys():
-                    test_xchem_val = eval(str('lab_object[0].' + key))
-                    soakdb_val = row[translation[key]]
-                    if key == 'outcome':
-                        pattern = re.compile('-?\d+')
-                        try:
-                            soakdb_val = int(pattern.findall(str(soakdb_val))[0])
-                        except:
-                            continue
-                    if translation[key] == 'CrystalName':
-                        test_xchem_val = lab_object[0].crystal_name.crystal_name
-                    if translation[key] == 'DimpleReferencePDB' and soakdb_val:
-                        test_xchem_val = lab_object[0].reference
-                        if test_xchem_val is not None:
-                            test_xchem_val = lab_object[0].reference.reference_pdb
-                    if soakdb_val == '' or soakdb_val == 'None' or not soakdb_val:
-                        continue
-                    if isinstance(test_xchem_val, float):
-                        if float(test_xchem_val) == float(soakdb_val):
-                            continue
-                    if isinstance(test_xchem_val, int):
-                        if int(soakdb_val) == int(test_xchem_val):
-                            continue
-                    if test_xchem_val != soakdb_val:
-                        if soakdb_val in [None, 'None', '', '-', 'n/a', 'null', 'pending', 'NULL', '#NAME?', '#NOM?',
-                                          'None\t',
-                                          'Analysis Pending', 'in-situ']:
-                            continue
-                        else:
-                            error_dict['crystal'].append(str(lab_object[0].crystal_name.crystal_name))
-                            error_dict['soakdb_field'].append(translation[key])
-                            error_dict['model_field'].append(key)
-                            error_dict['soakdb_value'].append(soakdb_val)
-                            error_dict['model_value'].append(test_xchem_val)
-
-            if error_dict['crystal']:
-                pd.DataFrame.from_dict(error_dict).to_csv(out_err_file)
-
-        except IndexError:
-            if 'No item with that key' in traceback.format_exc():
-                pass
-            else:
-                with open(out_err_file, 'w') as f:
-                    f.write(traceback.format_exc())
-                with open(out_err_file, 'a') as f:
-                    f.write('\n' + str(key))
-        except AttributeError:
-            with open(out_err_file, 'w') as f:
-                f.write(traceback.format_exc())
-            with open(out_err_file, 'a') as f:
-                f.write('\n' + str(lab_object))
+            # compare the whole file with the table in one go, rather than row by row
+            errors = db_functions.upload_mismatches(self.filename, self.model)
+
+            print(str(str(len(errors)) + ' mismatches between ' + self.filename + ' and ' + str(self.model)))
+
+            if len(errors) > 0:
+                errors.to_csv(out_err_file)
+
         except:
             with open(out_err_file, 'w') as f:
                 f.write(traceback.format_exc())
@@ -0,0 +1,19 @@
+import os
+import sys
+
+from functions import metrics_functions
+from luigi_classes.config_classes import DirectoriesConfig
+
+# usage: python metrics_summary.py [metrics file] [number of runs]
+if __name__ == '__main__':
+    if len(sys.argv) > 1:
+        metrics_file = sys.argv[1]
+    else:
+        metrics_file = os.path.join(DirectoriesConfig().log_directory, 'metrics', 'task_metrics.jsonl')
+
+    if len(sys.argv) > 2:
+        last_runs = int(sys.argv[2])
+    else:
+        last_runs = 10
+
+    metrics_functions.summarise_metrics(metrics_file, last_runs=last_runs)
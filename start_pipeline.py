@@ -19,6 +19,9 @@ import os
 import datetime
 import glob
 
+from functions import cache_functions
+from functions import metrics_functions
+
 # set sentry key url from config
 sentry_string = str("https://" + SentryConfig().key + "@sentry.io/" + SentryConfig().ident)
 # initiate sentry sdk
@@ -39,6 +42,38 @@ def send_failure_to_sentry(task, exception):
     capture_exception()
 
 
+# timing and throughput for every task, written to logs/metrics/task_metrics.jsonl (see metrics_summary.py)
+metrics_file = os.path.join(DirectoriesConfig().log_directory, 'metrics', 'task_metrics.jsonl')
+run_id = datetime.datetime.now().strftime("%Y%m%d%H%M")
+metrics_functions.count_queries()
+
+
+@luigi.Task.event_handler(luigi.Event.START)
+def record_start(task):
+    metrics_functions.task_started(task)
+
+
+@luigi.Task.event_handler(luigi.Event.START)
+def clear_stat_cache(task):
+    # every task starts from what is on disk now, not what an earlier task in the same worker saw
+    cache_functions.stat_cache.clear()
+
+
+@luigi.Task.event_handler(luigi.Event.PROCESSING_TIME)
+def record_processing_time(task, processing_time):
+    metrics_functions.task_processing_time(task, processing_time)
+
+
+@luigi.Task.event_handler(luigi.Event.SUCCESS)
+def record_success(task):
+    metrics_functions.task_finished(task, 'SUCCESS', metrics_file, run_id)
+
+
+@luigi.Task.event_handler(luigi.Event.FAILURE)
+def record_failure(task, exception):
+    metrics_functions.task_finished(task, 'FAILURE', metrics_file, run_id)
+
+
 class StartPipeline(luigi.WrapperTask):
     date = luigi.DateParameter(default=datetime.datetime.now())
     hit_directory = luigi.Parameter(default=DirectoriesConfig().hit_directory)
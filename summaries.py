@@ -11,8 +11,8 @@ from functions import proasis_api_funcs as paf
 
 def find_proasis_repeats(protein):
     project_strucids = paf.get_strucids_from_project(protein)
-    project_titles = [paf.get_strucid_json(strucid)['allStrucs'][0]['TITLE'].split()[-1] for strucid in
-                      project_strucids]
+    project_titles = [struc_json['allStrucs'][0]['TITLE'].split()[-1] for struc_json in
+                      paf.get_strucids_json(project_strucids)]
 
     counts = dict(Counter(project_titles))
 
@@ -0,0 +1,85 @@
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+
+from functions.cache_functions import StatCache
+
+
+class TestStatCache(unittest.TestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.directories = [os.path.join(self.root, str('dir' + str(i))) for i in range(10)]
+        for directory in self.directories:
+            os.makedirs(directory)
+            for name in ['a.pdb', 'b.mtz']:
+                open(os.path.join(directory, name), 'w').close()
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def test_listing(self):
+        cache = StatCache()
+        paths = [os.path.join(self.directories[0], name) for name in ['a.pdb', 'b.mtz', 'missing.pdb']]
+
+        self.assertEqual([cache.isfile(path) for path in paths], [True, True, False])
+        self.assertEqual(cache.stats(), {'hits': 2, 'misses': 1})
+        # a directory isn't a file, and a missing directory has no files
+        self.assertFalse(cache.isfile(self.directories[1]))
+        self.assertFalse(cache.isfile(os.path.join(self.root, 'missing', 'a.pdb')))
+
+    def test_clear(self):
+        cache = StatCache()
+        new_file = os.path.join(self.directories[0], 'c.pdb')
+        self.assertFalse(cache.isfile(new_file))
+
+        open(new_file, 'w').close()
+        # still in the cached listing until it is cleared (or the ttl runs out)
+        self.assertFalse(cache.isfile(new_file))
+        cache.clear()
+        self.assertTrue(cache.isfile(new_file))
+
+        expired = StatCache(ttl=0)
+        self.assertTrue(expired.isfile(new_file))
+        os.remove(new_file)
+        self.assertFalse(expired.isfile(new_file))
+
+    def test_limit(self):
+        cache = StatCache(max_listings=3)
+        for directory in self.directories:
+            self.assertTrue(cache.isfile(os.path.join(directory, 'a.pdb')))
+        self.assertEqual(list(cache.listings.keys()), self.directories[-3:])
+
+        # using a listing keeps it, so the least recently used one goes next
+        cache.isfile(os.path.join(self.directories[-3], 'b.mtz'))
+        cache.isfile(os.path.join(self.directories[0], 'b.mtz'))
+        self.assertEqual(list(cache.listings.keys()), [self.directories[-1], self.directories[-3],
+                                                       self.directories[0]])
+
+        files = StatCache(prefetch=False, max_files=5)
+        for directory in self.directories:
+            self.assertTrue(files.isfile(os.path.join(directory, 'a.pdb')))
+        self.assertEqual(len(files.files), 5)
+
+    def test_threads(self):
+        cache = StatCache(max_listings=4)
+        paths = [os.path.join(directory, name) for directory in self.directories for name in ['a.pdb', 'b.mtz', 'c']]
+        results = []
+
+        def check():
+            results.append([cache.isfile(path) for path in paths])
+
+        threads = [threading.Thread(target=check) for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(results, [[os.path.isfile(path) for path in paths]] * 8)
+        self.assertEqual(sum(cache.stats().values()), 8 * len(paths))
+        self.assertLessEqual(len(cache.listings), 4)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,145 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from functions import crawl_functions
+
+
+def touch(path):
+    if not os.path.isdir(os.path.dirname(path)):
+        os.makedirs(os.path.dirname(path))
+    open(path, 'w').close()
+    return path
+
+
+class VisitTree(unittest.TestCase):
+    def setUp(self):
+        # crawl a relative path, as the prune patterns would match temp directories like /tmp/...
+        self.cwd = os.getcwd()
+        self.root = tempfile.mkdtemp()
+        os.chdir(self.root)
+        self.visits = 'visits'
+
+        self.soakdb_files = [
+            touch(os.path.join(self.visits, 'lb1', 'processing', 'database', 'soakDBDataFile.sqlite')),
+            # depth 5 below the visits directory, so just inside maxdepth
+            touch(os.path.join(self.visits, 'lb2', 'a', 'b', 'c', 'soakDBDataFile.sqlite'))
+        ]
+        self.pandda_logs = [
+            touch(os.path.join(self.visits, 'lb1', 'processing', 'analysis', 'panddas', 'pandda-2018-01-01-0000.log')),
+            touch(os.path.join(self.visits, 'lb1', 'processing', 'analysis', 'panddas', 'pandda-2018-02-01-0000.log'))
+        ]
+
+        # depth 6, past maxdepth for soakdb files
+        touch(os.path.join(self.visits, 'lb2', 'a', 'b', 'c', 'd', 'soakDBDataFile.sqlite'))
+        # pruned directories
+        touch(os.path.join(self.visits, 'lb1', 'processing', 'lab36', 'soakDBDataFile.sqlite'))
+        touch(os.path.join(self.visits, 'lb1', 'processing', 'database', 'backup', 'soakDBDataFile.sqlite'))
+        touch(os.path.join(self.visits, 'lb1', 'processing', 'analysis', 'soakDBDataFile.sqlite'))
+        touch(os.path.join(self.visits, 'lb1', 'processing', 'analysis', 'old_panddas', 'pandda-2017-01-01-0000.log'))
+        # not the right names
+        touch(os.path.join(self.visits, 'lb1', 'processing', 'database', 'soakDBDataFile.sqlite.bak'))
+        touch(os.path.join(self.visits, 'lb1', 'processing', 'analysis', 'panddas', 'pandda.log'))
+
+        # symlinks to directories are not followed, as for find
+        os.symlink('lb1', os.path.join(self.visits, 'lb3'))
+
+    def tearDown(self):
+        os.chdir(self.cwd)
+        shutil.rmtree(self.root)
+
+
+class TestCrawl(VisitTree):
+    def test_crawl(self):
+        found, stats = crawl_functions.crawl([self.visits], workers=4)
+
+        self.assertEqual(found['soakdb'], sorted(self.soakdb_files))
+        self.assertEqual(found['pandda_log'], sorted(self.pandda_logs))
+        self.assertEqual(stats['errors'], 0)
+
+    def test_single_search(self):
+        found, _ = crawl_functions.crawl([self.visits], searches=('pandda_log',), workers=4)
+
+        self.assertEqual(list(found.keys()), ['pandda_log'])
+        self.assertEqual(found['pandda_log'], sorted(self.pandda_logs))
+
+    def test_crawl_path(self):
+        # the visit directories as a glob, as for the find commands crawl replaces. maxdepth is counted from each
+        # root, so the file 6 levels below the visits directory is now in range
+        found, stats = crawl_functions.crawl_path(os.path.join(self.visits, 'lb[12]'), workers=4)
+
+        self.assertEqual(stats['roots'], 2)
+        self.assertEqual(found['soakdb'], sorted(self.soakdb_files
+                                                 + [os.path.join(self.visits, 'lb2', 'a', 'b', 'c', 'd',
+                                                                 'soakDBDataFile.sqlite')]))
+
+    def test_unreadable_directory(self):
+        unreadable = os.path.join(self.visits, 'lb2', 'a')
+        os.chmod(unreadable, 0)
+        try:
+            if os.access(unreadable, os.R_OK):
+                self.skipTest('permissions are not enforced for this user')
+            found, stats = crawl_functions.crawl([self.visits], workers=4)
+        finally:
+            os.chmod(unreadable, 0o755)
+
+        # the rest of the tree is still crawled
+        self.assertEqual(found['soakdb'], self.soakdb_files[:1])
+        self.assertEqual(found['pandda_log'], sorted(self.pandda_logs))
+        self.assertEqual(stats['errors'], 1)
+
+
+class TestCrawlIndex(VisitTree):
+    def setUp(self):
+        VisitTree.setUp(self)
+        self.index_file = os.path.join(self.root, 'crawl_index.sqlite')
+
+    def age(self):
+        # move the directory mtimes back an hour, as if the tree was written well before the crawl
+        for directory, _, _ in os.walk(self.visits):
+            stat = os.stat(directory)
+            os.utime(directory, ns=(stat.st_atime_ns, stat.st_mtime_ns - 3600 * 10 ** 9))
+
+    def test_index_reuse(self):
+        self.age()
+        first, first_stats = crawl_functions.crawl([self.visits], workers=4, index_file=self.index_file)
+        second, second_stats = crawl_functions.crawl([self.visits], workers=4, index_file=self.index_file)
+
+        self.assertEqual(first, second)
+        self.assertEqual(first_stats['dirs_skipped'], 0)
+        self.assertEqual(second_stats['dirs_skipped'], second_stats['dirs_visited'])
+
+        # full_walk ignores the index
+        _, full_stats = crawl_functions.crawl([self.visits], workers=4, index_file=self.index_file, full_walk=True)
+        self.assertEqual(full_stats['dirs_skipped'], 0)
+
+    def test_index_changes(self):
+        self.age()
+        crawl_functions.crawl([self.visits], workers=4, index_file=self.index_file)
+
+        os.remove(self.soakdb_files[1])
+        added = [
+            touch(os.path.join(self.visits, 'lb1', 'processing', 'analysis', 'panddas', 'pandda-2018-03-01-0000.log')),
+            # in new directories several levels down
+            touch(os.path.join(self.visits, 'lb2', 'x', 'y', 'database', 'soakDBDataFile.sqlite'))
+        ]
+
+        found, stats = crawl_functions.crawl([self.visits], workers=4, index_file=self.index_file)
+
+        self.assertEqual(found['soakdb'], sorted([self.soakdb_files[0], added[1]]))
+        self.assertEqual(found['pandda_log'], sorted(self.pandda_logs + [added[0]]))
+        self.assertEqual(found, crawl_functions.crawl([self.visits], workers=4)[0])
+        # only the changed and new directories were read again
+        self.assertEqual(stats['dirs_visited'] - stats['dirs_skipped'], 6)
+
+    def test_recent_changes(self):
+        # directories changed just before the crawl started are read again by the next crawl
+        crawl_functions.crawl([self.visits], workers=4, index_file=self.index_file)
+        _, stats = crawl_functions.crawl([self.visits], workers=4, index_file=self.index_file)
+
+        self.assertEqual(stats['dirs_skipped'], 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,81 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+import pandas as pd
+
+from functions import csv_functions
+
+
+class TestReadFrame(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        csv_functions.memo.clear()
+        # as written by FindSearchPaths, with a crystal-name-like value that must stay a string
+        self.search_paths = pd.DataFrame({'search_path': ['/dls/a/', '0001'],
+                                          'soak_db_filepath': ['/dls/a/database/', '/dls/b/database/'],
+                                          'sdbfile': ['/dls/a/database/soakDBDataFile.sqlite', '0002']})
+        self.events = pd.DataFrame({'dtag': ['0001', 'x0002'], 'event_idx': [1, 2], 'site_idx': [1, 1],
+                                    '1-BDC': [0.23, 0.19], 'x': [1.0, 2.0], 'y': [3.0, 4.0], 'z': [5.0, 6.0],
+                                    'z_peak': [6.67, 5.19]})
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def read_both(self, frame, schema):
+        # the frame read back from the csv alone, and from its parquet copy
+        path = os.path.join(self.directory, str(schema + '.csv'))
+        csv_functions.write_frame(frame, path)
+        from_csv = csv_functions.read_frame(path, schema)
+
+        csv_functions.write_frame(frame, path, columnar=True)
+        self.assertTrue(os.path.isfile(csv_functions.columnar_file(path)))
+        from_parquet = csv_functions.read_frame(path, schema)
+
+        return from_csv, from_parquet
+
+    def test_columnar(self):
+        if csv_functions.pyarrow is None:
+            self.skipTest('pyarrow is not installed')
+
+        from_csv, from_parquet = self.read_both(self.search_paths, 'search_paths')
+        pd.testing.assert_frame_equal(from_parquet, from_csv)
+        self.assertEqual(from_parquet['sdbfile'][1], '0002')
+
+        # a schema without index_col gets the written index back as a column, as it would from the csv
+        from_csv, from_parquet = self.read_both(self.events, 'pandda_events')
+        pd.testing.assert_frame_equal(from_parquet, from_csv)
+        self.assertEqual(from_parquet['dtag'][0], '0001')
+
+    def test_memo(self):
+        path = os.path.join(self.directory, 'search_paths.csv')
+        csv_functions.write_frame(self.search_paths, path)
+
+        hits = csv_functions.memo_stats['hits']
+        first = csv_functions.read_frame(path, 'search_paths')
+        first['search_path'] = ''
+        second = csv_functions.read_frame(path, 'search_paths')
+        self.assertEqual(csv_functions.memo_stats['hits'], hits + 1)
+        # callers get a copy
+        self.assertEqual(list(second['search_path']), ['/dls/a/', '0001'])
+
+        # a changed file is read again, and replaces the old frame
+        csv_functions.write_frame(self.search_paths.iloc[:1], path)
+        self.assertEqual(len(csv_functions.read_frame(path, 'search_paths')), 1)
+        self.assertEqual(csv_functions.memo_stats['hits'], hits + 1)
+        self.assertEqual(len(csv_functions.memo), 1)
+
+    def test_memo_size(self):
+        paths = [os.path.join(self.directory, str('search_paths_' + str(i) + '.csv'))
+                 for i in range(csv_functions.MEMO_SIZE + 5)]
+        for path in paths:
+            csv_functions.write_frame(self.search_paths, path)
+            csv_functions.read_frame(path, 'search_paths')
+
+        self.assertEqual(len(csv_functions.memo), csv_functions.MEMO_SIZE)
+        self.assertEqual(sorted([key[0] for key in csv_functions.memo.keys()]), sorted(paths[5:]))
+
+
+if __name__ == '__main__':
+    unittest.main()
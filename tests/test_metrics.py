@@ -0,0 +1,61 @@
+import threading
+import unittest
+
+import setup_django
+setup_django.setup_django()
+
+from django.db import connection
+
+from functions import metrics_functions
+from xchem_db.models import Proposals
+
+
+class TestQueryCounter(unittest.TestCase):
+    def setUp(self):
+        metrics_functions.count_queries()
+
+    def run_in_thread(self, target):
+        def run():
+            try:
+                target()
+            finally:
+                # django opens a connection per thread, which has to be closed by that thread
+                connection.close()
+
+        thread = threading.Thread(target=run)
+        thread.start()
+        thread.join()
+
+    def test_main_thread(self):
+        print('test_main_thread')
+        before = metrics_functions.counters['queries']
+        Proposals.objects.count()
+        Proposals.objects.count()
+
+        self.assertEqual(metrics_functions.counters['queries'] - before, 2)
+        # counting again doesn't add a second wrapper
+        metrics_functions.count_queries()
+        self.assertEqual(connection.execute_wrappers.count(metrics_functions.count_query), 1)
+
+    def test_second_thread(self):
+        print('test_second_thread')
+        before = metrics_functions.counters['queries']
+        self.run_in_thread(lambda: [Proposals.objects.count() for _ in range(3)])
+
+        self.assertEqual(metrics_functions.counters['queries'] - before, 3)
+
+    def test_count_threads(self):
+        print('test_count_threads')
+        before = metrics_functions.counters.get('test_items', 0)
+        threads = [threading.Thread(target=lambda: [metrics_functions.count('test_items') for _ in range(10000)])
+                   for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(metrics_functions.counters['test_items'] - before, 80000)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -6,9 +6,14 @@ import setup_django
 setup_django.setup_django()
 
 import functions.pandda_functions as pf
+from functions import csv_functions
+from functions import pdb_functions
+from functions.cache_functions import StatCache
 from luigi_classes.transfer_pandda import *
 from .test_functions import run_luigi_worker
 from xchem_db.models import PanddaRun, PanddaAnalysis
+from xchem_db import spatial
+from xchem_db.spatial import site_index
 
 
 class TestFindLogs(unittest.TestCase):
@@ -75,6 +80,128 @@ class TestFindLogs(unittest.TestCase):
                          '/pipeline/tests/data/processing/analysis/panddas/analyses/pandda_analyse_events.csv')
         self.assertEqual(error, False)
 
+    # a second read of an unchanged log should come from the cache
+    def test_get_files_from_log_cached(self):
+        log_file = '/pipeline/tests/data/processing/analysis/panddas/logs/pandda-2018-07-29-1940.log'
+        cache = FileCache('/pipeline/logs/pandda_cache.sqlite', 'pandda_logs')
+
+        first = pf.get_files_from_log(log_file, cache=cache)
+        bytes_parsed = pf.log_parse_stats['bytes_parsed']
+        second = pf.get_files_from_log(log_file, cache=cache)
+
+        self.assertEqual(first, pf.get_files_from_log(log_file))
+        self.assertEqual(first, second)
+        self.assertEqual(cache.stats(), {'hits': 1, 'misses': 1})
+        self.assertEqual(pf.log_parse_stats['bytes_parsed'], bytes_parsed)
+        cache.close()
+
+    # files in the same directory are found from one listing
+    def test_stat_cache(self):
+        crystal_dir = '/pipeline/tests/data/processing/analysis/panddas/processed_datasets/NUDT5A-x0114/'
+        paths = [os.path.join(crystal_dir, name) for name in sorted(os.listdir(crystal_dir))]
+        paths.append(os.path.join(crystal_dir, 'missing.pdb'))
+
+        cache = StatCache()
+        self.assertEqual([cache.isfile(path) for path in paths], [os.path.isfile(path) for path in paths])
+        self.assertEqual(cache.stats(), {'hits': len(paths) - 1, 'misses': 1})
+
+    def test_translate_event_stats(self):
+        events_file = '/pipeline/tests/data/processing/analysis/panddas/analyses/pandda_analyse_events.csv'
+        stats = pf.translate_event_stats(events_file, 0)
+
+        self.assertEqual(stats['cluster_size'], 277)
+        self.assertAlmostEqual(stats['one_minus_bdc'], 0.23)
+        self.assertEqual(len(pf.event_stats_frame(pf.read_events(events_file))), 4)
+
+    # an unchanged csv is only read once, and comes back with the schema's types
+    def test_read_frame(self):
+        events_file = '/pipeline/tests/data/processing/analysis/panddas/analyses/pandda_analyse_events.csv'
+        first = csv_functions.read_frame(events_file, 'pandda_events')
+        hits = csv_functions.memo_stats['hits']
+        second = csv_functions.read_frame(events_file, 'pandda_events')
+
+        self.assertEqual(csv_functions.memo_stats['hits'], hits + 1)
+        self.assertTrue(first.equals(second))
+        self.assertTrue(isinstance(first['dtag'][0], str))
+
+    # ligand centroids leave out hydrogens and alternate locations other than A, and the closest ligand is picked
+    def test_find_ligand_site_event(self):
+        model_file = '/pipeline/logs/test-pandda-model.pdb'
+        with open(model_file, 'w') as f:
+            f.write(''.join([
+                'HETATM    1  C1  LIG A 501      10.000  10.000  10.000  1.00 20.00           C  \n',
+                'HETATM    2  C2 ALIG A 501      12.000  10.000  10.000  0.50 20.00           C  \n',
+                'HETATM    3  C2 BLIG A 501      14.000  10.000  10.000  0.50 20.00           C  \n',
+                'HETATM    4  H1  LIG A 501      30.000  10.000  10.000  1.00 20.00           H  \n',
+                'HETATM    5  O1  LIG A 501      10.000  16.000  10.000  1.00 20.00           O  \n',
+                'HETATM    6  C1  LIG B 601       3.500   3.500   3.500  1.00 20.00           C  \n',
+                'HETATM    7  O1  LIG B 601      11.500  14.500   3.500  1.00 20.00           O  \n'
+            ]))
+
+        lig_strings = pf.find_ligands(model_file)
+        self.assertEqual(sorted(lig_strings), ['LIG A 501 ', 'LIG B 601 '])
+
+        ligand, centroid, lig_dist, site_dist = pf.find_ligand_site_event(30, -2, 10, 12, 15, -3, lig_strings,
+                                                                          model_file)
+        self.assertEqual(ligand, 'LIG A 501 ')
+        self.assertEqual([round(x, 3) for x in centroid], [10.667, 12.0, 10.0])
+        self.assertAlmostEqual(site_dist, 37.17526059)
+        self.assertAlmostEqual(lig_dist, 10.05003658)
+
+        ligand, centroid, lig_dist, site_dist = pf.find_ligand_site_event(1, 2, 3, 4, 5, 6, lig_strings, model_file)
+        self.assertEqual(ligand, 'LIG B 601 ')
+        self.assertEqual(centroid, [7.5, 9.0, 3.5])
+
+    # matching all the events of a model at once, each with its own site, is the same as matching them one at a time
+    def test_match_ligands_per_event_sites(self):
+        lig_centroids = [[10.667, 12.0, 10.0], [7.5, 9.0, 3.5], [-4.0, 2.0, 8.0]]
+        natives = [[30, -2, 10], [1, 2, 3], [-15.0, -13.9, -9.2]]
+        events = [[12, 15, -3], [4, 5, 6], [0.5, 1.5, 2.5]]
+
+        indices, distances, displacements = pdb_functions.match_ligands(natives, events, lig_centroids)
+        for i in range(len(events)):
+            index, distance, displacement = pdb_functions.match_ligands(natives[i], [events[i]], lig_centroids)
+            self.assertEqual(indices[i], index[0])
+            self.assertAlmostEqual(distances[i], distance[0])
+            self.assertAlmostEqual(displacements[i], displacement[0])
+
+    # events in sites with no native centroid (or no row in the sites csv) are skipped, not matched against NaNs
+    def test_events_file_info_blank_centroid(self):
+        events_file = '/pipeline/tests/data/processing/analysis/panddas/analyses/pandda_analyse_events.csv'
+        events_frame = pf.read_events(events_file)
+        native_centroids = dict((int(site), (None, None, None)) for site in events_frame['site_idx'])
+
+        info = pf.events_file_info(events_frame, native_centroids, input_dir='/pipeline/tests/data/',
+                                   output_dir='/pipeline/tests/data/')
+        self.assertEqual([fields for fields, _, _, _ in info], [None] * len(events_frame))
+        self.assertTrue(info[0][3].startswith('No native centroid for site'))
+
+        info = pf.events_file_info(events_frame, {}, input_dir='/pipeline/tests/data/',
+                                   output_dir='/pipeline/tests/data/')
+        self.assertEqual([fields for fields, _, _, _ in info], [None] * len(events_frame))
+
+    # radius and nearest neighbour lookups match a brute force search, and only the most recent indexes are kept
+    def test_spatial_index(self):
+        points = [[0, 0, 0], [1, 0, 0], [0, 3, 0], [10, 10, 10], [0.5, 0.5, 0.5]]
+        index = spatial.SpatialIndex([11, 12, 13, 14, 15], points)
+
+        self.assertEqual([i for i, _ in index.near([0, 0, 0], 1.5)], [11, 15, 12])
+        self.assertAlmostEqual(index.near([0, 0, 0], 1.5)[1][1], 0.75 ** 0.5)
+        self.assertEqual(index.near([100, 100, 100], 1.0), [])
+        self.assertEqual([i for i, _ in index.nearest([9, 9, 9], k=2)], [14, 13])
+        self.assertEqual(sorted([sorted(group) for group in index.clusters(1.0)]), [[11, 12, 15], [13], [14]])
+
+        max_indexes = spatial.MAX_INDEXES
+        spatial.MAX_INDEXES = 2
+        try:
+            spatial.indexes.clear()
+            for target in ['NOT-A-TARGET-1', 'NOT-A-TARGET-2', 'NOT-A-TARGET-3']:
+                self.assertEqual(len(site_index(target=target)), 0)
+            self.assertEqual([key[3] for key in spatial.indexes.keys()], ['NOT-A-TARGET-2', 'NOT-A-TARGET-3'])
+        finally:
+            spatial.MAX_INDEXES = max_indexes
+            spatial.indexes.clear()
+
     # tasks: AddPanddaRun
     def test_add_pandda_run(self):
         log_file = '/pipeline/tests/data/processing/analysis/panddas/logs/pandda-2018-07-29-1940.log'
@@ -185,6 +312,18 @@ class TestFindLogs(unittest.TestCase):
                     self.assertAlmostEqual(site.site_native_centroid_y, e['site_native_centroid_y'])
                     self.assertAlmostEqual(site.site_native_centroid_z, e['site_native_centroid_z'])
 
+        # loading the same sites again changes nothing
+        counts = db_functions.add_pandda_sites(log_file=log_file, sites_file=sites_file)
+        self.assertEqual(counts, {'sites': 4, 'inserted': 0, 'updated': 0})
+
+        # the spatial index finds each site at its own centroid, and the 4 sites are well apart
+        run = PanddaRun.objects.get(pandda_log=log_file)
+        index = site_index(pandda_run=run.id)
+        site_1 = PanddaSite.objects.get(pandda_run=run, site=1)
+        self.assertEqual(index.nearest((site_1.site_native_centroid_x, site_1.site_native_centroid_y,
+                                        site_1.site_native_centroid_z))[0], (site_1.id, 0.0))
+        self.assertEqual(len(index.clusters(5.0)), 4)
+
         os.remove('/pipeline/tests/data/processing/analysis/panddas/logs/pandda-2018-07-29-1940.log.sites.done')
         os.remove('/pipeline/tests/data/processing/analysis/panddas/logs/pandda-2018-07-29-1940.log.run.done')
 
@@ -0,0 +1,142 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from functions import pdb_functions
+
+fixture = os.path.join(os.path.dirname(__file__), 'data', 'pdb', 'bound_altconfs.pdb')
+
+
+def legacy_altconf_pdb(proasis_bound_pdb, unique_ligands, altconf, proasis_crystal_directory):
+    # the altconf pdb file as hit_submission wrote it before rewrite_pdb
+    altconf_pdb_file = str(proasis_crystal_directory + proasis_bound_pdb.split('/')[-1].replace(
+        '.pdb', str('_' + altconf.replace(' ', '') + '.pdb')))
+
+    if os.path.isfile(altconf_pdb_file):
+        os.remove(altconf_pdb_file)
+
+    ligands = [lig for lig in unique_ligands if lig != altconf]
+
+    for line in open(proasis_bound_pdb, 'r'):
+        if any(lig in line for lig in ligands):
+            continue
+        else:
+            if altconf in line:
+                line = line.replace(altconf, str(' ' + altconf[1:]))
+
+            with open(altconf_pdb_file, 'a') as f:
+                f.write(line)
+
+    return altconf_pdb_file
+
+
+def legacy_proasis_pdb(proasis_bound_pdb, lig):
+    # the _proasis.pdb file as hit_submission wrote it before rewrite_pdb
+    newlines = ''
+    for line in open(proasis_bound_pdb, 'r'):
+        if lig in line:
+            line = line.replace(lig, str(' ' + lig[1:]))
+        newlines += line
+
+    with open(proasis_bound_pdb.replace('.pdb', '_proasis.pdb'), 'w') as f:
+        f.write(newlines)
+
+    return proasis_bound_pdb.replace('.pdb', '_proasis.pdb')
+
+
+def read(filename):
+    with open(filename, 'rb') as f:
+        return f.read()
+
+
+class TestRewritePdb(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.new = os.path.join(self.directory, 'new/')
+        self.old = os.path.join(self.directory, 'old/')
+        os.makedirs(self.new)
+        os.makedirs(self.old)
+        self.pdb_file = os.path.join(self.directory, 'refine.split.bound-state.pdb')
+        shutil.copy(fixture, self.pdb_file)
+        self.ligands = [' LIG B 402 ', 'ALIG A 401 ', 'BLIG A 401 ']
+
+        self.saved_caches = (pdb_functions.ligand_cache, pdb_functions.rewrite_cache)
+        pdb_functions.ligand_cache = pdb_functions.rewrite_cache = None
+
+    def tearDown(self):
+        if pdb_functions.rewrite_cache is not None:
+            pdb_functions.ligand_cache.close()
+            pdb_functions.rewrite_cache.close()
+        pdb_functions.ligand_cache, pdb_functions.rewrite_cache = self.saved_caches
+        shutil.rmtree(self.directory)
+
+    def split(self):
+        return pdb_functions.split_altconfs(self.pdb_file, self.ligands, self.new)
+
+    def touch_source(self, seconds):
+        stat = os.stat(self.pdb_file)
+        os.utime(self.pdb_file, ns=(stat.st_atime_ns, stat.st_mtime_ns + seconds * 10 ** 9))
+
+    def test_split_altconfs(self):
+        files = self.split()
+
+        self.assertEqual(sorted(files.keys()), ['ALIG A 401 ', 'BLIG A 401 '])
+        for altconf, filename in files.items():
+            legacy = legacy_altconf_pdb(self.pdb_file, self.ligands, altconf, self.old)
+            self.assertEqual(os.path.basename(filename), os.path.basename(legacy))
+            self.assertEqual(read(filename), read(legacy))
+
+        # the other conformation and the other ligand are gone, and the altloc is removed from this one
+        contents = read(files['ALIG A 401 ']).decode()
+        self.assertNotIn('BLIG', contents)
+        self.assertNotIn('LIG B 402', contents)
+        self.assertEqual(contents.count(' LIG A 401 '), 5)
+
+    def test_relabel(self):
+        proasis_pdb = self.pdb_file.replace('.pdb', '_proasis.pdb')
+        self.assertEqual(pdb_functions.rewrite_pdb(self.pdb_file, [(proasis_pdb, [], 'ALIG A 401 ')]), [proasis_pdb])
+        new = read(proasis_pdb)
+
+        self.assertEqual(read(legacy_proasis_pdb(self.pdb_file, 'ALIG A 401 ')), new)
+
+    def test_no_cache(self):
+        # without a cache, the copies are always written
+        self.assertEqual(len(pdb_functions.rewrite_pdb(self.pdb_file, [(os.path.join(self.new, 'a.pdb'), [], None)])),
+                         1)
+        self.assertEqual(len(pdb_functions.rewrite_pdb(self.pdb_file, [(os.path.join(self.new, 'a.pdb'), [], None)])),
+                         1)
+
+    def test_skip_unchanged(self):
+        pdb_functions.set_ligand_cache(os.path.join(self.directory, 'ligand_cache.sqlite'))
+        files = self.split()
+        first = os.path.join(self.new, 'first.pdb')
+        outputs = [(first, ['BLIG A 401 '], 'ALIG A 401 ')]
+
+        self.assertEqual(pdb_functions.rewrite_pdb(self.pdb_file, outputs), [first])
+        self.assertEqual(pdb_functions.rewrite_pdb(self.pdb_file, outputs), [])
+        self.assertEqual(pdb_functions.rewrite_pdb(self.pdb_file, [(first, ('BLIG A 401 ',), 'ALIG A 401 ')]), [])
+
+        # a different set of ligands to drop, or ligand to relabel, is written again
+        self.assertEqual(pdb_functions.rewrite_pdb(self.pdb_file, [(first, [], 'ALIG A 401 ')]), [first])
+        self.assertEqual(pdb_functions.rewrite_pdb(self.pdb_file, [(first, [], 'BLIG A 401 ')]), [first])
+        self.assertEqual(read(first), read(legacy_proasis_pdb(self.pdb_file, 'BLIG A 401 ')))
+
+        # as is a copy that has been changed since it was written
+        with open(first, 'a') as f:
+            f.write('REMARK edited\n')
+        self.assertEqual(pdb_functions.rewrite_pdb(self.pdb_file, [(first, [], 'BLIG A 401 ')]), [first])
+        self.assertNotIn(b'REMARK edited', read(first))
+
+        # the altconf files are only written again when the source changes - including to an older mtime
+        self.assertEqual(self.split(), files)
+        self.assertEqual(pdb_functions.rewrite_pdb(self.pdb_file, [(f, [lig for lig in self.ligands if lig != a], a)
+                                                                   for a, f in files.items()]), [])
+        self.touch_source(-3600)
+        written = pdb_functions.rewrite_pdb(self.pdb_file, [(f, [lig for lig in self.ligands if lig != a], a)
+                                                            for a, f in files.items()])
+        self.assertEqual(sorted(written), sorted(files.values()))
+
+
+if __name__ == '__main__':
+    unittest.main()
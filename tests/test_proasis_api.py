@@ -0,0 +1,128 @@
+import json
+import multiprocessing
+import socketserver
+import threading
+import unittest
+from http.server import BaseHTTPRequestHandler, HTTPServer
+
+from functions import proasis_api_funcs
+
+
+class ProasisStub(socketserver.ThreadingMixIn, HTTPServer):
+    """
+    A local stand in for the proasis API: responds to GET requests for the paths in responses with their json, after
+    failing the first failures[path] requests with a 500, and answering the next empties[path] with empty json.
+    Records the requests and the connections they came on.
+    """
+    daemon_threads = True
+
+    def __init__(self, responses, failures=None, empties=None):
+        HTTPServer.__init__(self, ('127.0.0.1', 0), StubHandler)
+        self.responses = responses
+        self.failures = failures or {}
+        self.empties = empties or {}
+        self.requests = []
+        self.connections = set()
+        self.lock = threading.Lock()
+
+    @property
+    def address(self):
+        return str('http://127.0.0.1:' + str(self.server_address[1]) + '/')
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        body = json.loads(self.rfile.read(length).decode()) if length else {}
+        path = self.path.replace('/proasisapi/v1.4/', '', 1)
+
+        with self.server.lock:
+            self.server.requests.append((path, body))
+            self.server.connections.add(self.client_address)
+            failing = self.server.failures.get(path, 0) > 0
+            if failing:
+                self.server.failures[path] -= 1
+            empty = not failing and self.server.empties.get(path, 0) > 0
+            if empty:
+                self.server.empties[path] -= 1
+
+        if failing:
+            status, data = 500, b'error'
+        elif empty:
+            status, data = 200, b'{}'
+        elif path in self.server.responses:
+            status, data = 200, json.dumps(self.server.responses[path]).encode()
+        else:
+            status, data = 404, b'not found'
+
+        self.send_response(status)
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, *args):
+        pass
+
+
+class TestProasisClient(unittest.TestCase):
+    def setUp(self):
+        self.strucids = [str('ab' + str(i).zfill(3)) for i in range(20)]
+        responses = dict((str('idlookup/' + s), {'allStrucs': [{'TITLE': str('XX0' + str(i % 5) + ' ' + s)}]})
+                         for i, s in enumerate(self.strucids))
+        responses['projectlookup/PROT?strucsource=inh&idonly=1'] = {'strucids': ','.join(self.strucids)}
+        self.server = ProasisStub(responses, failures={'idlookup/ab000': 2}, empties={'idlookup/ab001': 2})
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+        self.client = proasis_api_funcs.ProasisClient(self.server.address, 'proasisapi/v1.4/', 'user', 'pass',
+                                                      retries=3, backoff=0, workers=4)
+        proasis_api_funcs.set_client(self.client)
+
+    def tearDown(self):
+        proasis_api_funcs.set_client(None)
+        self.client.close()
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_get_json(self):
+        self.assertEqual(proasis_api_funcs.get_strucids_from_project('PROT'), self.strucids)
+        # credentials go in the body of the request
+        self.assertEqual(self.server.requests[0][1], {'username': 'user', 'password': 'pass'})
+
+    def test_retries(self):
+        self.assertEqual(self.client.get_json('idlookup/ab000')['allStrucs'][0]['TITLE'], 'XX00 ab000')
+        self.assertEqual(len(self.server.requests), 3)
+        self.assertIsNone(self.client.get_json('idlookup/missing', retries=1))
+
+        # empty json is retried too
+        self.assertEqual(self.client.get_json('idlookup/ab001')['allStrucs'][0]['TITLE'], 'XX01 ab001')
+        self.assertEqual(len([path for path, _ in self.server.requests if path == 'idlookup/ab001']), 3)
+
+    def test_get_many(self):
+        jsons = proasis_api_funcs.get_strucids_json(self.strucids)
+        self.assertEqual([j['allStrucs'][0]['TITLE'].split()[-1] for j in jsons], self.strucids)
+        # connections are kept open and shared, so there are never more than one per worker
+        self.assertLessEqual(len(self.server.connections), 4)
+
+    def test_forked_client(self):
+        # a forked process makes its own client with the same settings, rather than using its parent's connections
+        context = multiprocessing.get_context('fork')
+        queue = context.Queue()
+
+        def child():
+            proasis_client = proasis_api_funcs.client()
+            queue.put((proasis_client is self.client, proasis_client.base_url,
+                       proasis_api_funcs.get_strucids_from_project('PROT')))
+
+        process = context.Process(target=child)
+        process.start()
+        result = queue.get(timeout=30)
+        process.join()
+
+        self.assertEqual(result, (False, self.client.base_url, self.strucids))
+        self.assertIs(proasis_api_funcs.client(), self.client)
+
+
+if __name__ == '__main__':
+    unittest.main()
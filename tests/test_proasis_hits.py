@@ -0,0 +1,155 @@
+import ast
+import os
+import re
+import shutil
+import tempfile
+import unittest
+
+import setup_django
+setup_django.setup_django()
+
+from functions import cache_functions, db_functions
+from functions.misc_functions import get_mod_date
+from xchem_db.models import *
+
+
+def write_structure(directory, ligand_lines):
+    # a bound state pdb file and the maps proasis needs alongside it
+    os.makedirs(directory)
+    pdb_file = os.path.join(directory, 'refine.split.bound-state.pdb')
+    with open(pdb_file, 'w') as f:
+        f.write('ATOM      1  N   ALA A   1      11.104   6.134  -6.504  1.00 20.00           N\n')
+        f.writelines(ligand_lines)
+        f.write('LINK         C1  LIG A 501                 N   ALA A   1     1555   1555  1.40\n')
+        f.write('END\n')
+    for name in ['refine.mtz', '2fofc.map', 'fofc.map']:
+        open(os.path.join(directory, name), 'w').close()
+    return pdb_file
+
+
+def hetatm(serial, altloc, residue):
+    return str('HETATM' + str(serial).rjust(5) + '  C1 ' + altloc + 'LIG A ' + str(residue).rjust(3)
+               + '      10.000  10.000  10.000  0.50 20.00           C\n')
+
+
+def legacy_hits(bound_conf):
+    """
+    The hits the loop in InitDBEntries (before bulk reconciliation) made from a refinement's bound pdb file, without
+    the proasis calls: {altconf: fields}
+    """
+    mtz = db_functions.check_file_status('refine.mtz', bound_conf)
+    two_fofc = db_functions.check_file_status('2fofc.map', bound_conf)
+    fofc = db_functions.check_file_status('fofc.map', bound_conf)
+
+    ligand_list = []
+    for line in open(bound_conf):
+        if 'LIG' in line and 'LINK' not in line:
+            try:
+                ligand_list.append(re.search(r".LIG.......", line).group())
+            except AttributeError:
+                continue
+    unique_ligands = list(set(ligand_list))
+
+    lig_no_conf = [lig[1:] for lig in unique_ligands]
+    confs = []
+    for lig in lig_no_conf:
+        if lig_no_conf.count(lig) > 1:
+            confs.extend([conf for conf in unique_ligands if lig in conf])
+
+    fields = {'pdb_file': bound_conf, 'modification_date': get_mod_date(bound_conf), 'mtz': mtz[1],
+              'two_fofc': two_fofc[1], 'fofc': fofc[1], 'ligand_list': sorted(unique_ligands)}
+
+    return dict((conf, fields) for conf in (set(confs) or [None]))
+
+
+class TestHitReconciliation(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        cache_functions.stat_cache.clear()
+
+        proposal = Proposals.objects.create(proposal='lb90010')
+        visit = SoakdbFiles.objects.create(filename=os.path.join(self.directory, 'soakDBDataFile.sqlite'),
+                                           modification_date=0, proposal=proposal, visit='lb90010-1')
+        target = Target.objects.create(target_name='HITS')
+
+        structures = {
+            # one ligand, no altconfs: one new hit
+            'new': [hetatm(2, ' ', 501)],
+            # two conformations of the same ligand: a hit for each
+            'altconf': [hetatm(2, 'A', 501), hetatm(3, 'B', 501), hetatm(4, ' ', 502)],
+            # already uploaded from an older pdb file, so it has to be retired and made again
+            'retired': [hetatm(2, ' ', 501), hetatm(3, ' ', 601)]
+        }
+
+        self.refinements = {}
+        for name, lines in structures.items():
+            crystal = Crystal.objects.create(crystal_name=str('HITS-' + name), target=target, visit=visit)
+            pdb_file = write_structure(os.path.join(self.directory, name), lines)
+            self.refinements[name] = Refinement.objects.create(crystal_name=crystal, outcome=5, bound_conf=pdb_file)
+
+        retired = self.refinements['retired']
+        self.retired_hit = ProasisHits.objects.create(
+            refinement=retired, crystal_name=retired.crystal_name, pdb_file=retired.bound_conf,
+            modification_date='20000101000000', strucid='ab123', ligand_list=str(['LIG A 501 ']),
+            mtz='old.mtz', two_fofc='old_2fofc.map', fofc='old_fofc.map')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+        for m in [ProasisHits, Refinement, Crystal, Target, SoakdbFiles, Proposals]:
+            m.objects.all().delete()
+
+    def hits(self, refinement):
+        return dict((hit.altconf, dict((f, getattr(hit, f)) for f in db_functions.hit_file_fields))
+                    for hit in ProasisHits.objects.filter(refinement=refinement))
+
+    def test_matches_legacy_loop(self):
+        print('test_matches_legacy_loop')
+        probed = db_functions.probe_hits(db_functions.hit_candidates(), workers=4)
+        changes = db_functions.hit_changes(probed)
+
+        self.assertEqual(len(changes['create']), 3)
+        self.assertEqual([hit.id for hit, _ in changes['update']], [self.retired_hit.id])
+        self.assertEqual(changes['delete'], [])
+
+        # the structure is still in proasis, so has to be removed before the hit is updated (see retire_hits)
+        self.assertEqual(changes['update'][0][0].strucid, 'ab123')
+        changes['update'][0][0].strucid = None
+        db_functions.apply_hit_changes(changes)
+
+        for name, refinement in self.refinements.items():
+            hits = self.hits(refinement)
+            # the old loop saved the list of ligands in whatever order set() gave them
+            for fields in hits.values():
+                fields['ligand_list'] = sorted(ast.literal_eval(fields['ligand_list']))
+            self.assertEqual(hits, legacy_hits(refinement.bound_conf), name)
+
+        self.assertEqual(sorted(self.hits(self.refinements['altconf']).keys()), ['ALIG A 501 ', 'BLIG A 501 '])
+        self.assertIsNone(ProasisHits.objects.get(id=self.retired_hit.id).strucid)
+
+        # nothing to do the second time round
+        changes = db_functions.hit_changes(db_functions.probe_hits(db_functions.hit_candidates(), workers=4))
+        self.assertEqual((changes['create'], changes['update'], changes['delete'], changes['unchanged']),
+                         ([], [], [], 4))
+
+    def test_removed_altconf(self):
+        print('test_removed_altconf')
+        db_functions.apply_hit_changes(db_functions.hit_changes(
+            db_functions.probe_hits(db_functions.hit_candidates(), workers=4)))
+
+        # the B conformation is taken out of the model. The old loop only updated the existing hits, so would have
+        # kept a hit for it; it is now deleted
+        refinement = self.refinements['altconf']
+        write_structure(os.path.join(self.directory, 'altconf_2'), [hetatm(2, ' ', 501), hetatm(4, ' ', 502)])
+        os.rename(os.path.join(self.directory, 'altconf_2', 'refine.split.bound-state.pdb'), refinement.bound_conf)
+        cache_functions.stat_cache.clear()
+
+        changes = db_functions.hit_changes(db_functions.probe_hits(db_functions.hit_candidates(), workers=4))
+        self.assertEqual(sorted(hit.altconf for hit in changes['delete']), ['ALIG A 501 ', 'BLIG A 501 '])
+        self.assertEqual([hit.altconf for hit in changes['create']], [None])
+
+        db_functions.apply_hit_changes(changes)
+        self.assertEqual(list(self.hits(refinement).keys()), [None])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,101 @@
+import unittest
+
+import setup_django
+setup_django.setup_django()
+
+from rest_framework.test import APIClient
+
+from xchem_db import spatial
+from xchem_db.models import *
+
+
+class TestSpatialViews(unittest.TestCase):
+    def setUp(self):
+        spatial.indexes.clear()
+        # DEBUG with no ALLOWED_HOSTS only accepts localhost
+        self.client = APIClient(SERVER_NAME='localhost')
+
+        proposal = Proposals.objects.create(proposal='lb90030')
+        visit = SoakdbFiles.objects.create(filename='/not/a/real/soakDBDataFile.sqlite', modification_date=0,
+                                           proposal=proposal, visit='lb90030-1')
+        target = Target.objects.create(target_name='SPATIAL')
+        crystal = Crystal.objects.create(crystal_name='SPATIAL-x0001', target=target, visit=visit)
+        refinement = Refinement.objects.create(crystal_name=crystal, outcome=5)
+        data_proc = DataProcessing.objects.create(crystal_name=crystal)
+        self.run = PanddaRun.objects.create(pandda_analysis=PanddaAnalysis.objects.create(pandda_dir='/not/a/pandda'),
+                                            pandda_log='/not/a/pandda/logs/pandda-2018-01-01-0000.log')
+
+        self.sites = {}
+        for site, centroid in [(1, (0, 0, 0)), (2, (1, 0, 0)), (3, (10, 10, 10)), (4, (0, None, 0))]:
+            self.sites[site] = PanddaSite.objects.create(
+                pandda_run=self.run, site=site, site_native_centroid_x=centroid[0],
+                site_native_centroid_y=centroid[1], site_native_centroid_z=centroid[2])
+
+        self.events = {}
+        for event, centroid in [(1, (0, 0, 0)), (2, (2, 0, 0)), (3, (20, 0, 0)), (4, (1, 0, None))]:
+            self.events[event] = PanddaEvent.objects.create(
+                crystal=crystal, site=self.sites[event], refinement=refinement, data_proc=data_proc,
+                pandda_run=self.run, event=event, interesting=False, event_centroid_x=centroid[0],
+                event_centroid_y=centroid[1], event_centroid_z=centroid[2])
+
+    def tearDown(self):
+        spatial.indexes.clear()
+        for m in [PanddaEvent, PanddaSite, PanddaRun, PanddaAnalysis, DataProcessing, Refinement, Crystal, Target,
+                  SoakdbFiles, Proposals]:
+            m.objects.all().delete()
+
+    def get(self, path, **params):
+        return self.client.get(str('/api/' + path + '/'), params)
+
+    def near(self, **params):
+        response = self.get('pandda_event_near', **params)
+        self.assertEqual(response.status_code, 200, response.data)
+        return [(event['id'], round(event['distance'], 6)) for event in response.data]
+
+    def test_event_near(self):
+        print('test_event_near')
+        # the event with no z centroid isn't in the index, so doesn't come back with a NaN distance
+        expected = [(self.events[1].id, 0.0), (self.events[2].id, 2.0)]
+        self.assertEqual(self.near(pandda_run=self.run.id, x=0, y=0, z=0, radius=5), expected)
+        self.assertEqual(self.near(target='spatial', x=0, y=0, z=0, radius=5), expected)
+        self.assertEqual(self.near(pandda_run=self.run.id, x=0, y=0, z=0, k=10),
+                         expected + [(self.events[3].id, 20.0)])
+        self.assertEqual(self.near(pandda_run=self.run.id, x=100, y=100, z=100), [])
+
+    def test_event_near_bad_params(self):
+        print('test_event_near_bad_params')
+        for params in [{'pandda_run': self.run.id, 'x': 0, 'y': 0},
+                       {'x': 0, 'y': 0, 'z': 0},
+                       {'pandda_run': self.run.id, 'x': 'a', 'y': 0, 'z': 0},
+                       {'pandda_run': 'a', 'x': 0, 'y': 0, 'z': 0},
+                       {'pandda_run': self.run.id, 'x': 0, 'y': 0, 'z': 0, 'radius': 'a'},
+                       {'pandda_run': self.run.id, 'x': 0, 'y': 0, 'z': 0, 'k': '1.5'},
+                       {'pandda_run': self.run.id, 'x': 0, 'y': 0, 'z': 0, 'centroid': 'native'}]:
+            response = self.get('pandda_event_near', **params)
+            self.assertEqual(response.status_code, 400, params)
+            self.assertIn('error', response.data)
+
+    def test_site_cluster(self):
+        print('test_site_cluster')
+        response = self.get('pandda_site_cluster', pandda_run=self.run.id, radius=1.5)
+        self.assertEqual(response.status_code, 200, response.data)
+        # the site with no y centroid is left out
+        self.assertEqual([sorted(group) for group in response.data],
+                         [sorted([self.sites[1].id, self.sites[2].id]), [self.sites[3].id]])
+
+        response = self.get('pandda_site_cluster', target='SPATIAL', radius=0.5)
+        self.assertEqual(sorted(len(group) for group in response.data), [1, 1, 1])
+
+    def test_site_cluster_bad_params(self):
+        print('test_site_cluster_bad_params')
+        for params in [{},
+                       {'pandda_run': 'a'},
+                       {'pandda_run': self.run.id, 'radius': 'a'},
+                       {'pandda_run': self.run.id, 'centroid': 'event'}]:
+            response = self.get('pandda_site_cluster', **params)
+            self.assertEqual(response.status_code, 400, params)
+            self.assertIn('error', response.data)
+
+
+if __name__ == '__main__':
+    unittest.main()
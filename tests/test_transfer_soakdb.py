@@ -2,6 +2,7 @@ import json
 import os
 import shutil
 import sqlite3
+import time
 import unittest
 
 import setup_django
@@ -10,11 +11,16 @@ setup_django.setup_django()
 import datetime
 import pandas
 
-from functions.db_functions import soakdb_query
+from functions import misc_functions
+from functions.db_functions import soakdb_query, transfer_soakdb_file, pop_soakdb, update_proposal_fedids, \
+    upload_mismatches, expected_values
 from functions.misc_functions import get_mod_date
 from luigi_classes.transfer_soakdb import FindSoakDBFiles, TransferAllFedIDsAndDatafiles, CheckFiles, \
-    TransferNewDataFile, transfer_file, TransferChangedDataFile
-from luigi_classes.transfer_pandda import AddPanddaRun, AddPanddaSites
+    TransferNewDataFile, transfer_file, TransferChangedDataFile, transfer_files_parallel, \
+    reset_pandda_markers, StartTransfers
+from functions import db_functions, pandda_functions
+from luigi_classes.transfer_pandda import AddPanddaRun, AddPanddaSites, AddPanddaEvents, TransferPandda, \
+    FindSearchPaths, write_pandda_run, transfer_pandda_parallel
 from xchem_db.models import *
 from .test_functions import run_luigi_worker
 
@@ -22,6 +28,11 @@ from .test_functions import run_luigi_worker
 # + misc_functions.get_mod_date
 # - luigi_classes.transfer_soakdb.transfer_file
 # + soakdb_query
+# + transfer_soakdb_file
+# + transfer_files_parallel
+# + update_proposal_fedids
+# + upload_mismatches
+# + expected_values
 
 # task list:
 # + FindSoakDBFiles
@@ -109,6 +120,47 @@ class TestTransferSoakDBDependencyFunctions(unittest.TestCase):
     #     transfer_file(self.db)
 
 
+class TestProposalFedids(unittest.TestCase):
+    # proposals that won't be in the group database of the test environment
+    proposals = ['lb90001', 'lb90002']
+
+    def setUp(self):
+        # fill the group cache as if the group database had been read just now
+        self.saved_cache = dict(misc_functions.group_cache)
+        misc_functions.group_cache['members'] = {'lb90001': 'abc12345,def67890'}
+        misc_functions.group_cache['time'] = time.time()
+
+    def tearDown(self):
+        misc_functions.group_cache.update(self.saved_cache)
+        Proposals.objects.filter(proposal__in=self.proposals).delete()
+
+    def test_update_proposal_fedids(self):
+        print('test_update_proposal_fedids')
+        # duplicates are written once, and groups not in the cache are looked up and cached as blank
+        self.assertEqual(update_proposal_fedids(self.proposals + self.proposals[:1]), (2, 0))
+        self.assertEqual(Proposals.objects.get(proposal='lb90001').fedids, 'abc12345,def67890')
+        self.assertEqual(Proposals.objects.get(proposal='lb90001').title, '90001')
+        self.assertEqual(Proposals.objects.get(proposal='lb90002').fedids, '')
+        self.assertEqual(misc_functions.group_cache['members']['lb90002'], '')
+
+        # nothing has changed, so nothing is written
+        self.assertEqual(update_proposal_fedids(self.proposals), (0, 0))
+
+        # a change to the cached group is written to the proposal
+        misc_functions.group_cache['members']['lb90002'] = 'ghi13579'
+        self.assertEqual(update_proposal_fedids(self.proposals), (0, 1))
+        self.assertEqual(Proposals.objects.get(proposal='lb90002').fedids, 'ghi13579')
+
+    def test_group_cache_expiry(self):
+        print('test_group_cache_expiry')
+        self.assertEqual(misc_functions.get_fedids('lb90001'), 'abc12345,def67890')
+
+        # once the cache has expired the group database is read again, and the made up group is gone
+        misc_functions.group_cache['time'] = time.time() - misc_functions.GROUP_CACHE_TTL - 1
+        self.assertEqual(misc_functions.get_fedids('lb90001'), '')
+        self.assertTrue(time.time() - misc_functions.group_cache['time'] < misc_functions.GROUP_CACHE_TTL)
+
+
 class TestTransferSoakDBTasks(unittest.TestCase):
     # filepath where test data is (in docker container) and filenames for soakdb
     filepath = '/pipeline/tests/data/soakdb_files/'
@@ -278,6 +330,168 @@ class TestTransferSoakDBTasks(unittest.TestCase):
         print(Crystal.objects.all())
         print('\n')
 
+    # tasks: FindSoakDBFiles -> TransferAllFedIDsAndDatafiles -> CheckFiles
+    # scenario: one sweep over a new file, a changed file, an unchanged file, and a file in the soakdb table that
+    # wasn't found this time
+    def test_check_files_sweep(self):
+        print('test_check_files_sweep')
+        copies = dict((name, os.path.join(self.db_filepath, name, self.db_file_name))
+                      for name in ['new', 'unchanged'])
+        for copy in copies.values():
+            os.makedirs(os.path.dirname(copy))
+            shutil.copy(self.db, copy)
+            self.addCleanup(shutil.rmtree, os.path.dirname(copy))
+        missing = os.path.join(self.db_filepath, 'missing', self.db_file_name)
+
+        proposal = Proposals.objects.get_or_create(proposal='lb13385')[0]
+        # changed: modification date older than the file's
+        SoakdbFiles.objects.get_or_create(filename=self.db, proposal=proposal, modification_date=0)
+        transfer_file(self.db)
+        SoakdbFiles.objects.create(filename=copies['unchanged'], proposal=proposal, status=2,
+                                   modification_date=get_mod_date(copies['unchanged']))
+        SoakdbFiles.objects.create(filename=missing, proposal=proposal, status=2, modification_date=0)
+
+        # emulate soakdb and transfer tasks
+        with open(self.findsoakdb_outfile, 'w') as f:
+            f.write('\n'.join([self.db, copies['new'], copies['unchanged']]))
+        os.system('touch ' + self.transfer_outfile)
+
+        check_files = run_luigi_worker(CheckFiles(date=self.date, soak_db_filepath=self.db_filepath))
+        self.assertTrue(check_files)
+
+        self.assertEqual(SoakdbFiles.objects.get(filename=copies['new']).status, 0)
+        self.assertEqual(SoakdbFiles.objects.get(filename=copies['new']).modification_date,
+                         int(get_mod_date(copies['new'])))
+        self.assertEqual(SoakdbFiles.objects.get(filename=self.db).status, 1)
+        self.assertEqual(SoakdbFiles.objects.get(filename=copies['unchanged']).status, 2)
+        # files that weren't found are left alone
+        self.assertEqual(SoakdbFiles.objects.get(filename=missing).status, 2)
+        self.assertEqual(SoakdbFiles.objects.count(), 4)
+        print('\n')
+
+    # function: bulk transfer should write each table once, and leave everything alone on a second pass
+    def test_transfer_soakdb_file(self):
+        print('test_transfer_soakdb_file')
+        soak_db_dump = {'filename': self.db,
+                        'proposal': Proposals.objects.get_or_create(proposal='lb13385')[0],
+                        'modification_date': 0
+                        }
+
+        SoakdbFiles.objects.get_or_create(**soak_db_dump)
+
+        stats = transfer_soakdb_file(self.db)
+
+        self.assertEqual(stats['rows'], 1)
+        self.assertEqual(stats['Crystal'], (1, 0))
+        self.assertEqual(Crystal.objects.filter(visit__filename=self.db).count(), 1)
+        self.assertEqual(Lab.objects.filter(crystal_name__visit__filename=self.db).count(), 1)
+
+        stats = transfer_soakdb_file(self.db)
+
+        self.assertEqual(stats['Crystal'], (0, 0))
+        for model in ['Lab', 'Refinement', 'Dimple', 'DataProcessing']:
+            self.assertEqual(stats[model], (0, 0))
+        self.assertEqual(Crystal.objects.filter(visit__filename=self.db).count(), 1)
+        print('\n')
+
+    # function: the upload check should find nothing after a transfer, and report a row changed behind its back
+    def test_upload_mismatches(self):
+        print('test_upload_mismatches')
+        SoakdbFiles.objects.get_or_create(filename=self.db, modification_date=0,
+                                          proposal=Proposals.objects.get_or_create(proposal='lb13385')[0])
+        transfer_soakdb_file(self.db)
+
+        for model in [Lab, Refinement, Dimple, DataProcessing]:
+            self.assertEqual(len(upload_mismatches(self.db, model)), 0)
+
+        Lab.objects.filter(crystal_name__visit__filename=self.db).update(solv_frac=99)
+        Refinement.objects.filter(crystal_name__visit__filename=self.db).update(outcome=3,
+                                                                               lig_confidence_string='Low')
+
+        errors = upload_mismatches(self.db, Lab)
+        self.assertEqual(list(errors['model_field']), ['solv_frac'])
+        self.assertEqual(list(errors['crystal']), ['NUDT5A-x0114'])
+        self.assertEqual(float(errors['model_value'][0]), 99)
+
+        errors = upload_mismatches(self.db, Refinement)
+        self.assertEqual(sorted(errors['model_field']), ['lig_confidence_string', 'outcome'])
+        self.assertEqual(list(errors[errors['model_field'] == 'outcome']['soakdb_value']), ['6 - Deposited'])
+
+        # the checked values are translated as they are for the transfer
+        expected, skip = expected_values(pandas.Series(['6 - Deposited', 'None', '', '1 - 2']), 'outcome')
+        self.assertEqual(list(expected[:1]), [6])
+        self.assertEqual(list(skip), [False, True, True, False])
+        self.assertTrue(pandas.isnull(expected[3]))
+        expected, skip = expected_values(pandas.Series(['4 - High Confidence', None]), 'lig_confidence_int')
+        self.assertEqual(list(expected), [4, -1])
+        expected, skip = expected_values(pandas.Series(['4 - High Confidence', None]), 'lig_confidence_string')
+        self.assertEqual(list(expected), [' High Confidence', 'Unassigned'])
+        print('\n')
+
+    # function: an incremental transfer should skip rows that haven't changed since the last transfer
+    def test_transfer_soakdb_file_incremental(self):
+        print('test_transfer_soakdb_file_incremental')
+        soak_db_dump = {'filename': self.db,
+                        'proposal': Proposals.objects.get_or_create(proposal='lb13385')[0],
+                        'modification_date': 0
+                        }
+
+        SoakdbFiles.objects.get_or_create(**soak_db_dump)
+
+        stats = transfer_soakdb_file(self.db, incremental=True)
+
+        self.assertEqual(stats['unchanged'], 0)
+        self.assertEqual(stats['Crystal'], (1, 0))
+        self.assertEqual(SoakdbRowHash.objects.filter(crystal__visit__filename=self.db).count(), 1)
+
+        crystal_id = Crystal.objects.get(visit__filename=self.db).id
+
+        stats = transfer_soakdb_file(self.db, incremental=True)
+
+        self.assertEqual(stats['unchanged'], 1)
+        self.assertEqual(stats['stale'], [])
+        # the crystal (and anything hanging off it) should not have been touched
+        self.assertEqual(Crystal.objects.get(visit__filename=self.db).id, crystal_id)
+        print('\n')
+
+    # function: transferring files with a process pool should give the same result as transferring them one by one
+    def test_transfer_files_parallel(self):
+        print('test_transfer_files_parallel')
+        # copies of the test file in different visits
+        copies = []
+        for i in range(8):
+            directory = os.path.join('/pipeline/tests/data/parallel/', str('lb1338' + str(i) + '-1'), 'database')
+            os.makedirs(directory, exist_ok=True)
+            shutil.copy(self.db, directory)
+            copies.append(os.path.join(directory, self.db_file_name))
+
+        for copy in copies:
+            pop_soakdb(copy)
+
+        start = datetime.datetime.now()
+        for copy in copies:
+            transfer_file(copy)
+        serial = (datetime.datetime.now() - start).total_seconds()
+
+        self.assertEqual(Crystal.objects.filter(visit__filename__in=copies).count(), len(copies))
+
+        Crystal.objects.filter(visit__filename__in=copies).delete()
+
+        start = datetime.datetime.now()
+        results = transfer_files_parallel(copies, [], '/pipeline/tests/data/parallel/proasis/', 4)
+        parallel = (datetime.datetime.now() - start).total_seconds()
+
+        print(str('serial: ' + str(serial) + 's, parallel (4 workers): ' + str(parallel) + 's, speedup: ' +
+                  str(round(serial / parallel, 2))))
+
+        self.assertEqual([error for _, _, error in results], [None] * len(copies))
+        self.assertEqual(Crystal.objects.filter(visit__filename__in=copies).count(), len(copies))
+        self.assertEqual(Target.objects.count(), 1)
+        self.assertEqual(set(SoakdbFiles.objects.filter(filename__in=copies).values_list('status', flat=True)), {2})
+
+        shutil.rmtree('/pipeline/tests/data/parallel/')
+        print('\n')
+
     # tasks: FindSoakDBFiles -> TransferAllFedIDsAndDatafiles -> CheckFiles -> TransferChangedDatafile
     def test_transfer_changed_datafile(self):
         print('test_transfer_changed_datafile')
@@ -321,6 +535,101 @@ class TestTransferSoakDBTasks(unittest.TestCase):
         print(Crystal.objects.all())
         print('\n')
 
+    # function: events loaded before their crystals have been transferred are loaded again once they have been
+    def test_pandda_events_before_transfer(self):
+        print('test_pandda_events_before_transfer')
+        log_file = '/pipeline/tests/data/processing/analysis/panddas/logs/pandda-2018-07-29-1940.log'
+        input_dir = '/pipeline/tests/data/processing/analysis/initial_model/*'
+        output_dir = '/pipeline/tests/data/processing/analysis/panddas'
+        sites_file = '/pipeline/tests/data/processing/analysis/panddas/analyses/pandda_analyse_sites.csv'
+        events_file = '/pipeline/tests/data/processing/analysis/panddas/analyses/pandda_analyse_events.csv'
+        job = (log_file, '0.2.12-dev', input_dir, output_dir, sites_file, events_file, self.db)
+        for marker in ['.run.done', '.sites.done', '.events.done']:
+            self.addCleanup(os.remove, str(log_file + marker))
+
+        # the run as read by read_pandda_run, with every event's files found
+        events_frame = pandda_functions.read_events(events_file)
+        event_info = []
+        for i, row in events_frame.iterrows():
+            files = ('event.ccp4', 'input.pdb', 'input.mtz', 'aligned.pdb', 'model.pdb', [True] * 5)
+            event_info.append((pandda_functions.event_fields(row, files, 'LIG A 1 ', [0.0, 0.0, 0.0], 1.0, 2.0),
+                               list(files[:5]), files[5], None))
+        run = {'sites_fingerprint': pandda_functions.file_fingerprint(sites_file),
+               'events_fingerprint': pandda_functions.file_fingerprint(events_file),
+               'sites_frame': pandda_functions.read_sites(sites_file), 'events_frame': events_frame,
+               'event_info': event_info}
+
+        # found by CheckFiles, but not transferred yet
+        SoakdbFiles.objects.create(filename=self.db, proposal=Proposals.objects.get_or_create(proposal='lb13385')[0],
+                                   modification_date=get_mod_date(self.db), status=0)
+
+        counts, _, error = write_pandda_run(job, run)
+        self.assertIsNone(error)
+        self.assertEqual(counts['skipped'], len(events_frame))
+        self.assertEqual(PanddaEvent.objects.count(), 0)
+        # nothing has been transferred since, so there is nothing to retry yet
+        self.assertFalse(db_functions.pandda_events_changed(log_file, events_file, self.db))
+
+        # the modification date doesn't change with the transfer, but the status and crystals do
+        transfer_file(self.db)
+        self.assertTrue(db_functions.pandda_events_changed(log_file, events_file, self.db))
+
+        counts, _, error = write_pandda_run(job, run)
+        self.assertIsNone(error)
+        self.assertEqual(counts['skipped'], 0)
+        self.assertEqual(PanddaEvent.objects.filter(crystal__visit__filename=self.db).count(), len(events_frame))
+        self.assertFalse(db_functions.pandda_events_changed(log_file, events_file, self.db))
+        print('\n')
+
+    # function: loading the pandda runs in parallel should give the same runs, sites and events as the task chain
+    def test_transfer_pandda_parallel(self):
+        print('test_transfer_pandda_parallel')
+        log_file = '/pipeline/tests/data/processing/analysis/panddas/logs/pandda-2018-07-29-1940.log'
+        params = {'log_file': log_file, 'pver': '0.2.12-dev',
+                  'input_dir': '/pipeline/tests/data/processing/analysis/initial_model/*',
+                  'output_dir': '/pipeline/tests/data/processing/analysis/panddas',
+                  'sites_file': '/pipeline/tests/data/processing/analysis/panddas/analyses/pandda_analyse_sites.csv',
+                  'events_file': '/pipeline/tests/data/processing/analysis/panddas/analyses/pandda_analyse_events.csv'}
+
+        SoakdbFiles.objects.create(filename=self.db, proposal=Proposals.objects.get_or_create(proposal='lb13385')[0],
+                                   modification_date=0)
+        transfer_file(self.db)
+
+        def loaded():
+            return (list(PanddaRun.objects.values_list('pandda_log', 'input_dir', 'sites_file', 'events_file')),
+                    sorted(PanddaSite.objects.values_list('site', 'site_native_centroid_x', 'site_aligned_centroid_x')),
+                    sorted(PanddaEvent.objects.values_list('site__site', 'event', 'crystal__crystal_name', 'lig_id',
+                                                           'pandda_model_pdb', 'event_centroid_x')),
+                    sorted(PanddaEventStats.objects.values_list('event__event', 'one_minus_bdc', 'cluster_size')))
+
+        def reset():
+            for marker in ['.run.done', '.sites.done', '.events.done']:
+                if os.path.isfile(str(log_file + marker)):
+                    os.remove(str(log_file + marker))
+            PanddaRun.objects.all().delete()
+            PanddaAnalysis.objects.all().delete()
+
+        self.addCleanup(reset)
+
+        self.assertTrue(run_luigi_worker(AddPanddaEvents(sdbfile=self.db, **params)))
+        expected = loaded()
+        reset()
+
+        results = transfer_pandda_parallel([('/pipeline/tests/data/processing/', self.db)], workers=2, writers=2)
+        self.assertEqual([(log, error) for log, _, _, _, error in results], [(log_file, None)])
+        self.assertEqual(loaded(), expected)
+        for marker in ['.run.done', '.sites.done', '.events.done']:
+            self.assertTrue(os.path.isfile(str(log_file + marker)))
+
+        # nothing has changed, so nothing is loaded again
+        self.assertEqual(transfer_pandda_parallel([('/pipeline/tests/data/processing/', self.db)], workers=2,
+                                                  writers=2), [])
+
+        # the soakdb files are transferred before the runs are loaded in run()
+        required = TransferPandda(soak_db_filepath=self.db_filepath, parallel=True).requires()
+        self.assertEqual([type(task) for task in required], [FindSearchPaths, StartTransfers])
+        print('\n')
+
     def test_pandda_deleted_changed_file(self):
         log_file = '/pipeline/tests/data/processing/analysis/panddas/logs/pandda-2018-07-29-1940.log'
         pver = '0.2.12-dev'
@@ -386,9 +695,20 @@ class TestTransferSoakDBTasks(unittest.TestCase):
         print(Crystal.objects.all())
         print('\n')
 
-        self.assertTrue(os.path.isfile('/pipeline/tests/data/processing/analysis/panddas/logs/pandda-2018-07-29-1940.log.run.done')==False)
+        # a soakdb change doesn't force the pandda runs to be loaded again: the sites csv hasn't changed
+        self.assertTrue(os.path.isfile('/pipeline/tests/data/processing/analysis/panddas/logs/pandda-2018-07-29-1940.log.run.done'))
         self.assertTrue(
-            os.path.isfile('/pipeline/tests/data/processing/analysis/panddas/logs/pandda-2018-07-29-1940.log.sites.done')==False)
+            os.path.isfile('/pipeline/tests/data/processing/analysis/panddas/logs/pandda-2018-07-29-1940.log.sites.done'))
+        self.assertTrue(AddPanddaSites(log_file=log_file, output_dir=output_dir, input_dir=input_dir, pver=pver,
+                                       sites_file=sites_file, events_file=events_file,
+                                       soakdb_filename=soakdb_filename).complete())
+
+        # ... unless a full reload is asked for
+        reset_pandda_markers(self.db)
+        self.assertFalse(os.path.isfile('/pipeline/tests/data/processing/analysis/panddas/logs/pandda-2018-07-29-1940.log.run.done'))
+        self.assertFalse(AddPanddaSites(log_file=log_file, output_dir=output_dir, input_dir=input_dir, pver=pver,
+                                        sites_file=sites_file, events_file=events_file,
+                                        soakdb_filename=soakdb_filename).complete())
 
 
 
@@ -0,0 +1,248 @@
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+
+import setup_django
+setup_django.setup_django()
+
+from functions import proasis_api_funcs
+from luigi_classes import transfer_proasis
+from luigi_classes.transfer_proasis import CopyFile, GetPanddaMaps, GenerateSdf, UploadHit, AddFiles, \
+    upload_hits_parallel, prepare_hit
+from xchem_db.models import *
+from .test_proasis_hits import write_structure, hetatm
+
+# worker processes preparing hits for failing_prepare, and the number of calls after which it fails
+prepare_calls = []
+PREPARE_LIMIT = 2
+
+
+def failing_prepare(job):
+    # prepare_hit, until the worker has prepared PREPARE_LIMIT hits
+    prepare_calls.append(job['hit_id'])
+    if len(prepare_calls) > PREPARE_LIMIT:
+        raise RuntimeError('worker lost')
+    return prepare_hit(job)
+
+
+class StubSubmitter(object):
+    """
+    Stands in for the proasis utils scripts: a structure gets its title as its strucid, unless the title is in
+    failures, and files can't be added to the structures in file_failures. Records what was submitted and the files
+    added.
+    """
+
+    def __init__(self, failures=(), file_failures=()):
+        self.failures = failures
+        self.file_failures = file_failures
+        self.submissions = []
+        self.files = []
+        self.lock = threading.Lock()
+
+    def submit_proasis_job_string(self, command):
+        title = command.split(' -t ')[1].split()[0]
+        with self.lock:
+            self.submissions.append(command)
+        if title in self.failures:
+            return '', '', 'no structure made'
+        return title, '', str('strucid: ' + title)
+
+    def add_proasis_file(self, file_type, filename, strucid, title):
+        if strucid in self.file_failures:
+            return '', 'could not add file'
+        with self.lock:
+            self.files.append((file_type, filename, strucid, title))
+        return '', ''
+
+
+class TestUploadHits(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.hit_directory = os.path.join(self.directory, 'hits')
+        os.makedirs(self.hit_directory)
+        self.outputs = []
+
+        self.saved = (proasis_api_funcs.submit_proasis_job_string, proasis_api_funcs.add_proasis_file)
+        self.stub = self.use_stub(StubSubmitter())
+        del prepare_calls[:]
+
+        proposal = Proposals.objects.create(proposal='lb90020')
+        visit = SoakdbFiles.objects.create(filename=os.path.join(self.directory, 'soakDBDataFile.sqlite'),
+                                           modification_date=0, proposal=proposal, visit='lb90020-1')
+        target = Target.objects.create(target_name='upload')
+        compound = Compounds.objects.create(smiles='CC(=O)Nc1ccccc1')
+
+        structures = [
+            # one ligand
+            ('UPLOAD-1', [hetatm(2, ' ', 501)], [None]),
+            # a hit for each conformation of the ligand
+            ('UPLOAD-2', [hetatm(2, 'A', 501), hetatm(3, 'B', 501)], ['ALIG A 501 ', 'BLIG A 501 ']),
+            # one ligand with an altloc, which is removed from the pdb file that is uploaded
+            ('UPLOAD-3', [hetatm(2, 'A', 501)], [None])
+        ]
+
+        for crystal_name, lines, altconfs in structures:
+            crystal = Crystal.objects.create(crystal_name=crystal_name, target=target, compound=compound, visit=visit)
+            pdb_file = write_structure(os.path.join(self.directory, crystal_name), lines)
+            refinement = Refinement.objects.create(crystal_name=crystal, outcome=5, bound_conf=pdb_file)
+            ligands = sorted(set(line[16:27] for line in lines))
+            for altconf in altconfs:
+                ProasisHits.objects.create(refinement=refinement, crystal_name=crystal, altconf=altconf,
+                                           pdb_file=pdb_file, modification_date='20180101000000',
+                                           ligand_list=str(ligands),
+                                           mtz=os.path.join(os.path.dirname(pdb_file), 'refine.mtz'),
+                                           two_fofc=os.path.join(os.path.dirname(pdb_file), '2fofc.map'),
+                                           fofc=os.path.join(os.path.dirname(pdb_file), 'fofc.map'))
+
+        # pandda events for the first crystal
+        crystal = Crystal.objects.get(crystal_name='UPLOAD-1')
+        run = PanddaRun.objects.create(pandda_analysis=PanddaAnalysis.objects.create(pandda_dir=self.directory),
+                                       pandda_log=os.path.join(self.directory, 'pandda.log'))
+        site = PanddaSite.objects.create(pandda_run=run, site=1)
+        data_proc = DataProcessing.objects.create(crystal_name=crystal)
+        for event, event_map in [(1, 'UPLOAD-1-event_1_1-BDC_0.3_map.native.ccp4'),
+                                 (2, 'UPLOAD-1-event_2_1-BDC_0.4_map.native.ccp4')]:
+            PanddaEvent.objects.create(crystal=crystal, site=site, refinement=Refinement.objects.get(
+                crystal_name=crystal), data_proc=data_proc, pandda_run=run, event=event, interesting=True,
+                pandda_event_map_native=os.path.join(self.directory, event_map),
+                pandda_model_pdb=os.path.join(self.directory, 'UPLOAD-1-pandda-model.pdb'))
+
+        self.original = dict((hit.id, dict((f, getattr(hit, f)) for f in ['pdb_file', 'two_fofc', 'fofc', 'mtz']))
+                             for hit in ProasisHits.objects.all())
+
+    def tearDown(self):
+        proasis_api_funcs.submit_proasis_job_string, proasis_api_funcs.add_proasis_file = self.saved
+        shutil.rmtree(self.directory)
+        for output in self.outputs:
+            if os.path.isfile(output):
+                os.remove(output)
+        for m in [ProasisPandda, ProasisHits, PanddaEvent, PanddaSite, PanddaRun, PanddaAnalysis, DataProcessing,
+                  Refinement, Crystal, Compounds, Target, SoakdbFiles, Proposals]:
+            m.objects.all().delete()
+
+    def use_stub(self, stub):
+        proasis_api_funcs.submit_proasis_job_string = stub.submit_proasis_job_string
+        proasis_api_funcs.add_proasis_file = stub.add_proasis_file
+        return stub
+
+    def reset(self):
+        # back to before anything was uploaded
+        ProasisPandda.objects.all().delete()
+        for hit_id, fields in self.original.items():
+            ProasisHits.objects.filter(id=hit_id).update(strucid=None, sdf=None, files_added=None, **fields)
+        shutil.rmtree(self.hit_directory)
+        os.makedirs(self.hit_directory)
+
+    def upload_chain(self):
+        # the tasks AddFiles requires for each hit, run in the order luigi would run them
+        for hit in ProasisHits.objects.filter(strucid=None).select_related('crystal_name'):
+            for field, update_field in [('pdb_file', 'pdb'), ('two_fofc', 'two_fofc'), ('mtz', 'mtz'),
+                                        ('fofc', 'fofc')]:
+                CopyFile(proasis_hit=hit, crystal=hit.crystal_name, update_field=update_field,
+                         filename=str(getattr(hit, field)), hit_directory=self.hit_directory).run()
+
+            for task_class in [GetPanddaMaps, GenerateSdf, UploadHit, AddFiles]:
+                task = task_class(crystal_id=hit.crystal_name_id, refinement_id=hit.refinement_id,
+                                  altconf=hit.altconf, hit_directory=self.hit_directory)
+                task.run()
+                self.outputs.append(task.output().path)
+
+    def uploaded(self, stub):
+        hits = sorted(ProasisHits.objects.values_list('id', 'pdb_file', 'two_fofc', 'fofc', 'mtz', 'sdf', 'strucid',
+                                                      'files_added'))
+        pandda = sorted(ProasisPandda.objects.values_list('crystal_id', 'hit_id', 'event_id', 'event_map_native',
+                                                          'model_pdb'))
+        return hits, pandda, sorted(stub.submissions), sorted(stub.files)
+
+    def test_matches_chain(self):
+        print('test_matches_chain')
+        self.upload_chain()
+        chain = self.uploaded(self.stub)
+
+        self.reset()
+        stub = self.use_stub(StubSubmitter())
+        results = upload_hits_parallel(self.hit_directory, workers=2, submitters=2)
+        parallel = self.uploaded(stub)
+
+        self.assertEqual([error for _, _, _, _, _, error in results], [None] * 4)
+        self.assertEqual(parallel, chain)
+        self.assertEqual(sorted(strucid for _, _, _, _, _, _, strucid, _ in parallel[0]),
+                         ['UPLOAD-1', 'UPLOAD-2_alt_ALIGA501', 'UPLOAD-2_alt_BLIGA501', 'UPLOAD-3'])
+        self.assertEqual(len(parallel[1]), 2)
+        self.assertEqual(len(parallel[3]), 12)
+        self.assertEqual([files_added for _, _, _, _, _, _, _, files_added in parallel[0]], [True] * 4)
+
+        # nothing left to upload
+        self.assertEqual(upload_hits_parallel(self.hit_directory, workers=2, submitters=2), [])
+
+    def test_failed_submission(self):
+        print('test_failed_submission')
+        stub = self.use_stub(StubSubmitter(failures=['UPLOAD-3']))
+        results = upload_hits_parallel(self.hit_directory, workers=2, submitters=2)
+
+        errors = dict((crystal_name, error) for crystal_name, _, _, _, _, error in results)
+        self.assertIn('no structure made', errors.pop('UPLOAD-3'))
+        self.assertEqual(list(errors.values()), [None] * 3)
+
+        # the files of every hit are recorded, and strucids for those that were made
+        failed = ProasisHits.objects.get(crystal_name__crystal_name='UPLOAD-3')
+        self.assertIsNone(failed.strucid)
+        self.assertTrue(failed.pdb_file.startswith(self.hit_directory))
+        self.assertEqual(ProasisHits.objects.exclude(strucid=None).count(), 3)
+        self.assertEqual(len(stub.submissions), 4)
+
+        # only the failed hit is tried again
+        stub = self.use_stub(StubSubmitter())
+        self.assertEqual([strucid for _, _, strucid, _, _, _ in upload_hits_parallel(self.hit_directory, workers=2,
+                                                                                     submitters=2)], ['UPLOAD-3'])
+        self.assertEqual(len(stub.submissions), 1)
+
+    def test_failed_files(self):
+        print('test_failed_files')
+        stub = self.use_stub(StubSubmitter(file_failures=['UPLOAD-3']))
+        results = upload_hits_parallel(self.hit_directory, workers=2, submitters=2)
+
+        errors = dict((crystal_name, error) for crystal_name, _, _, _, _, error in results)
+        self.assertIn('could not add file', errors.pop('UPLOAD-3'))
+        self.assertEqual(list(errors.values()), [None] * 3)
+
+        # the structure was made, but is kept for its maps and mtz to be added again
+        failed = ProasisHits.objects.get(crystal_name__crystal_name='UPLOAD-3')
+        self.assertEqual((failed.strucid, failed.files_added), ('UPLOAD-3', False))
+        self.assertEqual(ProasisHits.objects.filter(files_added=True).count(), 3)
+        self.assertEqual(len(stub.submissions), 4)
+
+        # the next run adds the files to the structure that is already there, without submitting it again
+        stub = self.use_stub(StubSubmitter())
+        self.assertEqual([(crystal_name, strucid, error) for crystal_name, _, strucid, _, _, error in
+                          upload_hits_parallel(self.hit_directory, workers=2, submitters=2)],
+                         [('UPLOAD-3', 'UPLOAD-3', None)])
+        self.assertEqual(stub.submissions, [])
+        self.assertEqual(sorted((file_type, filename, strucid) for file_type, filename, strucid, _ in stub.files),
+                         [('2fofc_c', failed.two_fofc, 'UPLOAD-3'), ('fofc_c', failed.fofc, 'UPLOAD-3'),
+                          ('mtz', failed.mtz, 'UPLOAD-3')])
+        self.assertTrue(ProasisHits.objects.get(id=failed.id).files_added)
+
+        self.assertEqual(upload_hits_parallel(self.hit_directory, workers=2, submitters=2), [])
+
+    def test_worker_failure(self):
+        print('test_worker_failure')
+        # a worker dying part way stops the upload, but the structures already submitted are still recorded
+        saved = transfer_proasis.prepare_hit
+        transfer_proasis.prepare_hit = failing_prepare
+        try:
+            with self.assertRaises(RuntimeError):
+                upload_hits_parallel(self.hit_directory, workers=1, submitters=2)
+        finally:
+            transfer_proasis.prepare_hit = saved
+
+        submitted = sorted(command.split(' -t ')[1].split()[0] for command in self.stub.submissions)
+        recorded = sorted(ProasisHits.objects.exclude(strucid=None).values_list('strucid', flat=True))
+        self.assertEqual(len(submitted), PREPARE_LIMIT)
+        self.assertEqual(recorded, submitted)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -95,6 +95,18 @@ class Crystal(models.Model):
         unique_together = ('crystal_name', 'visit', 'compound')
 
 
+class SoakdbRowHash(models.Model):
+    # content hash of the soakdb mainTable row a crystal was last transferred from
+    crystal = models.ForeignKey(Crystal, on_delete=models.CASCADE, unique=True)
+    last_updated = models.TextField(blank=True, null=True)
+    row_hash = models.CharField(max_length=40, blank=False, null=False)
+
+    class Meta:
+        if os.getcwd() != '/dls/science/groups/i04-1/software/luigi_pipeline/pipelineDEV':
+            app_label = 'xchem_db'
+        db_table = 'soakdb_row_hash'
+
+
 class DataProcessing(models.Model):
     auto_assigned = models.TextField(blank=True, null=True)
     cchalf_high = models.FloatField(blank=True, null=True)
@@ -235,6 +247,8 @@ class ProasisHits(models.Model):
     sdf = models.TextField(blank=True, null=True)
     altconf = models.CharField(max_length=255, blank=True, null=True)
     added = models.DateTimeField(auto_now_add=True)
+    # whether the maps and mtz have been added to the proasis structure (null for hits uploaded before this was kept)
+    files_added = models.NullBooleanField()
 
     class Meta:
         if os.getcwd() != '/dls/science/groups/i04-1/software/luigi_pipeline/pipelineDEV':
@@ -300,6 +314,22 @@ class PanddaRun(models.Model):
         db_table = 'pandda_run'
 
 
+class PanddaRunFingerprint(models.Model):
+    # the sites and events csvs (size:mtime:sha1) a pandda run was last loaded from
+    pandda_run = models.ForeignKey(PanddaRun, on_delete=models.CASCADE, unique=True)
+    sites_fingerprint = models.TextField(blank=True, null=True)
+    events_fingerprint = models.TextField(blank=True, null=True)
+    # the state of the soakdb file's transfer when the events were loaded (db_functions.soakdb_transfer_marker), and
+    # whether every event found its crystal
+    soakdb_transfer = models.TextField(blank=True, null=True)
+    events_complete = models.BooleanField(default=False)
+
+    class Meta:
+        if os.getcwd() != '/dls/science/groups/i04-1/software/luigi_pipeline/pipelineDEV':
+            app_label = 'xchem_db'
+        db_table = 'pandda_run_fingerprint'
+
+
 class PanddaStatisticalMap(models.Model):
     resolution_from = models.FloatField(blank=True, null=True)
     resolution_to = models.FloatField(blank=True, null=True)
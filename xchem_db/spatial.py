@@ -0,0 +1,200 @@
+import threading
+from collections import OrderedDict
+
+import numpy as np
+from django.db.models import Count, Max, Sum
+
+from .models import PanddaSite, PanddaEvent
+
+try:
+    from scipy.spatial import cKDTree
+except ImportError:
+    cKDTree = None
+
+
+# which centroid columns can be indexed for each model
+CENTROIDS = {
+    PanddaEvent: {
+        'event': ('event_centroid_x', 'event_centroid_y', 'event_centroid_z'),
+        'ligand': ('lig_centroid_x', 'lig_centroid_y', 'lig_centroid_z')
+    },
+    PanddaSite: {
+        'native': ('site_native_centroid_x', 'site_native_centroid_y', 'site_native_centroid_z'),
+        'aligned': ('site_aligned_centroid_x', 'site_aligned_centroid_y', 'site_aligned_centroid_z')
+    }
+}
+
+# indexes built by this process: (model, centroid, pandda_run, target) -> (marker, index), least recently used first.
+# At most MAX_INDEXES are kept
+MAX_INDEXES = 64
+indexes = OrderedDict()
+indexes_lock = threading.Lock()
+
+
+class SpatialIndex(object):
+    """
+    Nearest neighbour lookups over a set of centroids. Uses a KD-tree if scipy is installed, otherwise compares
+    against every point with numpy (which is still only a few ms for the few thousand events in a target).
+    """
+
+    def __init__(self, ids, points):
+        self.ids = np.asarray(ids, dtype=int)
+        self.points = np.asarray(points, dtype=float).reshape(-1, 3)
+        self.tree = None
+        if cKDTree is not None and len(self.points):
+            self.tree = cKDTree(self.points)
+
+    def __len__(self):
+        return len(self.ids)
+
+    def distances(self, point, idx=None):
+        # distances from point to all the points, or just those at the positions idx
+        points = self.points if idx is None else self.points[idx]
+        return np.sqrt(((points - np.asarray(point, dtype=float)) ** 2).sum(axis=1))
+
+    def near(self, point, radius):
+        """
+        Returns: [(id, distance), ...] for every point within radius of point, nearest first
+        """
+        if self.tree is not None:
+            idx = np.asarray(self.tree.query_ball_point(point, radius), dtype=int)
+            dists = self.distances(point, idx)
+        else:
+            dists = self.distances(point)
+            idx = np.flatnonzero(dists <= radius)
+            dists = dists[idx]
+
+        order = np.argsort(dists, kind='mergesort')
+
+        return [(int(self.ids[idx[i]]), float(dists[i])) for i in order]
+
+    def nearest(self, point, k=1):
+        """
+        Returns: [(id, distance), ...] for the k points nearest to point, nearest first
+        """
+        k = min(k, len(self))
+        if k < 1:
+            return []
+
+        if self.tree is not None:
+            dists, idx = self.tree.query(point, k=k)
+            dists = np.atleast_1d(dists)
+            idx = np.atleast_1d(idx)
+        else:
+            all_dists = self.distances(point)
+            idx = np.argsort(all_dists, kind='mergesort')[:k]
+            dists = all_dists[idx]
+
+        return [(int(i), float(d)) for i, d in zip(self.ids[idx], dists)]
+
+    def clusters(self, radius):
+        """
+        Group the points so that every point is within radius of at least one other point in its group (single
+        linkage), e.g. to find sites from different pandda runs that are the same site.
+
+        Returns: list of lists of ids, largest group first
+        """
+        parent = list(range(len(self)))
+
+        def find(i):
+            while parent[i] != i:
+                parent[i] = parent[parent[i]]
+                i = parent[i]
+            return i
+
+        if self.tree is not None:
+            pairs = self.tree.query_pairs(radius)
+        else:
+            # a block of rows of the distance matrix at a time, so memory doesn't grow with n^2
+            pairs = []
+            norms = (self.points ** 2).sum(axis=1)
+            for start in range(0, len(self), 512):
+                block = self.points[start:start + 512]
+                squared = norms[start:start + 512, None] + norms[None, :] - 2 * block.dot(self.points.T)
+                rows, cols = np.nonzero(squared <= radius ** 2)
+                rows = rows + start
+                keep = cols > rows
+                pairs.extend(zip(rows[keep].tolist(), cols[keep].tolist()))
+
+        for i, j in pairs:
+            root_i, root_j = find(i), find(int(j))
+            if root_i != root_j:
+                parent[root_j] = root_i
+
+        groups = {}
+        for i in range(len(self)):
+            groups.setdefault(find(i), []).append(int(self.ids[i]))
+
+        return sorted(groups.values(), key=lambda group: (-len(group), group[0]))
+
+
+def centroid_queryset(model, centroid, pandda_run=None, target=None):
+    # a centroid with any coordinate missing would be a NaN point in the index
+    fields = CENTROIDS[model][centroid]
+    queryset = model.objects.filter(**dict((field + '__isnull', False) for field in fields))
+
+    if pandda_run is not None:
+        queryset = queryset.filter(pandda_run=pandda_run)
+    if target is not None:
+        if model is PanddaEvent:
+            queryset = queryset.filter(crystal__target__target_name__iexact=target)
+        else:
+            queryset = queryset.filter(panddaevent__crystal__target__target_name__iexact=target).distinct()
+
+    return queryset
+
+
+def index_marker(queryset, model, centroid):
+    # cheap aggregate that changes whenever the indexed rows do. Events have a modified date, sites are upserted in
+    # place without one, so the coordinates themselves are summed
+    fields = CENTROIDS[model][centroid]
+    if model is PanddaEvent:
+        marker = queryset.aggregate(n=Count('id'), last=Max('id'), modified=Max('modified_date'))
+    else:
+        marker = queryset.aggregate(n=Count('id'), last=Max('id'), **{f: Sum(f) for f in fields})
+
+    return tuple(sorted(marker.items()))
+
+
+def get_index(model, centroid, pandda_run=None, target=None):
+    """
+    Get the spatial index of the centroids of model (PanddaEvent or PanddaSite) for one pandda run and/or target.
+    Indexes are built lazily on the first query and kept until the rows they were built from change (or until
+    MAX_INDEXES more recently used ones have been built).
+
+    Returns: SpatialIndex whose ids are the primary keys of the model
+    """
+    if centroid not in CENTROIDS[model]:
+        raise ValueError('unknown centroid ' + str(centroid) + ' for ' + model.__name__ + ', expected one of '
+                         + str(sorted(CENTROIDS[model].keys())))
+
+    queryset = centroid_queryset(model, centroid, pandda_run=pandda_run, target=target)
+    key = (model, centroid, pandda_run, target)
+    marker = index_marker(queryset, model, centroid)
+
+    with indexes_lock:
+        cached = indexes.get(key)
+        if cached is not None and cached[0] == marker:
+            indexes.move_to_end(key)
+            return cached[1]
+
+    rows = list(queryset.values_list('id', *CENTROIDS[model][centroid]))
+    ids = [row[0] for row in rows]
+    points = [row[1:] for row in rows]
+
+    index = SpatialIndex(ids, points)
+    with indexes_lock:
+        indexes[key] = (marker, index)
+        indexes.move_to_end(key)
+        while len(indexes) > MAX_INDEXES:
+            indexes.popitem(last=False)
+
+    return index
+
+
+def event_index(pandda_run=None, target=None, centroid='event'):
+    return get_index(PanddaEvent, centroid, pandda_run=pandda_run, target=target)
+
+
+def site_index(pandda_run=None, target=None, centroid='native'):
+    return get_index(PanddaSite, centroid, pandda_run=pandda_run, target=target)
@@ -1,4 +1,5 @@
-from rest_framework import viewsets
+from rest_framework import status, viewsets
+from rest_framework.response import Response
 
 from .models import Target, Compounds, Reference, SoakdbFiles, Crystal, DataProcessing, Dimple, Lab, Refinement, \
     PanddaAnalysis, PanddaRun, PanddaSite, PanddaEvent, ProasisOut
@@ -6,6 +7,7 @@ from .serializers import TargetSerializer, CompoundsSerializer, ReferenceSeriali
     CrystalSerializer, DataProcessingSerializer, DimpleSerializer, LabSerializer, RefinementSerializer, \
     PanddaAnalysisSerializer, PanddaRunSerializer, PanddaSiteSerializer, PanddaEventSerializer, ProasisOutSerializer, \
     FragspectCrystalSerializer
+from .spatial import event_index, site_index
 
 
 class TargetView(viewsets.ReadOnlyModelViewSet):
@@ -219,3 +221,98 @@ class FragspectCrystalView(viewsets.ReadOnlyModelViewSet):
     serializer_class = FragspectCrystalSerializer
     filter_fields = {'crystal__target__target_name': ['iexact']}
 
+
+
+def spatial_params(request):
+    # the pandda_run/target scope and point shared by the proximity views
+    params = request.query_params
+    pandda_run = params.get('pandda_run')
+    if pandda_run is not None:
+        pandda_run = int(pandda_run)
+    point = None
+    if all(axis in params for axis in ('x', 'y', 'z')):
+        point = (float(params['x']), float(params['y']), float(params['z']))
+    return pandda_run, params.get('target'), point
+
+
+class PanddaEventNearView(viewsets.ViewSet):
+    """
+    PanddaEvent near: events near a point, nearest first, from a spatial index of one pandda run and/or target
+    Parameters:
+        - x, y, z: the point (required)
+        - pandda_run: pandda run id
+        - target: target name
+        - radius: all events within radius (A) of the point (default)
+        - k: the k nearest events instead
+        - centroid: event (default) or ligand
+    Returns:
+        - PanddaEvent fields, plus distance from the point
+    """
+
+    def list(self, request):
+        try:
+            pandda_run, target, point = spatial_params(request)
+            radius = float(request.query_params.get('radius', 5.0))
+            k = request.query_params.get('k')
+            k = int(k) if k is not None else None
+        except ValueError as e:
+            return Response({'error': str(e)}, status=status.HTTP_400_BAD_REQUEST)
+
+        if point is None:
+            return Response({'error': 'x, y and z are required'}, status=status.HTTP_400_BAD_REQUEST)
+        if pandda_run is None and target is None:
+            return Response({'error': 'one of pandda_run or target is required'},
+                            status=status.HTTP_400_BAD_REQUEST)
+
+        try:
+            index = event_index(pandda_run=pandda_run, target=target,
+                                centroid=request.query_params.get('centroid', 'event'))
+        except ValueError as e:
+            return Response({'error': str(e)}, status=status.HTTP_400_BAD_REQUEST)
+
+        if k is not None:
+            hits = index.nearest(point, k)
+        else:
+            hits = index.near(point, radius)
+
+        events = PanddaEvent.objects.in_bulk([event_id for event_id, _ in hits])
+        results = []
+        for event_id, distance in hits:
+            data = PanddaEventSerializer(events[event_id]).data
+            data['distance'] = distance
+            results.append(data)
+
+        return Response(results)
+
+
+class PanddaSiteClusterView(viewsets.ViewSet):
+    """
+    PanddaSite cluster: groups of sites whose centroids are within radius of each other (single linkage), e.g. the
+    same site across several pandda runs of a target
+    Parameters:
+        - pandda_run: pandda run id
+        - target: target name
+        - radius: distance (A) between sites in a group (default 5)
+        - centroid: native (default) or aligned
+    Returns:
+        - list of groups of PanddaSite ids, largest first
+    """
+
+    def list(self, request):
+        try:
+            pandda_run, target, _ = spatial_params(request)
+            radius = float(request.query_params.get('radius', 5.0))
+        except ValueError as e:
+            return Response({'error': str(e)}, status=status.HTTP_400_BAD_REQUEST)
+
+        if pandda_run is None and target is None:
+            return Response({'error': 'one of pandda_run or target is required'},
+                            status=status.HTTP_400_BAD_REQUEST)
+
+        try:
+            index = site_index(pandda_run=pandda_run, target=target,
+                               centroid=request.query_params.get('centroid', 'native'))
+        except ValueError as e:
+            return Response({'error': str(e)}, status=status.HTTP_400_BAD_REQUEST)
+
+        return Response(index.clusters(radius))